@@ -0,0 +1,110 @@
+import numpy as np
+from collections import OrderedDict
+
+from .utils.flatTreeUtils import pruneTree
+from .predict_from_CCF import predictFromCCF
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def compressCCF(CCF, X, tol=0.01, maxTrees=None, bPrune=False, chunkSize=None):
+    """
+    Compresses a forest by greedily selecting a subset of its trees whose
+    averaged class probabilities on X stay within tol of those of the full
+    forest.  Trees are added one at a time, each time choosing the tree that
+    brings the averaged probabilities closest to those of the full forest,
+    until their mean absolute difference is at most tol or maxTrees trees
+    have been selected.
+
+    The out of bag statistics of the full forest do not apply to the
+    selected trees, so they are not kept and no trees can be added to the
+    compressed forest with extendCCF.
+
+    Parameters
+    ----------
+    CCF: Forest as returned by genCCF
+    X:   Held out inputs, in any format accepted by predictFromCCF, on which
+         the compressed forest is compared with the full one
+    tol: Allowed mean absolute difference between the class probabilities
+         of the compressed and the full forest
+    maxTrees: Maximum number of trees to select, defaults to all of them
+    bPrune: If true, subtrees of the selected trees whose leaves all predict
+            the same class for every output are also collapsed into single
+            leaves (see flatTreeUtils.pruneTree).  This does not change the
+            class predicted by any tree.
+    chunkSize: Passed to predictFromCCF
+
+    Returns
+    -------
+    compressedCCF: New forest holding the selected trees in their original
+                   order, which can be used by predictFromCCF.  The field
+                   compression gives the original number of trees and the
+                   achieved difference.  CCF itself is not modified.
+    """
+    _, _, treeOutputs = predictFromCCF(CCF, X, bTreeOutputs=True, chunkSize=chunkSize)
+    # Held as nTrees x N x K so that the outputs of each tree are contiguous
+    treeOutputs = np.ascontiguousarray(np.transpose(treeOutputs, (1, 0, 2)), dtype=np.float64)
+    nTrees, N, K = treeOutputs.shape
+    forestProbs  = np.mean(treeOutputs, axis=0)
+    if maxTrees is None:
+        maxTrees = nTrees
+    maxTrees = max(1, min(int(maxTrees), nTrees))
+
+    # Candidate trees are scored in blocks to bound the working memory
+    blockSize = max(1, (2**24) // (N * K))
+
+    cumProbs  = np.zeros((N, K))
+    bSelected = np.zeros((nTrees,), dtype=bool)
+    iSelected = []
+    deviation = np.inf
+    while (len(iSelected) < maxTrees) and (deviation > tol):
+        iCandidates = (~bSelected).nonzero()[0]
+        deviations  = np.empty((iCandidates.size,))
+        for iStart in range(0, iCandidates.size, blockSize):
+            iBlock = iCandidates[iStart:iStart+blockSize]
+            probs  = (cumProbs[np.newaxis, :, :] + treeOutputs[iBlock, :, :]) / (len(iSelected) + 1)
+            deviations[iStart:iStart+iBlock.size] = np.mean(np.absolute(probs - forestProbs[np.newaxis, :, :]), axis=(1, 2))
+
+        iBest     = np.argmin(deviations)
+        deviation = deviations[iBest]
+        bSelected[iCandidates[iBest]] = True
+        iSelected.append(iCandidates[iBest])
+        cumProbs  = cumProbs + treeOutputs[iCandidates[iBest], :, :]
+
+    logger.info('Selected {} of {} trees, mean absolute difference {}'.format(len(iSelected), nTrees, deviation))
+
+    keys  = list(CCF["Trees"].keys())
+    trees = OrderedDict()
+    for iTree in sorted(iSelected):
+        tree = CCF["Trees"][keys[iTree]]
+        if bPrune:
+            tree = pruneTree(tree, nodeLabels(tree, CCF["options"]))
+        trees[keys[iTree]] = tree
+
+    compressedCCF = {key: value for key, value in CCF.items() if key not in ["Trees", "stackedTrees", "oobStats", "outOfBagPreds", "outOfBagCounts"]}
+    compressedCCF["Trees"] = trees
+    compressedCCF["outOfBagError"] = 'OOB error not available for compressed forests.'
+    compressedCCF["compression"] = {"nTreesOriginal": nTrees, "deviation": float(deviation), "bPruned": bool(bPrune)}
+
+    return compressedCCF
+
+
+def nodeLabels(tree, optionsFor):
+    """
+    Class predicted by each node of a flat tree for each output, as used by
+    forestProbsToForestPredicts, i.e. whether the mean exceeds 0.5 if the
+    outputs are predicted separately and the most probable class of each
+    task otherwise.
+    """
+    mean = tree["mean"]
+    if optionsFor["bSepPred"]:
+        return mean > 0.5
+
+    if isinstance(optionsFor["task_ids"], int):
+        taskStarts = np.array([0])
+    else:
+        taskStarts = np.asarray(optionsFor["task_ids"]).ravel()
+    taskEnds = np.append(taskStarts[1:], mean.shape[1])
+
+    return np.stack([np.argmax(mean[:, iStart:iEnd], axis=1) for iStart, iEnd in zip(taskStarts, taskEnds)], axis=1)
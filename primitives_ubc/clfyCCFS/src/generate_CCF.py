@@ -1,5 +1,5 @@
+import time
 import numpy as np
-import multiprocessing as mp
 from collections import OrderedDict
 from sklearn.preprocessing import OneHotEncoder
 # CCFS functions
@@ -8,11 +8,17 @@ from .utils.commonUtils import is_numeric
 from .utils.ccfUtils import pcaLite
 from .utils.ccfUtils import randomRotation
 from .utils.ccfUtils import random_missing_vals
+from .utils.ccfUtils import getGenerator, treeGenerator
+from .utils.ccfUtils import trainingFingerprint
+from .utils.flatTreeUtils import flattenCCT, castTree
+from .utils.categoricalUtils import CategoricalMatrix
 from .predict_from_CCT import predictFromCCT
 from .training_utils.grow_CCT import growCCT
 from .training_utils.class_expansion import classExpansion
+from .training_utils.class_expansion import replicateClassExpansion
 from .training_utils.process_inputData import processInputData
 from .training_utils.rotation_forest_DP import rotationForestDataProcess
+from .training_utils.tree_executors import getTreeExecutor
 from .prediction_utils.replicate_input_process import replicateInputProcess
 # Logging
 import logging
@@ -53,26 +59,46 @@ def updateForD(optionsFor, D):
 
 
 #-------------------------------------------------------------------------------#
-def genTree(XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, pos):
+def genTree(XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, pos, rng=None, stopEvent=None):
     """
     A sub-function is used so that it can be shared between the for-loops and
     parallel processing. Does required preprocessing such as randomly setting 
-    missing values, then calls the tree training function.
+    missing values, then calls the tree training function.  All random
+    choices for the tree are drawn from rng, see ccfUtils.treeGenerator.
+    If stopEvent is set while the tree grows, growCCT raises a RuntimeError.
     """
+    rng = getGenerator(rng)
+
     if optionsFor["missingValuesMethod"] == 'random':
-        # Randomly set the missing values.  This will be different for each tree
-        XTrain = random_missing_vals(XTrain)
+        # Randomly set the missing values.  This will be different for each
+        # tree, so the values are filled in a copy rather than in the shared
+        # (and possibly read only) training data.
+        if isinstance(XTrain, CategoricalMatrix):
+            # Only the ordinal features can be missing
+            if np.any(np.isnan(XTrain.XOrd)):
+                XTrain = XTrain.replaceOrdinal(random_missing_vals(np.array(XTrain.XOrd), rng=rng))
+        elif np.any(np.isnan(XTrain)):
+            XTrain = random_missing_vals(np.array(XTrain), rng=rng)
+
+    if isinstance(XTrain, CategoricalMatrix) and (not (optionsFor["treeRotation"] == 'none')):
+        # Rotations mix all of the features so need the dense matrix
+        XTrain = XTrain.toarray()
 
     N = XTrain.shape[0]
 
-    # Bag if required
+    # Bag if required.  The bagged points are passed to growCCT as indices
+    # unless a rotation is applied, as that creates new data anyway.
+    iTrainRows = None
     if optionsFor["bBagTrees"] or (Ntrain != N):
         all_samples = np.arange(N)
-        iTrainThis  = np.random.choice(all_samples, Ntrain, replace=optionsFor["bBagTrees"])
+        iTrainThis  = rng.choice(all_samples, Ntrain, replace=optionsFor["bBagTrees"])
         iOob        = np.setdiff1d(all_samples, iTrainThis).T
         XTrainOrig  = XTrain
-        XTrain      = XTrain[iTrainThis, :]
-        YTrain      = YTrain[iTrainThis, :]
+        if optionsFor["treeRotation"] == 'none':
+            iTrainRows = iTrainThis
+        else:
+            XTrain = XTrain[iTrainThis, :]
+            YTrain = YTrain[iTrainThis, :]
 
     # Apply pre rotations if any requested.  Note that these all include a
     # subtracting a the mean prior to the projection (because this is a natural
@@ -81,33 +107,338 @@ def genTree(XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, pos):
         # This allows functionality to use the Rotation Forest algorithm as a
         # meta method for individual CCTs
         prop_classes_eliminate = optionsFor["RotForpClassLeaveOut"]
-        R, muX, XTrain = rotationForestDataProcess(XTrain, YTrain, optionsFor["RotForM"], optionsFor["RotForpS"], prop_classes_eliminate)
+        R, muX, XTrain = rotationForestDataProcess(XTrain, YTrain, optionsFor["RotForM"], optionsFor["RotForpS"], prop_classes_eliminate, rng=rng)
 
     elif optionsFor["treeRotation"] == 'random':
         muX = np.nanmean(XTrain, axis=0)
-        R   = randomRotation(N=XTrain.shape[1])
+        R   = randomRotation(N=XTrain.shape[1], rng=rng)
         XTrain = np.dot(np.subtract(XTrain, muX), R)
 
     elif optionsFor["treeRotation"] == 'pca':
         R, muX, XTrain = pcaLite(XTrain, False, False)
 
-    # Train the tree
-    tree = growCCT(XTrain, YTrain, optionsFor, iFeatureNum, 0)
-
-    # Calculate out of bag error if relevant
-    if optionsFor["bBagTrees"]:
-        tree["iOutOfBag"] = iOob
-        tree["predictsOutOfBag"], _ = predictFromCCT(tree, XTrainOrig[iOob, :])
+    # Train the tree and convert it to the flat format used for prediction
+    tree = growCCT(XTrain, YTrain, optionsFor, iFeatureNum, 0, iTrainRows=iTrainRows, rng=rng, stopEvent=stopEvent)
+    tree = flattenCCT(tree)
 
     # Store rotation deatils if necessary
     if not (optionsFor["treeRotation"] == 'none'):
         tree["rotDetails"] = {'R': R, 'muX': muX}
 
-    return (pos, tree)
+    # Store the tree in the precision of the training data
+    precision = np.dtype(optionsFor.get("precision", 'float64'))
+    if not (precision == np.float64):
+        tree = castTree(tree, precision)
+
+    # Out of bag predictions are returned alongside the tree rather than
+    # stored in it, so that they can be accumulated as the trees finish
+    oob = None
+    if optionsFor["bBagTrees"]:
+        if isinstance(XTrainOrig, CategoricalMatrix):
+            # Gather the out of bag points in chunks rather than forming all
+            # of their indicator columns at once
+            iChunks = np.array_split(iOob, max(1, (iOob.size * XTrainOrig.shape[1]) // 2**22))
+            predictsOutOfBag = np.concatenate([predictFromCCT(tree, XTrainOrig[iChunk, :])[0] for iChunk in iChunks], axis=0)
+        else:
+            predictsOutOfBag, _ = predictFromCCT(tree, XTrainOrig[iOob, :])
+        oob = (iOob, predictsOutOfBag)
+
+    return (pos, tree, oob)
+
+
+def accumulateOutOfBag(oobStats, oob):
+    """
+    Adds the out of bag predictions of a single tree to the running totals.
+
+    Parameters
+    ----------
+    oobStats: dict with fields cumOOb (N x K sum of the out of bag
+              predictions) and nOOb (N x 1 number of trees for which each
+              point was out of bag), updated in place
+    oob:      (iOob, predictsOutOfBag) as returned by genTree, or None if
+              bagging was not used
+    """
+    if oob is None:
+        return
+    iOob, predictsOutOfBag = oob
+    oobStats["cumOOb"][iOob, :] = oobStats["cumOOb"][iOob, :] + predictsOutOfBag
+    oobStats["nOOb"][iOob]      = oobStats["nOOb"][iOob] + 1
+
+
+#-------------------------------------------------------------------------------#
+def genTreeShared(context, task):
+    """
+    Grows a single tree from the training data and options in context, as
+    run by the executors of tree_executors.  Each task carries the forest's
+    seed, from which the tree's own random stream is derived, as forked
+    workers otherwise start from the same random state.
+    """
+    pos, seed = task
+
+    # growCCT modifies iFeatureNum and sets options such as mseTotal, so each
+    # tree gets its own copies rather than seeing those of earlier trees
+    return genTree(context["XTrain"], context["YTrain"], dict(context["optionsFor"]), np.copy(context["iFeatureNum"]),\
+                   context["Ntrain"], pos, rng=treeGenerator(seed, pos), stopEvent=context.get("stopEvent", None))
+
+
+def genTreesExecutor(executor, XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, nTrees, seed, nStart=0, oobStats=None, deadline=None, nMin=0):
+    """
+    Grows nTrees trees using executor (see tree_executors).  Out of bag
+    predictions are added to oobStats (see accumulateOutOfBag) as the trees
+    arrive, in the order of the trees so that the totals do not depend on
+    scheduling.  The trees are numbered from nStart and each is grown from
+    the random stream treeGenerator(seed, pos), so the result is the same
+    whichever executor is used.
+
+    If a deadline (as given by time.time()) is set, the trees finished by
+    then are returned and the outstanding ones cancelled, once at least nMin
+    trees have been collected.
+
+    Returns
+    -------
+    all_trees: List of (pos, tree) sorted by pos
+    """
+    tasks   = [(nStart+n_i, seed) for n_i in range(nTrees)]
+    # The process backend shares, and the remote backend sends, the data in C
+    # order, and the rotations and projections of a tree can differ in the
+    # last bits with the layout, so every backend is given that layout
+    if isinstance(XTrain, CategoricalMatrix):
+        XTrain = XTrain.replaceOrdinal(np.ascontiguousarray(XTrain.XOrd))
+    else:
+        XTrain = np.ascontiguousarray(XTrain)
+    YTrain = np.ascontiguousarray(YTrain)
+
+    context = {"XTrain": XTrain, "YTrain": YTrain, "optionsFor": optionsFor, "iFeatureNum": iFeatureNum, "Ntrain": Ntrain}
+
+    executor.start(genTreeShared, context, tasks)
+    try:
+        all_trees = []
+        pendingOob, nextPos = {}, nStart
+        while len(all_trees) < nTrees:
+            waitTime = None
+            if (deadline is not None) and (len(all_trees) >= nMin):
+                waitTime = max(0, deadline - time.time())
+            result = executor.next(timeout=waitTime)
+            if result is None:
+                break
+            pos, tree, oob = result
+            if oobStats is not None:
+                # Held back until all earlier trees have been added
+                pendingOob[pos] = oob
+                while nextPos in pendingOob:
+                    accumulateOutOfBag(oobStats, pendingOob.pop(nextPos))
+                    nextPos += 1
+            all_trees.append((pos, tree))
+
+            if len(all_trees)%25 == 0:
+                logger.info('Progress: {}/{}'.format(len(all_trees), nTrees))
+
+        if len(all_trees) < nTrees:
+            logger.info('Fit timeout reached, cancelling {} outstanding trees'.format(nTrees - len(all_trees)))
+            executor.stop(bCancel=True)
+            # Trees that did finish still count, whatever their order
+            for pos in sorted(pendingOob.keys()):
+                accumulateOutOfBag(oobStats, pendingOob[pos])
+        else:
+            executor.stop()
+    except:
+        executor.stop(bCancel=True)
+        raise
+
+    all_trees.sort(key=lambda x: x[0]) # Sort the results by pos
+
+    return all_trees
+
+
+#-------------------------------------------------------------------------------#
+def genTrees(XTrain, YTrain, optionsFor, iFeatureNum, nTrees, forest, oobStats, do_parallel=True, deadline=None, executor=None):
+    """
+    Grows nTrees trees on the processed training data and appends them to
+    forest, numbering them after any trees already present.
+
+    Parameters
+    ----------
+    XTrain, YTrain: Processed training data as used by genTree
+    optionsFor:  Options dict
+    iFeatureNum: Grouping of the features
+    nTrees:      Number of trees to grow
+    forest:      OrderedDict of trees, updated in place
+    oobStats:    Running out of bag totals, see accumulateOutOfBag
+    do_parallel: Grow the trees using a pool of worker processes, if no
+                 executor is given.  Each tree is grown from its own random
+                 stream derived from optionsFor["randomSeed"] and its
+                 position in the forest (see ccfUtils.treeGenerator), so the
+                 forest is the same whether or not this is used.  If no seed
+                 is set, one is drawn from the global numpy random state.
+    deadline:    Optional time, as given by time.time(), after which no
+                 more trees are started and the outstanding trees are
+                 cancelled.  The trees finished by then are kept, so fewer
+                 than nTrees may be added, but at least one tree is always
+                 grown for an empty forest.
+    executor:    Optional executor used to grow the trees, see
+                 tree_executors.getTreeExecutor
+
+    Returns
+    -------
+    forest: The updated forest
+    """
+    # Trees are numbered by the position they were started in, so after a
+    # timeout the numbers may have gaps and new trees follow the largest
+    nStart = (max(forest.keys()) + 1) if forest else 0
+    nMin   = 0 if forest else 1
+    nOld   = len(forest)
+    Ntrain = int(XTrain.shape[0] * optionsFor["propTrain"])
+    seed   = optionsFor.get("randomSeed", None)
+    if seed is None:
+        seed = np.random.randint(0, 2**31 - 1)
+    if executor is None:
+        executor = getTreeExecutor('process' if do_parallel else 'serial')
+
+    all_trees = genTreesExecutor(executor, XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, nTrees, seed, nStart=nStart, oobStats=oobStats,\
+                                 deadline=deadline, nMin=nMin)
+
+    # Collect
+    for pos, tree in all_trees:
+        forest[pos] = tree
+
+    logger.info('Progress: {}/{}'.format(len(forest) - nOld, nTrees))
+    logger.info('Completed!')
+    logger.info('.............................................................')
+
+    return forest
+
+
+def genTreesAdaptive(XTrain, YTrain, optionsFor, iFeatureNum, nTrees, forest, oobStats, do_parallel=True, deadline=None, executor=None):
+    """
+    Grows up to nTrees trees in waves of optionsFor["treeWaveSize"] trees
+    (see genTrees), stopping early once the forest has converged, i.e. once
+    a convergence score has changed by less than optionsFor["treeWaveTolerance"]
+    for optionsFor["treeWavePatience"] consecutive waves.
+
+    If bagging is used the score is the out of bag error, and a wave counts
+    towards convergence if it improves the error by less than the tolerance.
+    Otherwise the score is the mean absolute change, caused by the wave, of
+    the averaged predictions (class probabilities) for a fixed sample of up
+    to 1000 training points.
+
+    Returns
+    -------
+    forest: The updated forest
+    waves:  dict with fields nTrees (number of trees after each wave),
+            scores (score after each wave) and bConverged (whether growth
+            stopped because the forest converged)
+    """
+    waveSize = max(1, int(optionsFor["treeWaveSize"]))
+    tol      = optionsFor.get("treeWaveTolerance", 1e-3)
+    patience = max(1, int(optionsFor.get("treeWavePatience", 3)))
+
+    if not optionsFor["bBagTrees"]:
+        # Evenly spaced sample of the training points whose averaged
+        # predictions are tracked
+        iSample   = np.unique(np.linspace(0, XTrain.shape[0] - 1, min(XTrain.shape[0], 1000)).astype(int))
+        XSample   = XTrain[iSample, :]
+        cumSample = None
+        prevPreds = None
+
+    waves = {"nTrees": [], "scores": [], "bConverged": False}
+    nGrown, nStalled, prevScore = 0, 0, None
+    while nGrown < nTrees:
+        nWave    = min(waveSize, nTrees - nGrown)
+        keysOld  = set(forest.keys())
+        forest   = genTrees(XTrain, YTrain, optionsFor, iFeatureNum, nWave, forest, oobStats, do_parallel=do_parallel, deadline=deadline, executor=executor)
+        newKeys  = [key for key in forest.keys() if key not in keysOld]
+        nGrown  += len(newKeys)
+
+        if optionsFor["bBagTrees"]:
+            score  = float(np.nanmean(outOfBagError(oobStats, YTrain, optionsFor)))
+            change = np.inf if (prevScore is None) else (prevScore - score)
+            prevScore = score
+        else:
+            for key in newKeys:
+                treePreds = predictFromCCT(forest[key], XSample)[0]
+                cumSample = treePreds if (cumSample is None) else (cumSample + treePreds)
+            preds  = cumSample / len(forest)
+            score  = np.inf if (prevPreds is None) else float(np.mean(np.absolute(preds - prevPreds)))
+            change = score
+            prevPreds = preds
+
+        waves["nTrees"].append(len(forest))
+        waves["scores"].append(score)
+        logger.info('Trees: {}, convergence score: {}'.format(len(forest), score))
+
+        if len(newKeys) < nWave:
+            # Stopped by the deadline
+            break
+
+        nStalled = (nStalled + 1) if (change < tol) else 0
+        if nStalled >= patience:
+            waves["bConverged"] = True
+            logger.info('Forest converged after {} trees'.format(len(forest)))
+            break
+
+    return forest, waves
+
+
+def setOutOfBagOutputs(CCF, oobStats, YTrain, bOutOfBagPreds=False):
+    """
+    Sets the out of bag error, and optionally the averaged out of bag
+    predictions, of CCF from the out of bag totals oobStats.
+    """
+    CCF["outOfBagError"] = outOfBagError(oobStats, YTrain, CCF["options"])
+    if bOutOfBagPreds:
+        CCF["outOfBagPreds"]  = np.divide(oobStats["cumOOb"], oobStats["nOOb"])
+        CCF["outOfBagCounts"] = oobStats["nOOb"]
 
 
 #-------------------------------------------------------------------------------#
-def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=None, bKeepTrees=True, iFeatureNum=None, bOrdinal=None):
+def outOfBagError(oobStats, YTrain, optionsFor):
+    """
+    Calculates the out of bag error from the accumulated out of bag
+    predictions.
+
+    Parameters
+    ----------
+    oobStats: dict of running totals, see accumulateOutOfBag
+    YTrain:   Processed training outputs as used to grow the trees
+    optionsFor: Options dict
+
+    Returns
+    -------
+    outOfBagError: Out of bag error for each output, or None if not
+                   defined for the given outputs
+    """
+    outOfBagError = None
+    oobPreds = np.divide(oobStats["cumOOb"], oobStats["nOOb"])
+    if optionsFor["bSepPred"]:
+        outOfBagError = (1 - np.nanmean((oobPreds > 0.5) == YTrain, axis=0))
+    else:
+        # Check if task_ids is single number
+        if type(optionsFor["task_ids"]) == int:
+            task_ids_size = 1
+            forPreds = np.empty((YTrain.shape[0], 1))
+            forPreds.fill(np.nan)
+            YTrainCollapsed = np.empty((YTrain.shape[0], 1))
+            YTrainCollapsed.fill(np.nan)
+            forPreds[:, -1]        = np.argmax(oobPreds[:, optionsFor["task_ids"][-1]:], axis=1)
+            YTrainCollapsed[:, -1] = np.argmax(  YTrain[:, optionsFor["task_ids"][-1]:], axis=1)
+            outOfBagError = (1 - np.nanmean(forPreds==YTrainCollapsed, axis=0))
+        else:
+            forPreds = np.empty((YTrain.shape[0], optionsFor["task_ids"].size))
+            forPreds.fill(np.nan)
+            YTrainCollapsed = np.empty((YTrain.shape[0], optionsFor["task_ids"].size))
+            YTrainCollapsed.fill(np.nan)
+            for nO in range(optionsFor["task_ids"].size - 1):
+                forPreds[:, nO]        = np.argmax(oobPreds[:, optionsFor["task_ids"][nO]:optionsFor["task_ids"][nO+1]-1], axis=1)
+                YTrainCollapsed[:, nO] = np.argmax(  YTrain[:, optionsFor["task_ids"][nO]:optionsFor["task_ids"][nO+1]-1], axis=1)
+            forPreds[:, -1]        = np.argmax(oobPreds[:, optionsFor["task_ids"][-1]:], axis=1)
+            YTrainCollapsed[:, -1] = np.argmax(  YTrain[:, optionsFor["task_ids"][-1]:], axis=1)
+            outOfBagError = (1 - np.nanmean(forPreds==YTrainCollapsed, axis=0))
+
+    return outOfBagError
+
+
+#-------------------------------------------------------------------------------#
+def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=None, bKeepTrees=True, iFeatureNum=None, bOrdinal=None, bOutOfBagPreds=False, timeout=None, executor=None):
     """
     Creates a canonical correlation forest (CCF) comprising of nTrees
     canonical correlation trees (CCT) containing splits based on the a CCA
@@ -169,12 +500,28 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
              If the data is to be processed, this allows
              specification of ordinal variables.  For default
              behaviour see processInputData.m
+     bOutOfBagPreds: Boolean
+             If true and bagging is used, the averaged out of bag
+             predictions and the number of trees each training point
+             was out of bag for are also returned.  Default = false
+     timeout: float
+             Optional time limit in seconds.  Trees are kept in the
+             order they finish, and once the limit is reached the
+             outstanding trees are cancelled and the forest is returned
+             with the trees finished so far (at least one), which may
+             be fewer than nTrees.  Default = None, i.e. no limit
+     executor:
+             Executor used to grow the trees, as created by
+             tree_executors.getTreeExecutor, e.g. to use threads or
+             workers on other hosts.  Default = None, i.e. a pool of
+             processes if do_parallel and otherwise a serial loop
 
     Returns
     -------
      CCF:  dict
            Structure with following fields
-           - Trees = Cell array of CCTs
+           - Trees = Dict of CCTs, each stored in the flat format
+                     described in flatTreeUtils.flattenCCT
            - options = The used options structure (after
                        processing for things like task_ids based on the data)
            - inputProcessDetails = Details required to replicate
@@ -182,9 +529,25 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
                        z-scores) done during training
            - outOfBagError = If bagging was used, gives the
                        average out of bag error.  Otherwise empty.
+           - outOfBagPreds, outOfBagCounts = Only if bOutOfBagPreds,
+                       the averaged out of bag predictions (NaN for
+                       points never out of bag) and the count of trees
+                       contributing to each
+           - oobStats = Only if optionsFor["bKeepOobStats"] is set and
+                       bagging is used, the running totals of the out of
+                       bag predictions that extendCCF needs to add trees
+           - treeWaves = Only if optionsFor["treeWaveSize"] is set,
+                       the number of trees and convergence score after
+                       each wave of trees and whether growth stopped
+                       early, see genTreesAdaptive
+           - trainingFingerprint = Shapes and hash of XTrain and YTrain,
+                       see ccfUtils.trainingFingerprint
            - timing_stats = see bCalcTimingStats option in optionsClassCCF.m
     """
+    deadline = None if (timeout is None) else (time.time() + timeout)
+    fingerprint = trainingFingerprint(XTrain, YTrain)
     bNaNtoMean = (optionsFor['missingValuesMethod'] == 'mean')
+    bExpandCategoricals = (optionsFor.get('categoricalEncoding', 'onehot') == 'onehot')
 
     if iFeatureNum == None:
         iFeatureNum=np.array([]) # Create empty array
@@ -196,9 +559,9 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
         if (not (iFeatureNum.size == 0)):
             logger.warning('iFeatureNum provided but XTrain not in array format, over-riding')
         if (XTest == None):
-            XTrain, iFeatureNum, inputProcessDetails, _  = processInputData(XTrainRC=XTrain, bOrdinal=bOrdinal, XTestRC=None, bNaNtoMean=bNaNtoMean)
+            XTrain, iFeatureNum, inputProcessDetails, _  = processInputData(XTrainRC=XTrain, bOrdinal=bOrdinal, XTestRC=None, bNaNtoMean=bNaNtoMean, bExpandCategoricals=bExpandCategoricals)
         else:
-            XTrain, iFeatureNum, inputProcessDetails, XTest, _ = processInputData(XTrainRC=XTrain, bOrdinal=bOrdinal, XTest=XTest, bNaNtoMean=bNaNtoMean)
+            XTrain, iFeatureNum, inputProcessDetails, XTest, _ = processInputData(XTrainRC=XTrain, bOrdinal=bOrdinal, XTest=XTest, bNaNtoMean=bNaNtoMean, bExpandCategoricals=bExpandCategoricals)
 
     else:
         # Process inputs, e.g. converting categoricals and converting to z-scores
@@ -211,6 +574,9 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
         if (not (XTest.size == 0)):
              XTest = replicateInputProcess(XTest, inputProcessDetails)
     
+    # Hold the processed inputs in the requested precision, see genTree
+    XTrain = XTrain.astype(optionsFor.get('precision', 'float64'), copy=False)
+
     N = XTrain.shape[0]
     # Note that setting of number of features to subsample is based only
     # number of features before expansion of categoricals.
@@ -241,35 +607,18 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
         logger.warning('Selected not to keep trees but only requested a single output of the trees, reseting bKeepTrees to true')
 
     forest = OrderedDict()
-    Ntrain = int(N * optionsFor["propTrain"])
-    # Train the trees
-    if do_parallel:
-        pool = mp.Pool(processes=mp.cpu_count())
-        processes = [pool.apply_async(genTree, args=(XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, n_i)) for n_i in range(nTrees)]
-
-        # Get process results
-        all_trees = [p.get() for p in processes]
-        all_trees.sort() # Sort the results by pos
-
-        # Collect
-        for nT in range(nTrees):
-            if bKeepTrees:
-                forest[nT] = all_trees[nT][1]
-    else:
-        for nT in range(nTrees):
-            # Generate tree
-            tree_out = genTree(XTrain, YTrain, optionsFor, iFeatureNum, Ntrain, pos=nT)
+    # Running totals of the out of bag predictions, see accumulateOutOfBag
+    oobStats = {"cumOOb": np.zeros((N, YTrain.shape[1])), "nOOb": np.zeros((N, 1))}
 
-            if bKeepTrees:
-                forest[nT] = tree_out[1]
+    # growCCT can modify iFeatureNum, so keep the original for adding trees
+    iFeatureNumOrig = np.copy(iFeatureNum)
 
-            if nT%25 == 0:
-                # print('Progress: {}/{}'.format(nT, nTrees))
-                logger.info('Progress: {}/{}'.format(nT, nTrees))
-
-    logger.info('Progress: {}/{}'.format(nT, nTrees))
-    logger.info('Completed!')
-    logger.info('.............................................................')
+    # Train the trees, in waves until converged if requested
+    waves = None
+    if optionsFor.get("treeWaveSize", 0) > 0:
+        forest, waves = genTreesAdaptive(XTrain, YTrain, optionsFor, iFeatureNum, nTrees, forest, oobStats, do_parallel=do_parallel, deadline=deadline, executor=executor)
+    else:
+        forest = genTrees(XTrain, YTrain, optionsFor, iFeatureNum, nTrees, forest, oobStats, do_parallel=do_parallel, deadline=deadline, executor=executor)
 
     # Setup outputs
     CCF = {}
@@ -277,41 +626,71 @@ def genCCF(XTrain, YTrain, nTrees=500, optionsFor={}, do_parallel=True, XTest=No
     CCF["options"] = optionsFor
     CCF["inputProcessDetails"] = inputProcessDetails
     CCF["classNames"] = optionsFor["classNames"]
+    CCF["iFeatureNum"] = iFeatureNumOrig
+    CCF["trainingFingerprint"] = fingerprint
+    if waves is not None:
+        CCF["treeWaves"] = waves
 
-    if optionsFor["bBagTrees"] and bKeepTrees:
-        # Calculate the out of back error if relevant
-        cumOOb = np.zeros((YTrain.shape[0], (CCF["Trees"][0]["predictsOutOfBag"]).shape[1]))
-        nOOb   = np.zeros((YTrain.shape[0], 1))
-        for nTO in range(len(CCF["Trees"])):
-            cumOOb[CCF["Trees"][nTO]["iOutOfBag"], :] = cumOOb[CCF["Trees"][nTO]["iOutOfBag"], :] + CCF["Trees"][nTO]["predictsOutOfBag"]
-            nOOb[CCF["Trees"][nTO]["iOutOfBag"]] = nOOb[CCF["Trees"][nTO]["iOutOfBag"]] + 1
-        oobPreds = np.divide(cumOOb, nOOb)
-        if optionsFor["bSepPred"]:
-            CCF["outOfBagError"] = (1 - np.nanmean((oobPreds > 0.5) == YTrain, axis=0))
-        else:
-            # Check if task_ids is single number
-            if type(optionsFor["task_ids"]) == int:
-                task_ids_size = 1
-                forPreds = np.empty((XTrain.shape[0], 1))
-                forPreds.fill(np.nan)
-                YTrainCollapsed = np.empty((XTrain.shape[0], 1))
-                YTrainCollapsed.fill(np.nan)
-                forPreds[:, -1]        = np.argmax(oobPreds[:, optionsFor["task_ids"][-1]:], axis=1)
-                YTrainCollapsed[:, -1] = np.argmax(  YTrain[:, optionsFor["task_ids"][-1]:], axis=1)
-                CCF["outOfBagError"]   = (1 - np.nanmean(forPreds==YTrainCollapsed, axis=0))
-            else:
-                forPreds = np.empty((XTrain.shape[0], optionsFor["task_ids"].size))
-                forPreds.fill(np.nan)
-                YTrainCollapsed = np.empty((XTrain.shape[0], optionsFor["task_ids"].size))
-                YTrainCollapsed.fill(np.nan)
-                for nO in range(optionsFor["task_ids"].size - 1):
-                    forPreds[:, nO]        = np.argmax(oobPreds[:, optionsFor["task_ids"][nO]:optionsFor["task_ids"][nO+1]-1], axis=1)
-                    YTrainCollapsed[:, nO] = np.argmax(  YTrain[:, optionsFor["task_ids"][nO]:optionsFor["task_ids"][nO+1]-1], axis=1)
-                forPreds[:, -1]        = np.argmax(oobPreds[:, optionsFor["task_ids"][-1]:], axis=1)
-                YTrainCollapsed[:, -1] = np.argmax(  YTrain[:, optionsFor["task_ids"][-1]:], axis=1)
-                CCF["outOfBagError"]   = (1 - np.nanmean(forPreds==YTrainCollapsed, axis=0))
+    if optionsFor["bBagTrees"]:
+        # The out of bag totals are only needed to add trees later
+        if optionsFor.get("bKeepOobStats", False):
+            CCF["oobStats"] = oobStats
+        setOutOfBagOutputs(CCF, oobStats, YTrain, bOutOfBagPreds)
     else:
-        CCF["outOfBagError"] = 'OOB error only returned if bagging used and trees kept.\
+        CCF["outOfBagError"] = 'OOB error only returned if bagging used.\
                                 Please use CCF-Bag instead via options=optionsClassCCF.defaultOptionsCCFBag!'
 
     return CCF
+
+
+#-------------------------------------------------------------------------------#
+def extendCCF(CCF, XTrain, YTrain, nTrees, do_parallel=True, timeout=None, executor=None):
+    """
+    Warm start, adds nTrees new trees to an existing CCF.  The training
+    data is processed using the inputProcessDetails and options stored in
+    the forest, so the new trees are grown on the same representation as
+    the existing ones, and the out of bag statistics are updated in place
+    rather than recalculated.
+
+    Parameters
+    ----------
+    CCF:    Forest as returned by genCCF, updated in place
+    XTrain: Training inputs in the same format as originally given to genCCF
+    YTrain: Training outputs in the same format as originally given to genCCF
+    nTrees: Number of trees to add
+    do_parallel: Grow the new trees using a pool of worker processes
+    timeout: Optional time limit in seconds, after which only the new trees
+             finished so far are added, see genCCF
+    executor: Optional executor used to grow the new trees, see genCCF
+
+    Returns
+    -------
+    CCF: The forest with the new trees appended to CCF["Trees"]
+    """
+    deadline = None if (timeout is None) else (time.time() + timeout)
+    assert ("iFeatureNum" in CCF), 'Forest does not store the details needed to add trees, retrain using genCCF!'
+    if "trainingFingerprint" in CCF:
+        assert (CCF["trainingFingerprint"] == trainingFingerprint(XTrain, YTrain)), 'Trees can only be added using the original training data!'
+    optionsFor = CCF["options"]
+
+    XTrain = replicateInputProcess(XTrain, CCF["inputProcessDetails"], bExpandCategoricals=(optionsFor.get('categoricalEncoding', 'onehot') == 'onehot'))
+    XTrain = XTrain.astype(optionsFor.get('precision', 'float64'), copy=False)
+    YTrain = replicateClassExpansion(YTrain, CCF["classNames"], optionsFor)
+
+    if optionsFor["bBagTrees"]:
+        assert ("oobStats" in CCF), 'Forest does not store its out of bag statistics, so trees cannot be added!  Set optionsFor["bKeepOobStats"] when training with genCCF, and do not compress the forest.'
+        assert (CCF["oobStats"]["nOOb"].shape[0] == XTrain.shape[0]), 'Out of bag statistics can only be updated using the original training data!'
+        # Copied as the totals of a loaded forest may be read only
+        oobStats = {key: np.array(value) for key, value in CCF["oobStats"].items()}
+        CCF["oobStats"] = oobStats
+    else:
+        oobStats = {"cumOOb": np.zeros((XTrain.shape[0], YTrain.shape[1])), "nOOb": np.zeros((XTrain.shape[0], 1))}
+
+    CCF["Trees"] = genTrees(XTrain, YTrain, optionsFor, np.copy(CCF["iFeatureNum"]), nTrees, CCF["Trees"], oobStats, do_parallel=do_parallel, deadline=deadline, executor=executor)
+    # Any stacked copy of the trees is now out of date
+    CCF.pop("stackedTrees", None)
+
+    if optionsFor["bBagTrees"]:
+        setOutOfBagOutputs(CCF, oobStats, YTrain, ("outOfBagPreds" in CCF))
+
+    return CCF
@@ -1,11 +1,14 @@
 import os
+import time
 import numpy as np
+import pandas as pd
 
-from .predict_from_CCT import predictFromCCT
+from .utils.flatTreeUtils import stackTrees
+from .prediction_utils.traverse_forestPredict import traverse_forest_predict_missing
 from .prediction_utils.replicate_input_process import replicateInputProcess
-from .prediction_utils.tree_output_forest_pred import treeOutputsToForestPredicts
+from .prediction_utils.tree_output_forest_pred import forestProbsToForestPredicts
 
-def predictFromCCF(CCF, X):
+def predictFromCCF(CCF, X, bTreeOutputs=False, chunkSize=None):
     """
     Parameters
     ----------
@@ -13,6 +16,11 @@ def predictFromCCF(CCF, X):
         Trees, giving a cell array of tree structures, and
         options which is an object of type optionsClassCCF
     X:  Input features at which to make predictions, each row should be a seperate data point
+    bTreeOutputs: If true, the individual tree outputs are also returned.  These
+                  take N x L x K memory so are not kept by default.
+    chunkSize: Number of rows of X processed at a time.  By default this is
+               chosen so that the tree outputs of a chunk have at most 2**24
+               elements.
 
     Returns
     -------
@@ -35,19 +43,172 @@ def predictFromCCF(CCF, X):
                  trees and K is the number of predictions.  K=1 for
                  regression, K = number of classes for classification, and
                  for regression then each output is concatenated in the third dimension.
+                 None unless bTreeOutputs is true.
     """
-    X = replicateInputProcess(X, CCF["inputProcessDetails"])
+    # All trees are evaluated together, one chunk of rows at a time.  Forests
+    # loaded by loadCCF are already stacked.
+    stackedTrees = CCF.get("stackedTrees", None)
+    if stackedTrees is None:
+        stackedTrees = stackTrees(CCF["Trees"])
+    nTrees = stackedTrees["nTrees"]
+    K      = stackedTrees["mean"].shape[1]
+    N      = X.shape[0]
+    if chunkSize is None:
+        chunkSize = max(1, (2**24) // (nTrees * K))
 
-    nTrees = len(CCF["Trees"])
+    forestMean = np.empty((N, K))
+    if bTreeOutputs:
+        treeOutputs = np.empty((N, nTrees, K), dtype=stackedTrees["mean"].dtype)
+    else:
+        treeOutputs = None
 
-    # Preallocate output space
-    pcctx0, _ = predictFromCCT(CCF["Trees"][0], X)
-    pcctx0    = np.expand_dims(pcctx0, axis=1)
-    treeOutputs = np.tile(pcctx0, [1, nTrees, 1])
+    for iStart in range(0, N, chunkSize):
+        iChunk = slice(iStart, min(iStart+chunkSize, N))
+        if isinstance(X, pd.DataFrame):
+            XChunk = X.iloc[iChunk, :]
+        else:
+            XChunk = X[iChunk, :]
 
-    for n in range(1, nTrees):
-        treeOutputs[:, n, :], _ = predictFromCCT(CCF["Trees"][n], X)
+        XChunk = replicateInputProcess(XChunk, CCF["inputProcessDetails"])
+        # Evaluated in the precision that the forest is stored in
+        XChunk = XChunk.astype(stackedTrees["decisionProjection"].dtype, copy=False)
 
-    forestPredicts, forestProbs = treeOutputsToForestPredicts(CCF, treeOutputs)
+        # Any values left as NaN are randomly assigned, separately by each
+        # tree
+        chunkOutputs, _ = traverse_forest_predict_missing(stackedTrees, XChunk)
+        forestMean[iChunk, :] = np.mean(chunkOutputs, axis=1)
+        if bTreeOutputs:
+            treeOutputs[iChunk, :, :] = chunkOutputs
+
+    forestPredicts, forestProbs = forestProbsToForestPredicts(CCF, np.squeeze(forestMean))
 
     return forestPredicts, forestProbs, treeOutputs
+
+
+def predictFromCCFEarlyExit(CCF, X, batchSize=None, timeBudget=None, chunkSize=None):
+    """
+    As predictFromCCF, but the trees are evaluated in batches and a row
+    stops being passed to further trees once its predicted class can no
+    longer change.  As each tree gives every class a probability between 0
+    and 1, this is the case when, for every task, the leading class is
+    ahead of the runner up by more than the number of trees still to be
+    evaluated (or for separate predictions, when the number of remaining
+    trees cannot move the mean across 0.5).  The predicted classes are thus
+    the same as those of predictFromCCF, unless the time budget runs out.
+
+    Parameters
+    ----------
+    CCF: Output from genCCF
+    X:   Input features at which to make predictions, each row should be a seperate data point
+    batchSize: Number of trees evaluated at a time, defaults to a tenth of
+               the trees.  Smaller batches allow rows to exit sooner at the
+               cost of more passes over the remaining rows.
+    timeBudget: Optional time in seconds after which no further batches are
+                started.  Every row is still passed through the first batch
+                and the remaining rows are predicted from the trees they
+                have been passed through, so their predictions may then
+                differ from those of the full forest.
+    chunkSize: Number of rows of X processed at a time, defaults as for
+               predictFromCCF
+
+    Returns
+    -------
+    forestPredicts: As for predictFromCCF
+    forestProbs: Class probabilities averaged over the trees used for each
+                 row, so for rows that exited early these can differ from
+                 those of predictFromCCF
+    nTreesUsed: (N,) array of the number of trees used for each row
+    """
+    startTime = time.time()
+    trees  = list(CCF["Trees"].values())
+    nTrees = len(trees)
+    if batchSize is None:
+        batchSize = max(1, nTrees // 10)
+    batches = [stackTrees(trees[iStart:iStart+batchSize]) for iStart in range(0, nTrees, batchSize)]
+    K = batches[0]["mean"].shape[1]
+    N = X.shape[0]
+    if chunkSize is None:
+        chunkSize = max(1, (2**24) // (nTrees * K))
+
+    taskSlices = predictionTaskSlices(CCF["options"], K)
+
+    forestMean = np.empty((N, K))
+    nTreesUsed = np.zeros((N,), dtype=np.int32)
+    bTimeUp    = False
+    for iStart in range(0, N, chunkSize):
+        iChunk = slice(iStart, min(iStart+chunkSize, N))
+        if isinstance(X, pd.DataFrame):
+            XChunk = X.iloc[iChunk, :]
+        else:
+            XChunk = X[iChunk, :]
+
+        XChunk = replicateInputProcess(XChunk, CCF["inputProcessDetails"])
+        XChunk = XChunk.astype(batches[0]["decisionProjection"].dtype, copy=False)
+
+        # Summed tree outputs of each row of the chunk and the rows still to
+        # be decided
+        sumOutputs = np.zeros((XChunk.shape[0], K))
+        nUsed      = np.zeros((XChunk.shape[0],), dtype=np.int32)
+        iActive    = np.arange(XChunk.shape[0])
+        nDone      = 0
+        for stackedTrees in batches:
+            if (iActive.size == 0) or (bTimeUp and (nDone > 0)):
+                break
+
+            batchOutputs, _ = traverse_forest_predict_missing(stackedTrees, XChunk[iActive, :])
+            sumOutputs[iActive, :] += np.sum(batchOutputs, axis=1)
+            nDone += stackedTrees["nTrees"]
+            nUsed[iActive] = nDone
+
+            bDecided = rowsDecided(CCF["options"], taskSlices, sumOutputs[iActive, :], nTrees, nTrees - nDone)
+            iActive  = iActive[~bDecided]
+
+            if (timeBudget is not None) and (time.time() - startTime >= timeBudget):
+                bTimeUp = True
+
+        forestMean[iChunk, :] = sumOutputs / nUsed[:, np.newaxis]
+        nTreesUsed[iChunk]    = nUsed
+
+    forestPredicts, forestProbs = forestProbsToForestPredicts(CCF, np.squeeze(forestMean))
+
+    return forestPredicts, forestProbs, nTreesUsed
+
+
+def predictionTaskSlices(optionsFor, K):
+    """
+    Columns of the tree outputs over which forestProbsToForestPredicts takes
+    the most probable class, one slice per task.
+    """
+    task_ids = optionsFor["task_ids"]
+    if isinstance(task_ids, int) or (np.size(task_ids) == 1):
+        return [slice(0, K)]
+
+    task_ids = np.asarray(task_ids).ravel()
+    taskSlices = [slice(task_ids[nO], task_ids[nO+1]-1) for nO in range(task_ids.size-1)]
+    taskSlices.append(slice(task_ids[-1], K))
+
+    return taskSlices
+
+
+def rowsDecided(optionsFor, taskSlices, sumOutputs, nTrees, nRemaining):
+    """
+    Boolean array which is True for the rows whose predicted classes cannot
+    be changed by the nRemaining trees still to be evaluated, given the
+    tree outputs summed over the trees evaluated so far.
+    """
+    if optionsFor["bSepPred"]:
+        # The final mean is above 0.5 whatever the remaining trees give, or
+        # cannot get above it
+        return np.all((sumOutputs > 0.5 * nTrees) | (sumOutputs + nRemaining <= 0.5 * nTrees), axis=1)
+
+    bDecided = np.ones((sumOutputs.shape[0],), dtype=bool)
+    for taskSlice in taskSlices:
+        sumTask = sumOutputs[:, taskSlice]
+        if sumTask.shape[1] < 2:
+            continue
+        # The remaining trees can at most give the runner up 1 and the
+        # leading class 0 each
+        topTwo   = -np.partition(-sumTask, 1, axis=1)[:, 0:2]
+        bDecided = bDecided & ((topTwo[:, 0] - topTwo[:, 1]) > nRemaining)
+
+    return bDecided
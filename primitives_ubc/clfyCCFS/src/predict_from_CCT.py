@@ -9,7 +9,7 @@ def predictFromCCT(tree, X):
 
     Parameters
     ----------
-    tree: output strcut from growTree
+    tree: output strcut from growTree, either flat or nested
     X: processed input features
 
     Returns
@@ -17,7 +17,8 @@ def predictFromCCT(tree, X):
     leaf_mean:  Mean of outputs present at the leaf.
                 For classification then this represents the class
                 probability, for regression it is simply the output mean.
-    leaf_node:  The full leaf node details for the assigned point.
+    leaf_node:  Index of the assigned leaf node in the flat tree, the
+                details of the node can be read from the tree arrays.
     """
     if 'inputProcessDetails' in tree.keys():
         X = replicateInputProcess(X, tree["inputProcessDetails"])
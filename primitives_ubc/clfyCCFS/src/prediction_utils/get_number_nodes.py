@@ -1,7 +1,10 @@
 # Calculates number of nodes in a tree
+from primitives_ubc.clfyCCFS.src.utils.flatTreeUtils import isFlatTree
 
 def get_number_of_nodes(tree):
-    if tree["bLeaf"]:
+    if isFlatTree(tree):
+        n_nodes = tree["bLeaf"].size
+    elif tree["bLeaf"]:
         n_nodes = 1
     else:
         n_nodes_left  = get_number_of_nodes(tree["lessthanChild"])
@@ -1,8 +1,9 @@
-from primitives_ubc.clfyCCFS.src.predict_from_cct import predictFromCCT
+import numpy as np
+from primitives_ubc.clfyCCFS.src.predict_from_CCT import predictFromCCT
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import random_missing_vals
 
 
-def randperm_preds(tree, X, bOutOfBag=None):
+def randperm_preds(tree, X, bOutOfBag=None, iOutOfBag=None):
     """
     Calculates D sets of predictions for a tree, each with column d of X
     randomly permuted. Currently only used by feature_importance function.
@@ -13,6 +14,9 @@ def randperm_preds(tree, X, bOutOfBag=None):
     X         = Samples to test
     bOutOfBag = Use only the out of bag indices, requires CCF-Bag to
                 have been used in the first place.
+    iOutOfBag = Out of bag indices of the tree.  These are no longer
+                stored in the tree, see generate_CCF.genTree, so must be
+                given if bOutOfBag.
 
     Returns
     -------
@@ -23,7 +27,10 @@ def randperm_preds(tree, X, bOutOfBag=None):
         bOutOfBag = True
 
     if bOutOfBag:
-        X = X[tree["iOutOfBag"], :]
+        if iOutOfBag is None:
+            iOutOfBag = tree.get("iOutOfBag")
+        assert (iOutOfBag is not None), 'Out of bag indices are required when bOutOfBag is true!'
+        X = X[iOutOfBag, :]
 
     # Any values left as NaN now need to be randomly assigned
     X = random_missing_vals(X)
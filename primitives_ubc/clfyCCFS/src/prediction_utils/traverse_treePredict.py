@@ -1,6 +1,7 @@
 import numpy as np
-import numpy.matlib as npmat
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import random_feature_expansion
+from primitives_ubc.clfyCCFS.src.utils.flatTreeUtils import isFlatTree
+from primitives_ubc.clfyCCFS.src.utils.flatTreeUtils import flattenCCT
 
 #-----------------------------------------------------------------------------#
 def makeExpansionFunc(wZ, bZ, bIncOrig):
@@ -12,62 +13,68 @@ def makeExpansionFunc(wZ, bZ, bIncOrig):
     return f
 
 #-----------------------------------------------------------------------------#
-def traverse_tree_predict(tree, X):
+def nodeProjection(tree, node, X):
     """
-    Traverses the tree to get a prediction.  Splits X to left and right child
-    then recursively calls self using each partition and the corresponding
-    left and right sub tree.  This continues until called on a leaf, where it
-    returns the mean of the leaf and, if requested, the full details of the
-    corresponding leaf node.  These are then returned as array with the same
-    number of rows as X.
+    Projects the rows of X onto the decision projection of an internal node
+    of a flat tree.
     """
-    if tree["bLeaf"]:
-        leaf_mean = np.multiply(tree["mean"], np.ones((X.shape[0], 1)))
-        leaf_node = npmat.repmat(tree, X.shape[0], 1)
+    if node in tree["featureExpansion"]:
+        wZ, bZ, rccaIncludeOriginal, decisionProjection = tree["featureExpansion"][node]
+        nIn   = wZ.shape[0]
+        fExp  = makeExpansionFunc(wZ, bZ, rccaIncludeOriginal)
+        XTest = fExp(X[:, tree["iIn"][node, 0:nIn]])
+        return np.dot(XTest, decisionProjection)
 
-    else:
-        if ('rotDetails' in tree.keys()):
-            if not (len(tree["rotDetails"]) == 0):
-                X = np.dot(np.subtract(X, tree["rotDetails"]["muX"]), tree["rotDetails"]["R"])
+    return np.dot(X[:, tree["iIn"][node, :]], tree["decisionProjection"][node, :])
+
+#-----------------------------------------------------------------------------#
+def batchProjection(tree, nodes, X, iRows):
+    """
+    Projects each row X[iRows[i], :] onto the decision projection of node
+    nodes[i] using a single gather of the padded feature indices.  Nodes
+    using random feature expansion are evaluated separately per node.
+    """
+    U = np.einsum('ij,ij->i', X[iRows[:, np.newaxis], tree["iIn"][nodes, :]], tree["decisionProjection"][nodes, :])
 
-        if ('featureExpansion' in tree.keys()):
-            if len(tree["decisionProjection"].shape) < 2:
-                decisionProjection = np.expand_dims(tree["decisionProjection"], axis=1)
-            else:
-                decisionProjection = tree["decisionProjection"]
-            # Check if the function exists
-            if not (len(tree["featureExpansion"]) == 0):
-                wZ, bZ, rccaIncludeOriginal = tree["featureExpansion"]
-                fExp  = makeExpansionFunc(wZ, bZ, rccaIncludeOriginal)
-                XTest = fExp(X[:, tree["iIn"]])
-                bLessChild = np.dot(XTest, decisionProjection) <= tree["paritionPoint"]
-            else:
-                bLessChild = np.dot(X[:, tree["iIn"]], decisionProjection) <= tree["paritionPoint"]
-        else:
-            if len(tree["decisionProjection"].shape) < 2:
-                decisionProjection = np.expand_dims(tree["decisionProjection"], axis=1)
-            else:
-                decisionProjection = tree["decisionProjection"]
-            
-            bLessChild = np.dot(X[:, tree["iIn"]], decisionProjection) <= tree["paritionPoint"]
+    for node in tree["featureExpansion"].keys():
+        bThisNode = (nodes == node)
+        if np.any(bThisNode):
+            U[bThisNode] = np.ravel(nodeProjection(tree, node, X[iRows[bThisNode], :]))
 
+    return U
+
+#-----------------------------------------------------------------------------#
+def traverse_tree_predict(tree, X):
+    """
+    Traverses the tree to get a prediction.  All rows are routed through the
+    tree together one level at a time: at each step the rows that have not
+    yet reached a leaf are projected onto the decision projection of their
+    current node and moved to the corresponding child.  Once every row is
+    at a leaf, the leaf means are gathered in one go.
+
+    Returns
+    -------
+    leaf_mean:  Array with the same number of rows as X giving the mean of
+                the assigned leaf.
+    leaf_node:  Integer index of the assigned leaf for each row of X.
+    """
+    if not isFlatTree(tree):
+        tree = flattenCCT(tree)
 
-        leaf_mean =  np.empty((X.shape[0], tree["mean"].size))
-        leaf_mean.fill(np.nan)
-        node = np.array([{}])
-        leaf_node = npmat.repmat(node, X.shape[0], 1)
+    if ('rotDetails' in tree.keys()):
+        if not (len(tree["rotDetails"]) == 0):
+            X = np.dot(np.subtract(X, tree["rotDetails"]["muX"]), tree["rotDetails"]["R"])
 
-        # Remove single dimension if present
-        if len(bLessChild.shape) > 1:
-            if bLessChild.shape[1] == 1:
-                bLessChild = np.squeeze(bLessChild, axis=1)
-            else:
-                bLessChild = np.squeeze(bLessChild, axis=0)
+    leaf_node = np.zeros((X.shape[0],), dtype=np.int32)
 
-        if np.any(bLessChild):
-            leaf_mean[bLessChild, :],  leaf_node[bLessChild]  = traverse_tree_predict(tree["lessthanChild"], X[bLessChild, :])
+    iActive = np.arange(X.shape[0])
+    iActive = iActive[~tree["bLeaf"][leaf_node[iActive]]]
+    while iActive.size > 0:
+        nodes = leaf_node[iActive]
+        bLessChild = batchProjection(tree, nodes, X, iActive) <= tree["paritionPoint"][nodes]
+        leaf_node[iActive] = np.where(bLessChild, tree["lessthanChild"][nodes], tree["greaterthanChild"][nodes])
+        iActive = iActive[~tree["bLeaf"][leaf_node[iActive]]]
 
-        if np.any(~bLessChild):
-            leaf_mean[~bLessChild, :], leaf_node[~bLessChild] = traverse_tree_predict(tree["greaterthanChild"], X[~bLessChild, :])
+    leaf_mean = tree["mean"][leaf_node, :]
 
     return leaf_mean, leaf_node
@@ -17,6 +17,19 @@ def treeOutputsToForestPredicts(CCF, treeOutputs):
     """
     forestProbs = np.squeeze(np.mean(treeOutputs, axis=1))
 
+    return forestProbsToForestPredicts(CCF, forestProbs)
+
+
+def forestProbsToForestPredicts(CCF, forestProbs):
+    """
+    Converts forest probabilities, i.e. the tree outputs averaged over the
+    trees, to forest predictions.
+
+    Parameters
+    ----------
+    CCF = Output of genCCF
+    forestProbs = NxK array of forest probabilities
+    """
     if CCF["options"]["bSepPred"]:
         forestPredicts = forestProbs > 0.5
 
@@ -88,3 +88,40 @@ def classExpansion(Y, N, optionsFor):
 
 
     return Y, classes, optionsFor
+
+
+def replicateClassExpansion(Y, classes, optionsFor):
+    """
+    Converts class data into the binary expansion that was used when the
+    forest was trained, e.g. so that trees can be added to an existing
+    forest.  Labels not seen during training give rows of all zeros.
+
+    Parameters
+    ----------
+    Y : pandas DataFrame/Numpy array
+        Class information in the same format as originally given to
+        classExpansion.
+    classes: Class names as returned by classExpansion.
+    optionsFor: dict
+        Forest options as returned by classExpansion.
+
+    Returns
+    -------
+    Y:  Numpy array
+        Y in binary expansion format
+    """
+    if isinstance(classes, type(OneHotEncoder(handle_unknown='ignore'))):
+        Y = (classes.transform(Y)).toarray()
+
+    elif Y.shape[1] == 1:
+        Y  = np.asarray(Y).ravel()
+        YE = np.empty((Y.shape[0], classes.size))
+        YE.fill(False)
+        for k in range(classes.size):
+            YE[:, k] = (Y == classes[k])
+        Y = YE
+
+    else:
+        Y = np.asarray(Y, dtype=float)
+
+    return Y
@@ -1,4 +1,5 @@
 import inspect
+from collections import deque
 import scipy.io
 import numpy as np
 # Import training utils
@@ -8,10 +9,17 @@ from primitives_ubc.clfyCCFS.src.utils.commonUtils import fastUnique
 from primitives_ubc.clfyCCFS.src.utils.commonUtils import queryIfColumnsVary
 from primitives_ubc.clfyCCFS.src.utils.commonUtils import queryIfOnlyTwoUniqueRows
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import regCCA_alt
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import getGenerator
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import randomSketch
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import subsampleRows
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import random_feature_expansion
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import genFeatureExpansionParameters
 from primitives_ubc.clfyCCFS.src.training_utils.component_analysis import componentAnalysis
+from primitives_ubc.clfyCCFS.src.training_utils.component_analysis import componentAnalysisFromStats
+from primitives_ubc.clfyCCFS.src.training_utils.component_analysis import nodeStatistics
+from primitives_ubc.clfyCCFS.src.training_utils.component_analysis import subtractStatistics
 from primitives_ubc.clfyCCFS.src.training_utils.twopoint_max_marginsplit import twoPointMaxMarginSplit
+from primitives_ubc.clfyCCFS.src.training_utils.split_search import searchSplits, searchSplitsBinned
 # Logging
 import logging
 logger  = logging.getLogger(__name__)
@@ -53,12 +61,36 @@ def makeExpansionFunc(wZ, bZ, bIncOrig):
 
 
 #-------------------------------------------------------------------------------
-def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
+def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False, iTrainRows=None, rng=None, stopEvent=None):
     """
     This function applies greedy splitting according to the CCT algorithm and the
-    provided options structure. Algorithm either returns a leaf or forms an
-    internal splitting node in which case the function recursively calls itself
-    for each of the children, eventually returning the corresponding subtree.
+    provided options structure. Nodes are split one at a time from an explicit
+    work queue, either depth first (the same order as a recursive
+    implementation) or breadth first as set by options["treeGrowthOrder"],
+    so the depth of the tree is not limited by the Python stack.
+
+    If options["ccaMethod"] is 'covariance', the CCA at each node is
+    calculated from sufficient statistics of its points (see
+    componentAnalysisFromStats).  Only the smaller child of each split has
+    its statistics calculated from the data, those of its sibling being
+    found by subtraction from the parent.  This requires CCA to be the only
+    projection and is not used with projection bootstrapping or bRCCA, in
+    which case the QR based componentAnalysis is used.
+
+    If options["ccaSketch"] is 'gaussian' or 'countsketch', nodes with more
+    than options["ccaSketchSize"] selected features and points carry out
+    the component analysis on that many random combinations of the
+    features (see randomSketch) instead of on the features themselves.
+
+    If options["histogramSplitMinPoints"] is positive, nodes with more
+    points than it only consider splits between options["histogramSplitBins"]
+    quantile bins of each projection (see searchSplitsBinned).
+
+    If options["maxPointsForProjection"] is positive, the projections of
+    nodes with more points than it are estimated from a random subsample
+    of that many of them (stratified by class for classification) and then
+    applied to all of the node's points.  This does not apply to nodes
+    using ccaMethod='covariance'.
 
     Parameters
     ----------
@@ -73,6 +105,15 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
                   data points, the corresponding values in iFeatureNum are
                   replaced with NaNs.
     depth       = Current tree depth (zero based)
+    iTrainRows  = Optional indices of the rows of XTrain and YTrain to train
+                  on, which may contain repeats (e.g. for bagging).  Defaults
+                  to all rows.
+    rng         = Optional numpy.random.Generator that all random choices
+                  made while growing the tree are drawn from, see
+                  ccfUtils.getGenerator
+    stopEvent   = Optional threading.Event checked before each node is
+                  split.  If it is set the tree is abandoned by raising a
+                  RuntimeError, e.g. when the fit has timed out.
 
 
     Returns
@@ -83,35 +124,137 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
     if bReg:
         bReg = False
 
+    # The tree is grown on a single ordering of the training rows, each node
+    # owning a contiguous range of it, so that the data is never copied for
+    # the children
+    rng = getGenerator(rng)
+    if iTrainRows is None:
+        order = np.arange(XTrain.shape[0])
+    else:
+        order = np.array(iTrainRows, copy=True).ravel()
+
+    growthOrder = options.get("treeGrowthOrder", 'depthFirst')
+    if not (growthOrder in ['depthFirst', 'breadthFirst']):
+        assert (False), 'Invalid option for treeGrowthOrder!'
+
+    # Nodes waiting to be split, each given by the node that will hold it,
+    # the field it is stored in, its depth and its range of the ordering.
+    # Depth first growth pops from the end, pushing the right child before
+    # the left, so that nodes are split in the same order as by recursion.
+    ccaMethod = options.get("ccaMethod", 'qr')
+    if not (ccaMethod in ['qr', 'covariance']):
+        assert (False), 'Invalid option for ccaMethod!'
+    bUseStats = (ccaMethod == 'covariance') and (not options["bProjBoot"]) and (not options["bRCCA"]) and\
+                ([proj for proj in options["projections"] if options["projections"][proj]] == ['CCA'])
+    nMinSplit = np.amax([2, options["minPointsForSplit"], 2 * options["minPointsLeaf"]])
+
+    rootStats = None
+    if bUseStats:
+        rootStats = nodeStatistics(XTrain[order, :], YTrain[order, :])
+
+    root = {}
+    work = deque([(root, "tree", depth, 0, order.size, rootStats)])
+    while work:
+        if (stopEvent is not None) and stopEvent.is_set():
+            raise RuntimeError('Tree growth cancelled!')
+
+        if growthOrder == 'depthFirst':
+            parent, field, nodeDepth, iStart, iEnd, stats = work.pop()
+        else:
+            parent, field, nodeDepth, iStart, iEnd, stats = work.popleft()
+
+        node, nLeft = splitNode(XTrain, YTrain, options, iFeatureNum, nodeDepth, bReg, order, iStart, iEnd, stats, rng)
+        parent[field] = node
+
+        if not node["bLeaf"]:
+            lessStats, greaterStats = childStatistics(XTrain, YTrain, order, iStart, iStart+nLeft, iEnd, stats, nMinSplit)
+            lessChild    = (node, "lessthanChild",    nodeDepth+1, iStart, iStart+nLeft, lessStats)
+            greaterChild = (node, "greaterthanChild", nodeDepth+1, iStart+nLeft, iEnd, greaterStats)
+            if growthOrder == 'depthFirst':
+                work.append(greaterChild)
+                work.append(lessChild)
+            else:
+                work.append(lessChild)
+                work.append(greaterChild)
+
+    return root["tree"]
+
+
+#-------------------------------------------------------------------------------
+def childStatistics(XTrain, YTrain, order, iStart, iSplit, iEnd, stats, nMinSplit):
+    """
+    Sufficient statistics of the two children of a node whose range of the
+    ordering has been partitioned at iSplit.  The smaller child is
+    calculated from its points and the larger by subtraction from the
+    parent.  Children too small to be split get None.
+    """
+    if stats is None:
+        return None, None
+
+    if (iSplit - iStart) <= (iEnd - iSplit):
+        rows = order[iStart:iSplit]
+    else:
+        rows = order[iSplit:iEnd]
+    smallStats = nodeStatistics(XTrain[rows, :], YTrain[rows, :])
+    largeStats = subtractStatistics(stats, smallStats)
+
+    if (iSplit - iStart) <= (iEnd - iSplit):
+        lessStats, greaterStats = smallStats, largeStats
+    else:
+        lessStats, greaterStats = largeStats, smallStats
+
+    if (iSplit - iStart) < nMinSplit:
+        lessStats = None
+    if (iEnd - iSplit) < nMinSplit:
+        greaterStats = None
+
+    return lessStats, greaterStats
+
+
+#-------------------------------------------------------------------------------
+def splitNode(XTrain, YTrain, options, iFeatureNum, depth, bReg, order, iStart, iEnd, stats=None, rng=None):
+    """
+    Splits the node holding the points XTrain[order[iStart:iEnd], :], see
+    growCCT.  Returns either a leaf or an internal node without its
+    children, in which case order[iStart:iEnd] has been partitioned so that
+    the first nLeft points go to the lessthanChild.  If given, stats are
+    the sufficient statistics of the node's points used for the CCA.  Random
+    choices are drawn from rng, see ccfUtils.getGenerator.
+
+    Returns
+    -------
+    tree  = Node struct
+    nLeft = Number of points going to the lessthanChild, 0 for leaves
+    """
+    rng   = getGenerator(rng)
+    rows  = order[iStart:iEnd]
+    YNode = YTrain[rows, :]
+
     # Standard variables
     eps = 2.2204e-16
 
     # Set any missing required variables
     if len(options["mseTotal"]) == 0:
-        options["mseTotal"] = np.var(YTrain, axis=0)
+        options["mseTotal"] = np.var(YNode, axis=0)
 
     #---------------------------------------------------------------------------
     # First do checks for whether we should immediately terminate
     #---------------------------------------------------------------------------
-    N = XTrain.shape[0]
+    N = iEnd - iStart
     # Return if one training point, pure node or if options for returning
     # fulfilled.  A little case to deal with a binary YTrain is required.
     bStop = (N < (np.amax([2, options["minPointsForSplit"], 2 * options["minPointsLeaf"]]))) or\
             (is_numeric(options["maxDepthSplit"]) and depth > options["maxDepthSplit"])
 
-    if depth > 490 and (options["maxDepthSplit"] == 'stack'):
-        bStop = True
-        logging.warning('Reached maximum depth imposed by stack limitations!')
-
     if bStop:
-        tree = setupLeaf(YTrain, bReg, options)
-        return tree
+        tree = setupLeaf(YNode, bReg, options)
+        return tree, 0
     else:
         # Check if variance in Y is less than the cut off amount
-         varY = YTrain.var(axis=0)
+         varY = YNode.var(axis=0)
          if np.all(varY < (options["mseTotal"] * options["mseErrorTolerance"])):
-             tree = setupLeaf(YTrain, bReg, options)
-             return tree
+             tree = setupLeaf(YNode, bReg, options)
+             return tree, 0
 
     #---------------------------------------------------------------------------
     # Subsample features as required for hyperplane sampling
@@ -119,7 +262,7 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
     iCanBeSelected = fastUnique(X=iFeatureNum)
     iCanBeSelected = iCanBeSelected[~np.isnan(iCanBeSelected)]
     lambda_   = np.min((iCanBeSelected.size, options["lambda"]))
-    indFeatIn = np.random.choice(int(iCanBeSelected.size), int(lambda_), replace=False)
+    indFeatIn = rng.choice(int(iCanBeSelected.size), int(lambda_), replace=False)
     iFeatIn   = iCanBeSelected[indFeatIn]
 
     bInMat = np.equal((iFeatureNum.flatten(order='F')[np.newaxis]), (np.sort(iFeatIn.flatten(order='F'))[np.newaxis]).T) # 1xk == nx1
@@ -127,7 +270,7 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
 
     # Check for variation along selected dimensions and
     # resample features that have no variation
-    bXVaries = queryIfColumnsVary(X=XTrain[:, iIn], tol=options["XVariationTol"])
+    bXVaries = queryIfColumnsVary(X=XTrain[rows[:, np.newaxis], iIn], tol=options["XVariationTol"])
 
     if (not np.all(bXVaries)):
         iInNew    = iIn
@@ -143,30 +286,31 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
             lambda_   = np.min((iCanBeSelected.size, options["lambda"]-nSelected))
             if lambda_ < 1:
                 break
-            indFeatIn = np.random.choice(iCanBeSelected.size, size=int(lambda_), replace=False)
+            indFeatIn = rng.choice(iCanBeSelected.size, size=int(lambda_), replace=False)
             iFeatIn   = iCanBeSelected[indFeatIn]
             bInMat    = np.equal((iFeatureNum.flatten(order='F')[np.newaxis]), (iFeatIn.flatten(order='F')[np.newaxis].T))
             iInNew    = (np.any(bInMat, axis=0)).ravel().nonzero()[0]
-            bXVaries  = queryIfColumnsVary(X=XTrain[:, iInNew], tol=options["XVariationTol"])
+            bXVaries  = queryIfColumnsVary(X=XTrain[rows[:, np.newaxis], iInNew], tol=options["XVariationTol"])
             iIn       = np.sort(np.concatenate((iIn, iInNew[bXVaries])))
 
     if iIn.size == 0:
         # This means that there was no variation along any feature, therefore exit.
-        tree = setupLeaf(YTrain, bReg, options)
-        return tree
+        tree = setupLeaf(YNode, bReg, options)
+        return tree, 0
+
+    # Only the selected features of the node's points are gathered
+    XNode = XTrain[rows[:, np.newaxis], iIn]
 
     #---------------------------------------------------------------------------
     # Projection bootstrap if required
     #---------------------------------------------------------------------------
     if options["bProjBoot"]:
-        iTrainThis = np.random.randint(N, size=(N, 1))
-        XTrainBag  = XTrain[iTrainThis, iIn]
-        YTrainBag  = YTrain[iTrainThis, :]
-        if len(YTrainBag.shape) > 2:
-            YTrainBag  = np.squeeze(YTrainBag)
+        iTrainThis = rng.integers(N, size=(N, 1))
+        XTrainBag  = XNode[iTrainThis.ravel(), :]
+        YTrainBag  = YNode[iTrainThis.ravel(), :]
     else:
-        XTrainBag = XTrain[:, iIn]
-        YTrainBag = YTrain
+        XTrainBag = XNode
+        YTrainBag = YNode
 
     bXBagVaries = queryIfColumnsVary(X=XTrainBag, tol=options["XVariationTol"])
 
@@ -175,11 +319,15 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         (not bReg and YTrainBag.shape[1] == 1 and (np.any(np.sum(YTrainBag, axis=0) == np.array([0, YTrainBag.shape[0]])))) or\
         (bReg and np.all(np.var(YTrainBag, axis=0) < (options["mseTotal"] * options["mseErrorTolerance"]))):
         if (not options["bContinueProjBootDegenerate"]):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
         else:
-            XTrainBag = XTrain[:, iIn]
-            YTrainBag = YTrain
+            XTrainBag = XNode
+            YTrainBag = YNode
+
+    # The projections are always estimated in double precision, e.g. for the
+    # QR decompositions of the CCA, even when the data is held in single
+    XTrainBag = np.asarray(XTrainBag, dtype=np.float64)
 
     #---------------------------------------------------------------------------
     # Check for only having two points
@@ -188,25 +336,48 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         bSplit, projMat, partitionPoint = twoPointMaxMarginSplit(XTrainBag, YTrainBag, options["XVariationTol"])
 
         if (not bSplit):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
         else:
-            bLessThanTrain = np.dot(XTrain[:, iIn], projMat) <= partitionPoint
+            bLessThanTrain = np.dot(XNode, projMat) <= partitionPoint
             iDir = 0
     else:
+        # Estimate the projection from a bounded subsample of the points,
+        # stratified by class, and then apply it to all of them
+        if 0 < options.get("maxPointsForProjection", 0) < XTrainBag.shape[0]:
+            iSample   = subsampleRows(XTrainBag.shape[0], int(options["maxPointsForProjection"]), None if bReg else YTrainBag, rng=rng)
+            XTrainBag = XTrainBag[iSample, :]
+            YTrainBag = YTrainBag[iSample, ...]
+
         # Generate the new features as required
         if options["bRCCA"]:
-            wZ, bZ    = genFeatureExpansionParameters(XTrainBag, options["rccaNFeatures"], options["rccaLengthScale"])
+            wZ, bZ    = genFeatureExpansionParameters(XTrainBag, options["rccaNFeatures"], options["rccaLengthScale"], rng=rng)
             fExp      = makeExpansionFunc(wZ, bZ, options["rccaIncludeOriginal"])
             XTrainBag = fExp(XTrainBag)
             projMat, _, _ = regCCA_alt(XTrainBag, YTrainBag, options["rccaRegLambda"], options["rccaRegLambda"], 1e-8)
             if projMat.size == 0:
                 projMat = np.ones((XTrainBag.shape[1], 1))
-            UTrain = np.dot(fExp(XTrain[:, iIn]), projMat)
+            UTrain = np.dot(fExp(XNode), projMat)
+
+        elif stats is not None:
+            projMat, yprojMat = componentAnalysisFromStats(stats, iIn, options["epsilonCCA"])
+            UTrain = np.dot(XNode, projMat)
+
+        elif (options.get("ccaSketch", 'none') != 'none') and (iIn.size > options["ccaSketchSize"]) and\
+             (XTrainBag.shape[0] > options["ccaSketchSize"]):
+            # Carry out the component analysis on a random sketch of the
+            # features and map the projections back.  Small nodes, for which
+            # the sketch would lose too much, use the exact analysis.
+            S = randomSketch(iIn.size, int(options["ccaSketchSize"]), options["ccaSketch"], rng=rng)
+            XSketch = np.asarray((S.T @ XTrainBag.T).T)
+            projMat, yprojMat, _, _, _ = componentAnalysis(XSketch, YTrainBag, options["projections"], options["epsilonCCA"], rng=rng)
+            projMat = np.asarray(S @ projMat)
+            projMat = np.divide(projMat, np.sqrt(np.sum(projMat**2, axis=0)))
+            UTrain  = np.dot(XNode, projMat)
 
         else:
-            projMat, yprojMat, _, _, _ = componentAnalysis(XTrainBag, YTrainBag, options["projections"], options["epsilonCCA"])
-            UTrain = np.dot(XTrain[:, iIn], projMat)
+            projMat, yprojMat, _, _, _ = componentAnalysis(XTrainBag, YTrainBag, options["projections"], options["epsilonCCA"], rng=rng)
+            UTrain = np.dot(XNode, projMat)
 
         #-----------------------------------------------------------------------
         # Choose the features to use
@@ -215,8 +386,8 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         bUTrainVaries = queryIfColumnsVary(UTrain, options["XVariationTol"])
 
         if (not np.any(bUTrainVaries)):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
 
         UTrain  = UTrain[:, bUTrainVaries]
         projMat = projMat[:, bUTrainVaries]
@@ -224,120 +395,16 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         #-----------------------------------------------------------------------
         # Search over splits using provided method
         #-----------------------------------------------------------------------
-        nProjDirs  = UTrain.shape[1]
-        splitGains = np.empty((nProjDirs,1))
-        splitGains.fill(np.nan)
-        iSplits    = np.empty((nProjDirs,1))
-        iSplits.fill(np.nan)
-
-        for nVarAtt in range(nProjDirs):
-            # Calculate the probabilities of being at each class in each of child
-            # nodes based on proportion of training data for each of possible
-            # splits using current projection
-            sort_UTrain   = UTrain[:, nVarAtt].ravel()
-            UTrainSort    = np.sort(sort_UTrain)
-            iUTrainSort   = np.argsort(sort_UTrain)
-
-            bUniquePoints_ = np.diff(UTrainSort, n=1, axis=0)
-            bUniquePoints  = np.concatenate((bUniquePoints_ > options["XVariationTol"], np.array([False])))
-
-            if options["bUseOutputComponentsMSE"] and bReg and YTrain.shape[1] > 1 and (not (yprojMat.size == 0)) and (options["splitCriterion"] == 'mse'):
-                VTrainSort = VTrain[iUTrainSort, :]
-            else:
-                VTrainSort = YTrain[iUTrainSort, :]
-
-            leftCum = np.cumsum(VTrainSort, axis=0)
-            if (YTrain.shape[1] ==1 or options["bSepPred"]) and (not bReg):
-                # Convert to [class_doesnt_exist,class_exists]
-                leftCum = np.concatenate((np.subtract(sVT(X=np.arange(0,N)), leftCum), leftCum))
-
-            rightCum = np.subtract(leftCum[-1, :], leftCum)
-
-            # Calculate the metric values of the current node and two child nodes
-            if not bReg:
-                pL = np.divide(leftCum,  (np.arange(1, N+1)[np.newaxis]).T)
-                pR = np.divide(rightCum, (np.arange(N-1, -1, -1)[np.newaxis]).T)
-
-                split_criterion = options["splitCriterion"]
-                if split_criterion == 'gini':
-                    # Can ignore the 1 as this cancels in the gain
-                    lTerm = -pL**2
-                    rTerm = -pR**2
-                elif split_criterion =='info':
-                    lTerm = np.multiply(-pL, np.log2(pL))
-                    lTerm[np.absolute(pL) == 0] = 0
-                    rTerm = np.multiply(-pR, np.log2(pR))
-                    rTerm[np.absolute(pR) == 0] = 0
-                else:
-                    assert (False), 'Invalid split criterion!'
-
-                if (YTrain.shape[1] == 1) or options["bSepPred"]:
-                    # Add grouped terms back together
-                    end   = YTrain.shape[1]
-                    lTerm = np.add(lTerm[:, 0:end//2], lTerm[:, end//2:])
-                    rTerm = np.add(rTerm[:, 0:end//2], rTerm[:, end//2:])
-
-                if (not is_numeric(options["taskWeights"])) and (not options["multiTaskGainCombination"] == 'max'):
-                    # No need to do anything fancy in the metric calculation
-                    metricLeft  = np.sum(lTerm, axis=1, keepdims=True)
-                    metricRight = np.sum(rTerm, axis=1, keepdims=True)
-                else:
-                    # Need to do grouped sums for each of the outputs as will be
-                    # doing more than a simple averaging of there values
-                   metricLeft = np.cumsum(lTerm, axis=1)
-                   taskidxs_L = np.array([(options["task_ids"][1:] - 2), np.array([-1])])
-                   metricLeft = metricLeft[:, taskidxs_L, np.newaxis]   - np.concatenate((np.zeros((metricLeft.shape[0], 1)),  metricLeft[:,  (options["task_ids"][1:] - 2), np.newaxis]), axis=1)
-
-                   metricRight = np.cumsum(rTerm, axis=1)
-                   taskidxs_R  = np.array([(options["task_ids"][1:] - 2), np.array([-1])])
-                   metricRight = metricRight[:, taskidxs_R, np.newaxis] - np.concatenate((np.zeros((metricRight.shape[0], 1)), metricRight[:, (options["task_ids"][1:] - 2), np.newaxis]), axis=1)
-
-            # Metric
-            metricCurrent = np.copy(metricLeft[-1, :])
-            metricLeft[~bUniquePoints,  :] = np.inf
-            metricRight[~bUniquePoints, :] = np.inf
-
-            # Calculate gain in metric for each of possible splits based on current
-            # metric value minus metric value of child weighted by number of terms
-            # in each child
-            metricGain = np.subtract(metricCurrent,\
-                        (np.multiply(sVT(np.arange(1,N+1, 1)), metricLeft)\
-                        +np.multiply(sVT(np.arange(N-1, -1, -1)), metricRight))/N)
-            metricGain = np.round(metricGain, decimals=4)
-
-            # Combine gains if there are mulitple outputs.  Note that for gini,
-            # info and mse, the joint gain is equal to the mean gain, hence
-            # taking the mean here rather than explicitly calculating joints before.
-            if metricGain.shape[1] > 1:
-                if is_numeric(options["taskWeights"]):
-                    # If weights provided, weight task appropriately in terms of importance.
-                    metricGain = np.multiply(metricGain, (options["taskWeights"].flatten(order='F')[np.newaxis])) # (nxk) .* (1*k)
-
-                multiTGC = options["multiTaskGainCombination"]
-                if multiTGC == 'mean':
-                    metricGain = np.mean(metricGain, axis=1, keepdims=True)
-                elif multiTGC == 'max':
-                    metricGain = np.max(metricGain, axis=1, keepdims=True)
-                else:
-                    assert (False), 'Invalid option for options.multiTaskGainCombination!'
-
-            # Disallow splits that violate the minimum number of leaf points
-            end = (metricGain.shape[0]-1)
-            metricGain[0:(options["minPointsLeaf"]-1)] = -np.inf
-            metricGain[(end-(options["minPointsLeaf"]-1)):] = -np.inf # Note that end is never chosen anyway
-
-            # Randomly sample from equally best splits
-            iSplits[nVarAtt]    = np.argmax(metricGain[0:-1])
-            splitGains[nVarAtt] = np.max(metricGain[0:-1])
-            iEqualMax = ((np.absolute(metricGain[0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
-            if iEqualMax.size == 0:
-                iEqualMax = np.array([1])
-            iSplits[nVarAtt] = iEqualMax[np.random.randint(iEqualMax.size)]
+        if 0 < options.get("histogramSplitMinPoints", 0) < N:
+            # Approximate search over quantile bins for large nodes
+            splitGains, iSplits = searchSplitsBinned(UTrain, YNode, options, options.get("histogramSplitBins", 256), eps, rng=rng)
+        else:
+            splitGains, iSplits = searchSplits(UTrain, YNode, options, eps, rng=rng)
 
         # If no split gives a positive gain then stop
         if np.max(splitGains) < 0:
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
 
         # Establish between projection direction
         maxGain   = np.max(splitGains, axis=0)
@@ -345,7 +412,7 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
 
         # Use given method to break ties
         if options["dirIfEqual"] == 'rand':
-            iDir = iEqualMax[np.random.randint(iEqualMax.size)]
+            iDir = iEqualMax[rng.integers(iEqualMax.size)]
         elif options["dirIfEqual"] == 'first':
             if iEqualMax.size == 0:
                 iDir = 0
@@ -359,7 +426,9 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         # Establish partition point and assign to child
         #-----------------------------------------------------------------------
         UTrain = UTrain[:, iDir, np.newaxis]
-        UTrainSort = np.sort(UTrain, axis=0)
+        # Only the points either side of the split are needed, which are
+        # found without sorting the node
+        UTrainSort = np.partition(UTrain, (int(iSplit[0]), int(iSplit[0])+1), axis=0)
 
         # The convoluted nature of the below is to avoid numerical errors
         uTrainSortLeftPart = UTrainSort[iSplit]
@@ -374,12 +443,12 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
             assert (False), 'Suggested split with empty!'
 
     #-----------------------------------------------------------------------
-    # Recur tree growth to child nodes and constructs tree struct
+    # Construct the node struct and partition the points between the children
     #-----------------------------------------------------------------------
     tree = {}
     tree["bLeaf"]   = False
     tree["Npoints"] = N
-    tree["mean"]    = np.mean(YTrain, axis=0)
+    tree["mean"]    = np.mean(YNode, axis=0)
 
     if len(bLessThanTrain.shape) > 1:
         if bLessThanTrain.shape[1] == 1:
@@ -387,8 +456,12 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
         else:
             bLessThanTrain = np.squeeze(bLessThanTrain, axis=0)
 
-    treeLeft  = growCCT(XTrain[bLessThanTrain, :], YTrain[bLessThanTrain,  :], options, iFeatureNum, depth+1, bReg)
-    treeRight = growCCT(XTrain[~bLessThanTrain,:], YTrain[~bLessThanTrain, :], options, iFeatureNum, depth+1, bReg)
+    # Partition the node's range of the ordering in place, keeping the
+    # original order of the points within each child.  A stable sort of a
+    # boolean key is a linear time counting sort.
+    nLeft = int(np.sum(bLessThanTrain))
+    order[iStart:iEnd] = rows[np.argsort(~bLessThanTrain, kind='stable')]
+
     tree["iIn"] = iIn
 
     if options["bRCCA"]:
@@ -403,7 +476,5 @@ def growCCT(XTrain, YTrain, options, iFeatureNum, depth, bReg=False):
 
     tree["decisionProjection"] = projMat[:, iDir, np.newaxis]
     tree["paritionPoint"]      = partitionPoint
-    tree["lessthanChild"]      = treeLeft
-    tree["greaterthanChild"]   = treeRight
 
-    return tree
+    return tree, nLeft
@@ -2,26 +2,28 @@ import numpy as np
 from primitives_ubc.clfyCCFS.src.utils.commonUtils import sVT
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import pcaLite
 from primitives_ubc.clfyCCFS.src.utils.ccfUtils import manyRandPerms
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import getGenerator
 
-def localRotation(x, p):
-    iB = np.random.choice((np.arange(0, x.shape[0])), round(x.shape[0] * p))
+def localRotation(x, p, rng=None):
+    iB = getGenerator(rng).choice((np.arange(0, x.shape[0])), round(x.shape[0] * p))
     xB = x[iB, :]
     r, _, _  = pcaLite(X=x, bScale=False, bMakeFullRank=False)
 
     return r
 
 
-def rotationForestDataProcess(X, Y, M, prop_points_subsample, prop_classes_eliminate):
+def rotationForestDataProcess(X, Y, M, prop_points_subsample, prop_classes_eliminate, rng=None):
     """
     Carries out the random pca-based projection required for training each
-    tree used in a rotation forest
+    tree used in a rotation forest, drawing from rng (see getGenerator)
     """
+    rng = getGenerator(rng)
     muX = np.mean(X, axis=0)
     X   = np.subtract(X, muX)
 
     D = X.shape[1]
 
-    fOrder  = np.random.permutation(D)
+    fOrder  = rng.permutation(D)
     fGroups = np.reshape(fOrder[0:int(M * np.floor(D/M))], (M, -1), order='F')
     fLeft   = fOrder[int(M * np.floor(D/M) + 1):]
 
@@ -32,8 +34,8 @@ def rotationForestDataProcess(X, Y, M, prop_points_subsample, prop_classes_elimi
         nClasses = classes.shape[0]
 
         n_classes_eliminate = np.floor(prop_classes_eliminate * nClasses).astype(int)
-        classLeaveGroups    = manyRandPerms(nClasses, nClasses-n_classes_eliminate, fGroups.shape[1]).T
-        classLeaveLeft      = np.random.choice(nClasses, nClasses-n_classes_eliminate)
+        classLeaveGroups    = manyRandPerms(nClasses, nClasses-n_classes_eliminate, fGroups.shape[1], rng=rng).T
+        classLeaveLeft      = rng.choice(nClasses, nClasses-n_classes_eliminate)
 
         iClasses = {}
         for k in range(nClasses):
@@ -54,13 +56,13 @@ def rotationForestDataProcess(X, Y, M, prop_points_subsample, prop_classes_elimi
     for n in range(K):
         cLGidx = classLeaveGroups[:, n]
         iThis  = iClasses[cLGidx]
-        r = localRotation(x=X[iThis, fGroups[:, n]], p=prop_points_subsample)
+        r = localRotation(x=X[iThis, fGroups[:, n]], p=prop_points_subsample, rng=rng)
         R[((1 + (n-1)*M)):(n*M), (iUpTo):(iUpTo + r.shape[1] - 1)] = r
         iUpTo = iUpTo + r.shape[1]
 
     if not(fLeft.size == 0):
         iThis = iClasses[classLeaveLeft.flatten()]
-        r = localRotation(x=X[iThis, fLeft], p=prop_points_subsample)
+        r = localRotation(x=X[iThis, fLeft], p=prop_points_subsample, rng=rng)
         R[((1+(K)*M)-1):, (iUpTo-1):(iUpTo + r.shape[1] - 1)] = r
 
     R[fOrder, :] = R
@@ -0,0 +1,312 @@
+import numpy as np
+from primitives_ubc.clfyCCFS.src.utils.commonUtils import is_numeric
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import getGenerator
+
+
+#-----------------------------------------------------------------------------#
+def classMetrics(leftCum, nLeft, N, options):
+    """
+    Calculates the split criterion of the points going left and right at a
+    set of candidate splits from the cumulative class counts.
+
+    Parameters
+    ----------
+    leftCum: d x S x K array of the class indicator sums of the points going
+             left at each of S candidate splits of d directions.  The last
+             candidate must have all points going left.
+    nLeft:   Array broadcastable to d x S x 1 of the number of points going
+             left at each candidate split
+    N:       Number of points
+    options: Options dict
+
+    Returns
+    -------
+    metricLeft, metricRight: d x S x nTasks arrays of the criterion of the
+             left and right children
+    """
+    d, S, K = leftCum.shape
+
+    if (K == 1) or options["bSepPred"]:
+        # Convert to [class_doesnt_exist,class_exists]
+        leftCum = np.concatenate((np.subtract(nLeft, leftCum), leftCum), axis=2)
+
+    rightCum = np.subtract(leftCum[:, -1, np.newaxis, :], leftCum)
+
+    # Calculate the probabilities of being at each class in each of child
+    # nodes based on proportion of training data for each of possible
+    # splits using each projection
+    pL = np.divide(leftCum,  nLeft)
+    pR = np.divide(rightCum, np.subtract(N, nLeft))
+
+    split_criterion = options["splitCriterion"]
+    if split_criterion == 'gini':
+        # Can ignore the 1 as this cancels in the gain
+        lTerm = -pL**2
+        rTerm = -pR**2
+    elif split_criterion =='info':
+        lTerm = np.multiply(-pL, np.log2(pL))
+        lTerm[np.absolute(pL) == 0] = 0
+        rTerm = np.multiply(-pR, np.log2(pR))
+        rTerm[np.absolute(pR) == 0] = 0
+    else:
+        assert (False), 'Invalid split criterion!'
+
+    if (K == 1) or options["bSepPred"]:
+        # Add grouped terms back together
+        end   = lTerm.shape[2]
+        lTerm = np.add(lTerm[:, :, 0:end//2], lTerm[:, :, end//2:])
+        rTerm = np.add(rTerm[:, :, 0:end//2], rTerm[:, :, end//2:])
+
+    if (not is_numeric(options["taskWeights"])) and (not options["multiTaskGainCombination"] == 'max'):
+        # No need to do anything fancy in the metric calculation
+        metricLeft  = np.sum(lTerm, axis=2, keepdims=True)
+        metricRight = np.sum(rTerm, axis=2, keepdims=True)
+    else:
+        # Need to do grouped sums for each of the outputs as will be
+        # doing more than a simple averaging of there values
+        taskEnds    = np.concatenate((np.ravel(options["task_ids"])[1:] - 1, np.array([lTerm.shape[2] - 1])))
+        metricLeft  = np.cumsum(lTerm, axis=2)
+        metricLeft  = metricLeft[:, :, taskEnds]  - np.concatenate((np.zeros((d, S, 1)), metricLeft[:, :, taskEnds[0:-1]]),  axis=2)
+        metricRight = np.cumsum(rTerm, axis=2)
+        metricRight = metricRight[:, :, taskEnds] - np.concatenate((np.zeros((d, S, 1)), metricRight[:, :, taskEnds[0:-1]]), axis=2)
+
+    return metricLeft, metricRight
+
+
+def gainsFromMetrics(metricLeft, metricRight, nLeft, N, bValid, options):
+    """
+    Combines the criterion of the children at each candidate split into the
+    gain of the split.
+
+    Parameters
+    ----------
+    metricLeft, metricRight: d x S x nTasks arrays as given by classMetrics
+    nLeft:   Array broadcastable to d x S x 1 of the number of points going
+             left at each candidate split
+    N:       Number of points
+    bValid:  d x S Boolean array, False for candidate splits that do not
+             separate distinct points
+    options: Options dict
+
+    Returns
+    -------
+    metricGain: d x S array of gains, -inf for disallowed splits
+    """
+    # Metric
+    metricCurrent = np.copy(metricLeft[:, -1, np.newaxis, :])
+    metricLeft[~bValid,  :] = np.inf
+    metricRight[~bValid, :] = np.inf
+
+    # Calculate gain in metric for each of possible splits based on current
+    # metric value minus metric value of child weighted by number of terms
+    # in each child
+    metricGain = np.subtract(metricCurrent,\
+                (np.multiply(nLeft, metricLeft)\
+                +np.multiply(np.subtract(N, nLeft), metricRight))/N)
+    metricGain = np.round(metricGain, decimals=4)
+
+    # Combine gains if there are mulitple outputs.  Note that for gini,
+    # info and mse, the joint gain is equal to the mean gain, hence
+    # taking the mean here rather than explicitly calculating joints before.
+    if metricGain.shape[2] > 1:
+        if is_numeric(options["taskWeights"]):
+            # If weights provided, weight task appropriately in terms of importance.
+            metricGain = np.multiply(metricGain, np.ravel(options["taskWeights"], order='F'))
+
+        multiTGC = options["multiTaskGainCombination"]
+        if multiTGC == 'mean':
+            metricGain = np.mean(metricGain, axis=2, keepdims=True)
+        elif multiTGC == 'max':
+            metricGain = np.max(metricGain, axis=2, keepdims=True)
+        else:
+            assert (False), 'Invalid option for options.multiTaskGainCombination!'
+
+    metricGain = metricGain[:, :, 0]
+
+    # Disallow splits that violate the minimum number of leaf points
+    bTooFew = np.logical_or(nLeft < options["minPointsLeaf"], np.subtract(N, nLeft) < options["minPointsLeaf"])
+    metricGain[np.broadcast_to(bTooFew[..., 0], metricGain.shape)] = -np.inf
+
+    return metricGain
+
+
+#-----------------------------------------------------------------------------#
+def metricGainsBlock(UTrainSort, VTrainSort, options):
+    """
+    Calculates the gain in the split criterion for every candidate split of a
+    block of projection directions at once.
+
+    Parameters
+    ----------
+    UTrainSort: d x N array of the sorted projected points of each direction
+    VTrainSort: d x N x K array of the class indicators in the sorted order
+                of each direction
+    options:    Options dict
+
+    Returns
+    -------
+    metricGain: d x N array of gains, -inf for disallowed splits
+    """
+    d, N = UTrainSort.shape
+
+    bUniquePoints_ = np.diff(UTrainSort, n=1, axis=1)
+    bUniquePoints  = np.concatenate((bUniquePoints_ > options["XVariationTol"], np.zeros((d, 1), dtype=bool)), axis=1)
+
+    nLeft   = np.arange(1, N+1)[np.newaxis, :, np.newaxis]
+    leftCum = np.cumsum(VTrainSort, axis=1)
+    metricLeft, metricRight = classMetrics(leftCum, nLeft, N, options)
+
+    return gainsFromMetrics(metricLeft, metricRight, nLeft, N, bUniquePoints, options)
+
+
+def edgeGaps(UTrain, iBin, d, S):
+    """
+    Gap between the largest point left of each bin edge and the smallest
+    point right of it, for the bins iBin (offset per direction, see
+    binnedGains) of the N x d projected points UTrain.  Returns a d x S
+    array, the gap after the last bin being -inf.
+    """
+    binMax = np.full((d*S,), -np.inf)
+    binMin = np.full((d*S,), np.inf)
+    np.maximum.at(binMax, iBin, UTrain.ravel())
+    np.minimum.at(binMin, iBin, UTrain.ravel())
+
+    leftMax  = np.maximum.accumulate(binMax.reshape(d, S), axis=1)
+    rightMin = np.minimum.accumulate(binMin.reshape(d, S)[:, ::-1], axis=1)[:, ::-1]
+    gaps = np.full((d, S), -np.inf)
+    gaps[:, :-1] = rightMin[:, 1:] - leftMax[:, :-1]
+
+    return gaps
+
+
+def binnedGains(UTrain, YTrain, options, nBins):
+    """
+    Approximate version of metricGainsBlock that only considers splits
+    between quantile bins of each direction.  The bin edges are values of
+    the projected points, so a point goes left of an edge if it is no
+    greater than it, and the class sums of each bin are found
+    without sorting.
+
+    Parameters
+    ----------
+    UTrain:  N x d array of projected points
+    YTrain:  N x K array of class indicators
+    options: Options dict
+    nBins:   Number of quantile bins per direction
+
+    Returns
+    -------
+    metricGain: d x S array of gains at the bin edges, -inf for disallowed
+                splits
+    nLeft:      d x S array of the number of points going left at each edge
+    """
+    N, d = UTrain.shape
+    K = YTrain.shape[1]
+
+    # The edges are estimated from an evenly strided subsample of the points
+    # as finding the exact quantiles is nearly as costly as a full sort
+    USample = np.sort(UTrain[::max(1, N // (16*nBins)), :], axis=0)
+    kth     = np.unique(np.round(np.linspace(0, USample.shape[0]-1, nBins+1)[1:-1]).astype(int))
+    edges   = USample[kth, :]
+    S       = kth.size + 1
+
+    # Bin of each point for each direction, offset so that the bins of all
+    # directions can be counted together
+    iBin = np.empty((N, d), dtype=np.intp)
+    for n in range(d):
+        iBin[:, n] = np.searchsorted(edges[:, n], UTrain[:, n], side='left') + n*S
+    iBin = iBin.ravel()
+
+    binCounts = np.bincount(iBin, minlength=d*S).reshape(d, S)
+    binSums   = np.empty((d, S, K))
+    for k in range(K):
+        binSums[:, :, k] = np.bincount(iBin, weights=np.repeat(YTrain[:, k], d), minlength=d*S).reshape(d, S)
+
+    nLeft   = np.cumsum(binCounts, axis=1)
+    leftCum = np.cumsum(binSums, axis=1)
+    # Repeated edges give empty bins, only the first of which is kept, and
+    # as for the exact search the points either side of a split must differ
+    bValid  = np.logical_and(np.logical_and(binCounts > 0, nLeft < N), edgeGaps(UTrain, iBin, d, S) > options["XVariationTol"])
+    metricLeft, metricRight = classMetrics(leftCum, nLeft[:, :, np.newaxis], N, options)
+
+    return gainsFromMetrics(metricLeft, metricRight, nLeft[:, :, np.newaxis], N, bValid, options), nLeft
+
+
+#-----------------------------------------------------------------------------#
+def searchSplits(UTrain, YTrain, options, eps=2.2204e-16, maxBlockSize=2**22, rng=None):
+    """
+    Searches for the best split along every projection direction.  All
+    columns of UTrain are sorted together and the gains of the candidate
+    splits are calculated for blocks of directions at a time, with the block
+    size chosen so that the d x N x K working arrays have at most
+    maxBlockSize elements.  Ties are broken at random per direction, drawing
+    from rng (see getGenerator) in the same order as when searching one
+    direction at a time.
+
+    Parameters
+    ----------
+    UTrain:  N x nProjDirs array of projected training points
+    YTrain:  N x K array of class indicators
+    options: Options dict
+
+    Returns
+    -------
+    splitGains: nProjDirs x 1 array of the best gain for each direction
+    iSplits:    nProjDirs x 1 array of the index in the sorted order of the
+                last point going left for the best split of each direction
+    """
+    N, nProjDirs = UTrain.shape
+    K   = YTrain.shape[1]
+    rng = getGenerator(rng)
+
+    iUTrainSort = np.argsort(UTrain, axis=0)
+    UTrainSort  = np.take_along_axis(UTrain, iUTrainSort, axis=0)
+
+    metricGain = np.empty((nProjDirs, N))
+    blockSize  = max(1, maxBlockSize // (N * 2 * K))
+    for iStart in range(0, nProjDirs, blockSize):
+        iBlock = np.arange(iStart, min(iStart+blockSize, nProjDirs))
+        metricGain[iBlock, :] = metricGainsBlock(UTrainSort[:, iBlock].T, YTrain[iUTrainSort[:, iBlock].T, :], options)
+
+    splitGains = np.empty((nProjDirs,1))
+    splitGains.fill(np.nan)
+    iSplits    = np.empty((nProjDirs,1))
+    iSplits.fill(np.nan)
+
+    for nVarAtt in range(nProjDirs):
+        # Randomly sample from equally best splits
+        iSplits[nVarAtt]    = np.argmax(metricGain[nVarAtt, 0:-1])
+        splitGains[nVarAtt] = np.max(metricGain[nVarAtt, 0:-1])
+        iEqualMax = ((np.absolute(metricGain[nVarAtt, 0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
+        if iEqualMax.size == 0:
+            iEqualMax = np.array([1])
+        iSplits[nVarAtt] = iEqualMax[rng.integers(iEqualMax.size)]
+
+    return splitGains, iSplits
+
+
+def searchSplitsBinned(UTrain, YTrain, options, nBins, eps=2.2204e-16, rng=None):
+    """
+    Approximate version of searchSplits for large nodes, only considering
+    splits at the edges of nBins quantile bins of each direction (see
+    binnedGains).  Returns the same outputs as searchSplits, the index of a
+    split being that of the last point going left in the sorted order.
+    """
+    rng = getGenerator(rng)
+    nProjDirs  = UTrain.shape[1]
+    metricGain, nLeft = binnedGains(UTrain, YTrain, options, nBins)
+
+    splitGains = np.empty((nProjDirs,1))
+    splitGains.fill(np.nan)
+    iSplits    = np.empty((nProjDirs,1))
+    iSplits.fill(np.nan)
+
+    for nVarAtt in range(nProjDirs):
+        # Randomly sample from equally best splits
+        splitGains[nVarAtt] = np.max(metricGain[nVarAtt, 0:-1])
+        iEqualMax = ((np.absolute(metricGain[nVarAtt, 0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
+        if iEqualMax.size == 0:
+            iEqualMax = np.array([0])
+        iSplits[nVarAtt] = nLeft[nVarAtt, iEqualMax[rng.integers(iEqualMax.size)]] - 1
+
+    return splitGains, iSplits
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 def cohenKappa(confusionMatrix):
     """
@@ -183,29 +184,75 @@ def zScoreToX(zScore, mu_X, std_X):
     return X
 
 
+def is_float(val):
+    """
+    Check if a single value can be converted to a float
+    """
+    try:
+        float(val)
+    except (ValueError, TypeError):
+        return False
+    else:
+        return True
+
+
+def numericMask(x):
+    """
+    Cell-wise check of which values of a 1D array can be converted to
+    floats.  Numerical dtypes are numeric throughout, otherwise (e.g. for
+    object columns of strings) the check is only carried out once for each
+    unique value.
+
+    Parameters
+    ----------
+    x: 1D Numpy array or pandas Series
+
+    Returns
+    -------
+    V: Numpy Boolean array
+    """
+    if getattr(x.dtype, 'kind', 'O') in 'biuf':
+        return np.ones((len(x),), dtype=bool)
+
+    x = np.asarray(x, dtype=object)
+    codes, uniques = pd.factorize(x)
+    bUnique = np.array([is_float(val) for val in uniques], dtype=bool)
+    bSeen   = codes >= 0
+
+    V = np.zeros(codes.shape, dtype=bool)
+    V[bSeen] = bUnique[codes[bSeen]]
+    # Missing values are given the code -1, so check these individually
+    iMissing = (~bSeen).nonzero()[0]
+    if iMissing.size > 0:
+        V[iMissing] = [is_float(val) for val in x[iMissing]]
+
+    return V
+
+
 def is_numeric(X, compress=True):
     """
-    Determine whether input is numeric array
+    Determine whether input is numeric array.  Columns are classified from
+    their dtype where possible, with a cell-wise check (see numericMask)
+    only for object or string columns.
 
     Parameters
     ----------
-    X: Numpy array
+    X: Numpy array, pandas DataFrame or scalar
     compress: Boolean
 
     Returns
     -------
     V: Numpy Boolean array if compress is False, otherwise Boolean Value
     """
-    def is_float(val):
-        try:
-            float(val)
-        except ValueError:
-            return False
-        else:
-            return True
-
-    isnumeric = np.vectorize(is_float, otypes=[bool]) # return numpy array
-    V = isnumeric(X)
+    if isinstance(X, pd.DataFrame):
+        V = np.ones(X.shape, dtype=bool)
+        for n in range(X.shape[1]):
+            V[:, n] = numericMask(X.iloc[:, n])
+    elif np.ndim(X) == 0:
+        V = np.array(is_float(X))
+    else:
+        X = np.asarray(X)
+        V = numericMask(X.ravel()).reshape(X.shape)
 
     if compress:
         return np.all(V)
@@ -260,6 +307,31 @@ def makeSureString(A, nSigFigTol, access_all = False):
     return A
 
 
+def expandCategoricalCodes(codes, nCats):
+    """
+    One-hot expansion of integer category codes with a single scatter.
+
+    Parameters
+    ----------
+    codes: N x C integer Numpy array of the category of each point for each
+           of C features.  Negative codes (e.g. for missing values or
+           unseen categories) leave all of the feature's columns as 0.
+    nCats: Length C array of the number of categories of each feature
+
+    Returns
+    -------
+    XExp: N x sum(nCats) Numpy array
+    """
+    nCats   = np.asarray(nCats, dtype=int)
+    offsets = np.concatenate((np.array([0]), np.cumsum(nCats)[0:-1]))
+    iRow, iCol = (codes >= 0).nonzero()
+
+    XExp = np.zeros((codes.shape[0], int(np.sum(nCats))))
+    XExp[iRow, codes[iRow, iCol] + offsets[iCol]] = 1
+
+    return XExp
+
+
 def dict2array(X):
     """
     Returns a Numpy array from dictionary
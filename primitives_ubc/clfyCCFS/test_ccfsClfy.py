@@ -0,0 +1,883 @@
+import os
+import json
+import copy
+import time
+import socket
+import inspect
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from unittest import mock
+from multiprocessing.connection import Client
+
+from primitives_ubc.clfyCCFS.src import generate_CCF
+from primitives_ubc.clfyCCFS.src.generate_CCF import genCCF, extendCCF
+from primitives_ubc.clfyCCFS.src.compress_CCF import compressCCF
+from primitives_ubc.clfyCCFS.src.predict_from_CCF import predictFromCCF, predictFromCCFEarlyExit
+from primitives_ubc.clfyCCFS.src.utils.ccfUtils import randomSketch, subsampleRows, random_missing_vals, trainingFingerprint
+from primitives_ubc.clfyCCFS.src.utils.commonUtils import is_numeric
+from primitives_ubc.clfyCCFS.src.utils.categoricalUtils import CategoricalMatrix
+from primitives_ubc.clfyCCFS.src.utils.persistUtils import saveCCF, loadCCF
+from primitives_ubc.clfyCCFS.src.utils.flatTreeUtils import isFlatTree, flattenCCT, stackTrees
+from primitives_ubc.clfyCCFS.src.prediction_utils.traverse_treePredict import traverse_tree_predict, nodeProjection
+from primitives_ubc.clfyCCFS.src.prediction_utils.traverse_forestPredict import traverse_forest_predict
+from primitives_ubc.clfyCCFS.src.prediction_utils.replicate_input_process import replicateInputProcess
+from primitives_ubc.clfyCCFS.src.training_utils import tree_executors
+from primitives_ubc.clfyCCFS.src.training_utils import grow_CCT
+from primitives_ubc.clfyCCFS.src.training_utils import component_analysis
+from primitives_ubc.clfyCCFS.src.training_utils.grow_CCT import growCCT
+from primitives_ubc.clfyCCFS.src.training_utils.process_inputData import processInputData
+from primitives_ubc.clfyCCFS.src.training_utils.split_search import searchSplits, searchSplitsBinned
+
+
+def defaultOptions(**kwargs):
+    """
+    Options as set by the primitive from its default hyperparameters, with
+    any given keyword arguments overriding them.
+    """
+    optionsFor = {}
+    optionsFor['nTrees']                      = 100
+    optionsFor['parallelprocessing']          = True
+    optionsFor['lambda']                      = 'log'
+    optionsFor['splitCriterion']              = 'gini'
+    optionsFor['minPointsLeaf']               = 2
+    optionsFor['bSepPred']                    = False
+    optionsFor['taskWeights']                 = 'even'
+    optionsFor['bProjBoot']                   = 'default'
+    optionsFor['bBagTrees']                   = 'default'
+    optionsFor['projections']                 = {'CCA': True}
+    optionsFor['treeRotation']                = 'none'
+    optionsFor['propTrain']                   = 1.0
+    optionsFor['epsilonCCA']                  = 1.0e-04
+    optionsFor['ccaMethod']                   = 'qr'
+    optionsFor['ccaSketch']                   = 'none'
+    optionsFor['ccaSketchSize']               = 256
+    optionsFor['histogramSplitMinPoints']     = 0
+    optionsFor['histogramSplitBins']          = 256
+    optionsFor['maxPointsForProjection']      = 0
+    optionsFor['categoricalEncoding']         = 'onehot'
+    optionsFor['precision']                   = 'float64'
+    optionsFor['randomSeed']                  = 0
+    optionsFor['treeWaveSize']                = 0
+    optionsFor['treeWaveTolerance']           = 1.0e-03
+    optionsFor['treeWavePatience']            = 3
+    optionsFor['bKeepOobStats']               = False
+    optionsFor['mseErrorTolerance']           = 1e-6
+    optionsFor['maxDepthSplit']               = 'stack'
+    optionsFor['treeGrowthOrder']             = 'depthFirst'
+    optionsFor['XVariationTol']               = 1.0e-10
+    optionsFor['RotForM']                     = 3
+    optionsFor['RotForpS']                    = 0.75
+    optionsFor['RotForpClassLeaveOut']        = 0.5
+    optionsFor['minPointsForSplit']           = 2
+    optionsFor['dirIfEqual']                  = 'first'
+    optionsFor['bContinueProjBootDegenerate'] = True
+    optionsFor['multiTaskGainCombination']    = 'mean'
+    optionsFor['missingValuesMethod']         = 'mean'
+    optionsFor['bUseOutputComponentsMSE']     = False
+    optionsFor['bRCCA']                       = False
+    optionsFor['rccaLengthScale']             = 0.1
+    optionsFor['rccaNFeatures']               = 50
+    optionsFor['rccaRegLambda']               = 1e-3
+    optionsFor['rccaIncludeOriginal']         = False
+    optionsFor['classNames']                  = np.array([])
+    optionsFor['org_muY']                     = np.array([])
+    optionsFor['org_stdY']                    = np.array([])
+    optionsFor['mseTotal']                    = np.array([])
+    optionsFor.update(kwargs)
+
+    return optionsFor
+
+
+def makeData(N=300, D=5, seed=0):
+    """
+    Three class problem with features and labels in the form passed by the
+    primitive, i.e. DataFrames with string labels.
+    """
+    rng = np.random.RandomState(seed)
+    X   = rng.randn(N, D)
+    y   = np.where(X[:, 0] + X[:, 1] > 0, 'a', np.where(X[:, 2] > 0, 'b', 'c'))
+
+    return pd.DataFrame(X), pd.DataFrame({'y': y})
+
+
+def treeOutputs(CCF, X):
+    """
+    Outputs of the individual trees, which match only for identical forests.
+    """
+    return predictFromCCF(CCF, X, bTreeOutputs=True)[2]
+
+
+def sameTrees(a, b):
+    """
+    Whether two trees, or any of their parts, are exactly equal.
+    """
+    if isinstance(a, dict):
+        return (set(a.keys()) == set(b.keys())) and all([sameTrees(a[key], b[key]) for key in a])
+    elif isinstance(a, (list, tuple)):
+        return (len(a) == len(b)) and all([sameTrees(x, y) for x, y in zip(a, b)])
+    elif isinstance(a, np.ndarray):
+        return (a.shape == b.shape) and np.array_equal(a, b, equal_nan=(a.dtype.kind == 'f'))
+    elif isinstance(a, float) and np.isnan(a):
+        return isinstance(b, float) and np.isnan(b)
+    return bool(a == b)
+
+
+def nestedPredict(tree, X):
+    """
+    Reference prediction of a nested tree, as grown by growCCT, routing the
+    rows of X recursively one node at a time.
+    """
+    if tree["bLeaf"]:
+        return np.tile(tree["mean"], (X.shape[0], 1))
+
+    bLessChild = np.ravel(np.dot(X[:, tree["iIn"]], tree["decisionProjection"]) <= tree["paritionPoint"])
+    outputs = np.empty((X.shape[0], tree["mean"].size))
+    outputs[bLessChild, :]  = nestedPredict(tree["lessthanChild"], X[bLessChild, :])
+    outputs[~bLessChild, :] = nestedPredict(tree["greaterthanChild"], X[~bLessChild, :])
+
+    return outputs
+
+
+def rowByRowLeaves(tree, X):
+    """
+    Reference leaf assignment of a flat tree, walking each row of X down
+    from the root on its own.
+    """
+    leaves = np.empty((X.shape[0],), dtype=int)
+    for i in range(X.shape[0]):
+        node = 0
+        while not tree["bLeaf"][node]:
+            if np.ravel(nodeProjection(tree, node, X[i:i+1, :]))[0] <= tree["paritionPoint"][node]:
+                node = tree["lessthanChild"][node]
+            else:
+                node = tree["greaterthanChild"][node]
+        leaves[i] = node
+
+    return leaves
+
+
+def bestSplitGain(u, Y, options):
+    """
+    Reference best gain in the split criterion along one projection
+    direction u, trying each split of the sorted points in turn.
+    """
+    def metric(Y):
+        p = np.mean(Y, axis=0)
+        if options["splitCriterion"] == 'gini':
+            return -np.sum(p**2)
+        return -np.sum(p[p > 0] * np.log2(p[p > 0]))
+
+    N = u.size
+    uSort = np.sort(u)
+    YSort = Y[np.argsort(u), :]
+    best  = -np.inf
+    for nLeft in range(options["minPointsLeaf"], N - options["minPointsLeaf"] + 1):
+        if uSort[nLeft] - uSort[nLeft-1] > options["XVariationTol"]:
+            gain = metric(Y) - (nLeft * metric(YSort[:nLeft, :]) + (N - nLeft) * metric(YSort[nLeft:, :])) / N
+            best = max(best, np.round(gain, decimals=4))
+
+    return best
+
+
+def genNestedCCF(X, Y, nTrees, optionsFor):
+    """
+    Grows a forest serially, also returning the nested trees that were
+    converted to the stored flat trees.
+    """
+    nestedTrees = []
+    def recordNested(tree):
+        nestedTrees.append(copy.deepcopy(tree))
+        return flattenCCT(tree)
+
+    with mock.patch.object(generate_CCF, 'flattenCCT', recordNested):
+        CCF = genCCF(X, Y, nTrees=nTrees, optionsFor=optionsFor, do_parallel=False)
+
+    return CCF, nestedTrees
+
+
+def sleepThenTouch(context, task):
+    """
+    Task that marks that it ran to completion by creating a file.
+    """
+    seconds, path = task
+    time.sleep(seconds)
+    open(path, 'w').close()
+    return path
+
+
+class TreeWorkers(object):
+    """
+    Serves remote tree workers on a free local port for the duration of a
+    with block.
+    """
+    authkey = b'test'
+
+    def __enter__(self):
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        self.address = sock.getsockname()
+        sock.close()
+
+        self._server = mp.Process(target=tree_executors.serveTreeWorkers, args=(self.address, self.authkey))
+        self._server.start()
+        for _ in range(100):
+            try:
+                Client(self.address, authkey=self.authkey).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        return self
+
+    def __exit__(self, *args):
+        self._server.terminate()
+        self._server.join()
+
+
+class TestCanonicalCorrelationForestsClassifier(unittest.TestCase):
+    def test_flat_prediction_matches_nested_trees(self):
+        X, Y = makeData()
+        for treeRotation in ['none', 'random', 'pca']:
+            CCF, nestedTrees = genNestedCCF(X, Y, 5, defaultOptions(treeRotation=treeRotation))
+            outputs = treeOutputs(CCF, X)
+
+            XProc = replicateInputProcess(X, CCF["inputProcessDetails"])
+            for n, tree in enumerate(CCF["Trees"].values()):
+                self.assertTrue(isFlatTree(tree))
+                XTree = XProc
+                if "rotDetails" in tree:
+                    XTree = np.dot(np.subtract(XProc, tree["rotDetails"]["muX"]), tree["rotDetails"]["R"])
+                np.testing.assert_allclose(outputs[:, n, :], nestedPredict(nestedTrees[n], XTree))
+                np.testing.assert_allclose(outputs[:, n, :], traverse_tree_predict(tree, XProc)[0])
+
+    def test_batch_traversal_matches_row_by_row(self):
+        X, Y = makeData()
+        for bRCCA in [False, True]:
+            CCF = genCCF(X, Y, nTrees=3, optionsFor=defaultOptions(bRCCA=bRCCA), do_parallel=False)
+            XProc = replicateInputProcess(X, CCF["inputProcessDetails"])
+            for tree in CCF["Trees"].values():
+                outputs, leaves = traverse_tree_predict(tree, XProc)
+                np.testing.assert_array_equal(leaves, rowByRowLeaves(tree, XProc))
+                np.testing.assert_array_equal(outputs, tree["mean"][leaves, :])
+
+    def test_fused_forest_matches_tree_by_tree(self):
+        X, Y = makeData()
+        for treeRotation, bRCCA in [('none', False), ('random', False), ('none', True)]:
+            optionsFor = defaultOptions(treeRotation=treeRotation, bRCCA=bRCCA)
+            CCF = genCCF(X, Y, nTrees=4, optionsFor=optionsFor, do_parallel=False)
+            XProc = replicateInputProcess(X, CCF["inputProcessDetails"])
+            stackedTrees = stackTrees(CCF["Trees"])
+
+            # Gathered and dense projections, in several row blocks
+            for denseFactor in [0, 1e9]:
+                outputs, leaves = traverse_forest_predict(stackedTrees, XProc, denseFactor=denseFactor, maxPairs=200)
+                for n, tree in enumerate(CCF["Trees"].values()):
+                    expected, expectedLeaves = traverse_tree_predict(tree, XProc)
+                    np.testing.assert_array_equal(leaves[:, n], expectedLeaves + stackedTrees["roots"][n])
+                    np.testing.assert_allclose(outputs[:, n, :], expected)
+
+    def test_parallel_fit_shares_data(self):
+        X, Y = makeData()
+        X.iloc[::7, 1] = np.nan
+        optionsFor = defaultOptions(missingValuesMethod='random')
+        folder = tempfile.mkdtemp()
+        try:
+            forests = []
+            with mock.patch.object(tempfile, 'tempdir', folder):
+                for _ in range(2):
+                    forests.append(genCCF(X, Y, nTrees=6, optionsFor=dict(optionsFor), do_parallel=True))
+
+            # The memory-mapped copy of the data is removed
+            self.assertEqual(os.listdir(folder), [])
+        finally:
+            shutil.rmtree(folder)
+
+        # Each tree has its own random stream, so the forest does not depend
+        # on which worker grew each tree, and workers forked with the same
+        # random state do not grow the same trees
+        trees = list(forests[0]["Trees"].values())
+        for pos in forests[0]["Trees"]:
+            self.assertTrue(sameTrees(forests[0]["Trees"][pos], forests[1]["Trees"][pos]))
+        for n in range(1, len(trees)):
+            self.assertFalse(any([sameTrees(trees[n], tree) for tree in trees[:n]]))
+
+    def test_vectorized_split_search_matches_reference(self):
+        rng = np.random.RandomState(0)
+        U = np.round(rng.randn(60, 7), decimals=1)
+        Y = np.eye(3)[rng.randint(3, size=60)]
+        for splitCriterion in ['gini', 'info']:
+            options = defaultOptions(splitCriterion=splitCriterion)
+            # Small blocks so that several are used
+            splitGains, iSplits = searchSplits(U, Y, options, maxBlockSize=1000)
+            for n in range(U.shape[1]):
+                self.assertAlmostEqual(splitGains[n, 0], bestSplitGain(U[:, n], Y, options))
+                self.assertLess(iSplits[n, 0], U.shape[0] - 1)
+
+    def test_bagged_rows_match_copied_rows(self):
+        X, Y = makeData()
+        calls = []
+        def recordGrowth(XTrain, YTrain, options, iFeatureNum, depth, **kwargs):
+            calls.append(copy.deepcopy((XTrain, YTrain, options, iFeatureNum, kwargs["iTrainRows"], kwargs["rng"])))
+            return growCCT(XTrain, YTrain, options, iFeatureNum, depth, **kwargs)
+
+        with mock.patch.object(generate_CCF, 'growCCT', recordGrowth):
+            genCCF(X, Y, nTrees=3, optionsFor=defaultOptions(bBagTrees=True), do_parallel=False)
+
+        # Growing from the indices of the bagged rows gives the tree grown
+        # from a copy of those rows
+        for XTrain, YTrain, options, iFeatureNum, iTrainRows, rng in calls:
+            tree = growCCT(XTrain, YTrain, copy.deepcopy(options), np.copy(iFeatureNum), 0, iTrainRows=iTrainRows, rng=copy.deepcopy(rng))
+            copied = growCCT(XTrain[iTrainRows, :], YTrain[iTrainRows, :], copy.deepcopy(options), np.copy(iFeatureNum), 0, rng=copy.deepcopy(rng))
+            self.assertTrue(sameTrees(tree, copied))
+
+    def test_growth_orders_split_every_node(self):
+        X, Y = makeData()
+        for treeGrowthOrder in ['depthFirst', 'breadthFirst']:
+            depths    = []
+            splitNode = grow_CCT.splitNode
+            def recordDepth(*args, **kwargs):
+                depths.append(inspect.signature(splitNode).bind(*args, **kwargs).arguments["depth"])
+                return splitNode(*args, **kwargs)
+
+            with mock.patch.object(grow_CCT, 'splitNode', recordDepth):
+                _, nestedTrees = genNestedCCF(X, Y, 1, defaultOptions(treeGrowthOrder=treeGrowthOrder))
+
+            # Nodes are split in pre-order or level by level
+            work, treeDepths = [(nestedTrees[0], 0)], []
+            while work:
+                node, depth = work.pop() if treeGrowthOrder == 'depthFirst' else work.pop(0)
+                treeDepths.append(depth)
+                if not node["bLeaf"]:
+                    children = [(node["greaterthanChild"], depth+1), (node["lessthanChild"], depth+1)]
+                    work.extend(children if treeGrowthOrder == 'depthFirst' else children[::-1])
+            self.assertGreater(len(depths), 1)
+            self.assertEqual(depths, treeDepths)
+
+    def test_chunked_prediction_matches_whole(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=defaultOptions(), do_parallel=False)
+        predicts, probs, outputs = predictFromCCF(CCF, X, bTreeOutputs=True)
+
+        # Small chunks so that several are used, including a partial one
+        chunkPredicts, chunkProbs, chunkOutputs = predictFromCCF(CCF, X, bTreeOutputs=True, chunkSize=70)
+        np.testing.assert_array_equal(predicts, chunkPredicts)
+        np.testing.assert_allclose(probs, chunkProbs)
+        np.testing.assert_array_equal(outputs, chunkOutputs)
+        np.testing.assert_allclose(probs, np.mean(outputs, axis=1))
+        self.assertIsNone(predictFromCCF(CCF, X, chunkSize=70)[2])
+
+    def test_streamed_out_of_bag_error(self):
+        X, Y = makeData()
+        grown   = []
+        genTree = generate_CCF.genTree
+        def recordTree(*args, **kwargs):
+            grown.append(genTree(*args, **kwargs))
+            return grown[-1]
+
+        with mock.patch.object(generate_CCF, 'genTree', recordTree):
+            CCF = genCCF(X, Y, nTrees=20, optionsFor=defaultOptions(bBagTrees=True), do_parallel=False, bOutOfBagPreds=True)
+
+        # Each tree's out of bag predictions are returned with it rather
+        # than stored in it
+        XProc  = replicateInputProcess(X, CCF["inputProcessDetails"])
+        cumOOb = np.zeros(CCF["outOfBagPreds"].shape)
+        nOOb   = np.zeros((X.shape[0], 1))
+        for _, tree, (iOob, predictsOutOfBag) in grown:
+            self.assertNotIn("iOutOfBag", tree)
+            np.testing.assert_allclose(predictsOutOfBag, traverse_tree_predict(tree, XProc[iOob, :])[0])
+            cumOOb[iOob, :] += predictsOutOfBag
+            nOOb[iOob]      += 1
+
+        self.assertTrue(np.all(nOOb > 0))
+        np.testing.assert_array_equal(CCF["outOfBagCounts"], nOOb)
+        np.testing.assert_allclose(CCF["outOfBagPreds"], cumOOb / nOOb)
+        expected = np.mean(np.unique(Y['y'])[np.argmax(cumOOb, axis=1)] != Y['y'].to_numpy())
+        np.testing.assert_allclose(CCF["outOfBagError"], [expected])
+
+    def test_parallel_fit_matches_serial(self):
+        X, Y = makeData()
+        optionsFor = defaultOptions(bBagTrees=True, treeRotation='random', bKeepOobStats=True)
+        serial   = genCCF(X, Y, nTrees=6, optionsFor=dict(optionsFor), do_parallel=False)
+        parallel = genCCF(X, Y, nTrees=6, optionsFor=dict(optionsFor), do_parallel=True)
+        for pos in serial["Trees"]:
+            self.assertTrue(sameTrees(serial["Trees"][pos], parallel["Trees"][pos]))
+        np.testing.assert_array_equal(serial["oobStats"]["nOOb"], parallel["oobStats"]["nOOb"])
+        np.testing.assert_allclose(serial["outOfBagError"], parallel["outOfBagError"])
+
+    def test_warm_start_matches_full_fit(self):
+        X, Y = makeData()
+        full = genCCF(X, Y, nTrees=10, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        warm = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        warm = extendCCF(warm, X, Y, 4, do_parallel=False)
+
+        self.assertEqual(list(warm["Trees"].keys()), list(full["Trees"].keys()))
+        for pos in full["Trees"]:
+            self.assertTrue(sameTrees(full["Trees"][pos], warm["Trees"][pos]))
+        np.testing.assert_array_equal(full["oobStats"]["nOOb"], warm["oobStats"]["nOOb"])
+        np.testing.assert_allclose(full["oobStats"]["cumOOb"], warm["oobStats"]["cumOOb"])
+        np.testing.assert_allclose(full["outOfBagError"], warm["outOfBagError"])
+
+    def test_covariance_cca_matches_qr(self):
+        rng = np.random.RandomState(0)
+        processes = {'CCA': True, 'CCAclasswise': False, 'Original': False, 'Random': False, 'PCA': False}
+        X = rng.randn(300, 8) + 3
+        Y = np.dot(X[:, 0:3], rng.randn(3, 2)) + rng.randn(300, 2)
+        iIn = np.array([0, 2, 3, 6])
+
+        # Statistics of the last 200 points, found by subtracting those of
+        # their sibling from the parent
+        stats = component_analysis.subtractStatistics(component_analysis.nodeStatistics(X, Y),
+                                                      component_analysis.nodeStatistics(X[:100, :], Y[:100, :]))
+        A, B = component_analysis.componentAnalysisFromStats(stats, iIn, 1e-4)
+        AQR, _, _, _, _ = component_analysis.componentAnalysis(X[100:, iIn], Y[100:, :], processes, 1e-4)
+
+        self.assertEqual(A.shape, AQR.shape)
+        sign = np.sign(np.sum(A * AQR, axis=0))
+        np.testing.assert_allclose(A, AQR * sign, atol=1e-8)
+
+    def test_covariance_cca_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        optionsFor = defaultOptions(ccaMethod='covariance', bProjBoot=False)
+        CCF = genCCF(X, Y, nTrees=10, optionsFor=optionsFor, do_parallel=False)
+
+        predicts, _, _ = predictFromCCF(CCF, XHeld)
+        self.assertGreater(np.mean(np.ravel(predicts) == YHeld['y'].to_numpy()), 0.8)
+
+    def test_class_indicator_cca_matches_general(self):
+        rng = np.random.RandomState(0)
+        processes = {'CCA': True, 'CCAclasswise': False, 'Original': False, 'Random': False, 'PCA': False}
+        X = rng.randn(500, 6) + 1
+        Y = np.eye(3)[np.argmax(X[:, 0:3] + rng.randn(500, 3), axis=1)]
+
+        # Scaled indicators are not recognised as such, so take the general
+        # QR path, but have the same canonical directions
+        with mock.patch.object(component_analysis, 'classIndicatorCCA', wraps=component_analysis.classIndicatorCCA) as closedForm:
+            A, _, _, _, r = component_analysis.componentAnalysis(X, Y, dict(processes), 1e-4)
+            self.assertEqual(closedForm.call_count, 1)
+        AQR, _, _, _, rQR = component_analysis.componentAnalysis(X, 2 * Y, dict(processes), 1e-4)
+
+        self.assertEqual(A.shape, AQR.shape)
+        sign = np.sign(np.sum(A * AQR, axis=0))
+        np.testing.assert_allclose(A, AQR * sign, atol=1e-8)
+        np.testing.assert_allclose(r, rQR, atol=1e-8)
+
+    def test_class_indicator_cca_from_scatter(self):
+        rng = np.random.RandomState(0)
+        processes = {'CCA': True, 'CCAclasswise': False, 'Original': False, 'Random': False, 'PCA': False}
+        X = rng.randn(400, 30)
+        Y = np.eye(5)[np.argmax(X[:, 0:5] + rng.randn(400, 5), axis=1)]
+
+        # Class indicators need no QR decomposition of the node's data
+        with mock.patch.object(component_analysis.la, 'qr', wraps=component_analysis.la.qr) as qr:
+            A, _, U, V, r = component_analysis.componentAnalysis(X, Y, dict(processes), 1e-4)
+            self.assertEqual(qr.call_count, 0)
+        AQR, _, UQR, VQR, rQR = component_analysis.componentAnalysis(X, 2 * Y, dict(processes), 1e-4)
+
+        self.assertEqual(A.shape, (30, 4))
+        self.assertEqual(A.shape, AQR.shape)
+        sign = np.sign(np.sum(A * AQR, axis=0))
+        np.testing.assert_allclose(A, AQR * sign, atol=1e-8)
+        np.testing.assert_allclose(U, UQR * sign, atol=1e-8)
+        np.testing.assert_allclose(V, VQR * sign, atol=1e-8)
+        np.testing.assert_allclose(r, rQR, atol=1e-8)
+
+    def test_class_indicator_cca_wide_nodes(self):
+        rng = np.random.RandomState(0)
+        processes = {'CCA': True, 'CCAclasswise': False, 'Original': False, 'Random': False, 'PCA': False}
+        X = rng.randn(12, 20)
+        Y = np.eye(3)[np.arange(12) % 3]
+
+        # Fewer points than features still use the class indicator path,
+        # which then separates the classes perfectly
+        with mock.patch.object(component_analysis, 'classIndicatorCCA', wraps=component_analysis.classIndicatorCCA) as closedForm:
+            A, _, _, _, r = component_analysis.componentAnalysis(X, Y, dict(processes), 1e-4)
+            self.assertEqual(closedForm.call_count, 1)
+        np.testing.assert_allclose(r, 1, atol=1e-6)
+        U = np.dot(X - np.mean(X, axis=0), A)
+        np.testing.assert_allclose(U, np.dot(Y, np.dot(Y.T, U) / 4), atol=1e-6)
+
+    def test_random_sketches(self):
+        rng = np.random.default_rng(0)
+        S = randomSketch(50, 8, 'countsketch', rng=rng).toarray()
+        self.assertEqual(S.shape, (50, 8))
+        np.testing.assert_array_equal(np.sum(S != 0, axis=1), np.ones(50))
+        np.testing.assert_array_equal(np.absolute(S[S != 0]), np.ones(50))
+        self.assertEqual(randomSketch(50, 8, 'gaussian', rng=rng).shape, (50, 8))
+
+    def test_sketched_cca_forest(self):
+        X, Y = makeData(D=20)
+        XHeld, YHeld = makeData(N=200, D=20, seed=1)
+        for ccaSketch in ['gaussian', 'countsketch']:
+            optionsFor = defaultOptions(ccaSketch=ccaSketch, ccaSketchSize=8, bProjBoot=False, **{'lambda': 'all'})
+            with mock.patch.object(grow_CCT, 'randomSketch', wraps=grow_CCT.randomSketch) as sketch:
+                CCF = genCCF(X, Y, nTrees=10, optionsFor=optionsFor, do_parallel=False)
+                self.assertGreater(sketch.call_count, 0)
+
+            # Half the points are in the largest class
+            predicts, _, _ = predictFromCCF(CCF, XHeld)
+            self.assertGreater(np.mean(np.ravel(predicts) == YHeld['y'].to_numpy()), 0.65)
+
+    def test_binned_split_search(self):
+        rng = np.random.RandomState(0)
+        U = np.round(rng.randn(60, 7), decimals=1)
+        Y = np.eye(3)[rng.randint(3, size=60)]
+        options = defaultOptions()
+        exactGains, _ = searchSplits(U, Y, options)
+
+        # With a bin for every point all splits are considered, with fewer
+        # bins only some of them
+        splitGains, _ = searchSplitsBinned(U, Y, options, 60)
+        np.testing.assert_allclose(splitGains, exactGains)
+        splitGains, iSplits = searchSplitsBinned(U, Y, options, 4)
+        self.assertTrue(np.all(splitGains <= exactGains + 1e-12))
+        self.assertTrue(np.all((iSplits >= 0) & (iSplits < U.shape[0] - 1)))
+
+    def test_binned_split_variation_tol(self):
+        # Only the split between points further apart than XVariationTol is
+        # allowed, as in the exact search
+        U = np.repeat([[0.0], [1e-12], [1.0]], [40, 40, 20], axis=0)
+        Y = np.eye(2)[np.repeat([0, 1, 1], [40, 40, 20])]
+        options = defaultOptions()
+        exactGains, exactSplits = searchSplits(U, Y, options)
+        splitGains, iSplits = searchSplitsBinned(U, Y, options, 8)
+        np.testing.assert_allclose(splitGains, exactGains)
+        np.testing.assert_array_equal(iSplits, [[79]])
+        np.testing.assert_array_equal(iSplits, exactSplits)
+
+    def test_binned_split_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        optionsFor = defaultOptions(histogramSplitMinPoints=50, histogramSplitBins=16)
+        with mock.patch.object(grow_CCT, 'searchSplitsBinned', wraps=grow_CCT.searchSplitsBinned) as binned:
+            CCF = genCCF(X, Y, nTrees=10, optionsFor=optionsFor, do_parallel=False)
+            self.assertGreater(binned.call_count, 0)
+
+        predicts, _, _ = predictFromCCF(CCF, XHeld)
+        self.assertGreater(np.mean(np.ravel(predicts) == YHeld['y'].to_numpy()), 0.8)
+
+    def test_stratified_subsample(self):
+        rng = np.random.default_rng(0)
+        Y = np.eye(4)[np.repeat(np.arange(4), [700, 200, 90, 10])]
+        iSample = subsampleRows(1000, 100, Y, rng=rng)
+        self.assertEqual(np.unique(iSample).size, iSample.size)
+        np.testing.assert_array_equal(np.sum(Y[iSample, :], axis=0), [70, 20, 9, 1])
+
+        # Rare classes keep at least one row, without exceeding nSample
+        iSample = subsampleRows(1000, 20, Y, rng=rng)
+        self.assertEqual(iSample.size, 20)
+        self.assertTrue(np.all(np.sum(Y[iSample, :], axis=0) >= 1))
+
+        iSample = subsampleRows(1000, 100, rng=rng)
+        self.assertEqual(np.unique(iSample).size, 100)
+
+    def test_stratified_subsample_singleton_classes(self):
+        rng = np.random.default_rng(0)
+        Y = np.eye(41)[np.concatenate((np.zeros(60, dtype=int), np.arange(1, 41)))]
+        for nSample in [10, 40, 41, 50]:
+            iSample = subsampleRows(100, nSample, Y, rng=rng)
+            self.assertEqual(np.unique(iSample).size, nSample)
+            if nSample >= 41:
+                self.assertTrue(np.all(np.sum(Y[iSample, :], axis=0) >= 1))
+
+    def test_subsampled_projection_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        optionsFor = defaultOptions(maxPointsForProjection=50)
+        with mock.patch.object(grow_CCT, 'componentAnalysis', wraps=grow_CCT.componentAnalysis) as analysis:
+            CCF = genCCF(X, Y, nTrees=10, optionsFor=optionsFor, do_parallel=False)
+            self.assertLessEqual(max([args[0].shape[0] for args, _ in analysis.call_args_list]), 50)
+
+        predicts, _, _ = predictFromCCF(CCF, XHeld)
+        self.assertGreater(np.mean(np.ravel(predicts) == YHeld['y'].to_numpy()), 0.8)
+
+    def test_mixed_input_processing(self):
+        X = pd.DataFrame({'a': [0.5, 1.5, 2.5, 3.5], 'b': ['y', 'x', 'z', 'x'], 'c': [1, 'NA', 3, 4]})
+        np.testing.assert_array_equal(is_numeric(X, compress=False), [[True, False, True], [True, False, False],
+                                                                     [True, False, True], [True, False, True]])
+
+        # The single string in c marks missing values, b is expanded
+        XTrain, iFeatureNum, inputProcessDetails, featureNames = processInputData(X.copy(), FNormalize=False)
+        np.testing.assert_array_equal(XTrain, [[0.5, 1, 0, 1, 0], [1.5, np.nan, 1, 0, 0],
+                                               [2.5, 3, 0, 0, 1], [3.5, 4, 1, 0, 0]])
+        np.testing.assert_array_equal(iFeatureNum, [0, 1, 2, 2, 2])
+        np.testing.assert_array_equal(featureNames, ['a', 'c', 'Cat_x', 'Cat_y', 'Cat_z'])
+
+        # Categories not seen in training set none of the expanded features
+        XNew = pd.DataFrame({'a': [1.0, 2.0], 'b': ['w', 'z'], 'c': [2, 'NA']})
+        np.testing.assert_array_equal(replicateInputProcess(XNew, inputProcessDetails),
+                                      [[1, 2, 0, 0, 0], [2, np.nan, 0, 0, 1]])
+
+
+    def test_categorical_codes_match_one_hot(self):
+        X, Y = makeData()
+        rng  = np.random.RandomState(1)
+        X['g'] = np.where(X[0] > 0.5, 'p', rng.choice(['q', 'r', 's'], X.shape[0]))
+        X['h'] = rng.choice(['u', 'v'], X.shape[0])
+
+        XDense, _, _, _ = processInputData(X.copy())
+        XCodes, _, _, _ = processInputData(X.copy(), bExpandCategoricals=False)
+        self.assertIsInstance(XCodes, CategoricalMatrix)
+        self.assertEqual(XCodes.shape, XDense.shape)
+        np.testing.assert_allclose(np.asarray(XCodes), XDense)
+        rows, cols = rng.choice(X.shape[0], 20), np.array([6, 0, 9, 5])
+        np.testing.assert_allclose(XCodes[rows[:, np.newaxis], cols], XDense[rows[:, np.newaxis], cols])
+        np.testing.assert_allclose(XCodes[rows, :], XDense[rows, :])
+
+        predicts = []
+        for categoricalEncoding in ['onehot', 'codes']:
+            CCF = genCCF(X.copy(), Y, nTrees=5, optionsFor=defaultOptions(categoricalEncoding=categoricalEncoding), do_parallel=False)
+            predicts.append(predictFromCCF(CCF, X.copy())[0])
+        # The z-scored indicator columns can differ in their last bits, which
+        # may settle the odd near tie between splits differently, so only the
+        # predicted classes are compared
+        self.assertGreater(np.mean(predicts[0] == predicts[1]), 0.98)
+
+
+    def test_single_precision_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        CCF = genCCF(X, Y, nTrees=10, optionsFor=defaultOptions(precision='float32', treeRotation='random'), do_parallel=False)
+        for tree in CCF["Trees"].values():
+            for key in ["mean", "decisionProjection", "paritionPoint"]:
+                self.assertEqual(tree[key].dtype, np.float32)
+            self.assertEqual(tree["rotDetails"]["R"].dtype, np.float32)
+
+        predicts, _, outputs = predictFromCCF(CCF, XHeld, bTreeOutputs=True)
+        self.assertEqual(outputs.dtype, np.float32)
+        self.assertGreater(np.mean(np.ravel(predicts) == YHeld['y'].to_numpy()), 0.8)
+
+
+    def test_save_load_round_trip(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=defaultOptions(treeRotation='random', bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        predicts, probs, outputs = predictFromCCF(CCF, X, bTreeOutputs=True)
+
+        folder = tempfile.mkdtemp()
+        try:
+            saveCCF(CCF, folder)
+            for mmap_mode in ['r', None]:
+                loaded = loadCCF(folder, mmap_mode=mmap_mode)
+                loadedPredicts, loadedProbs, loadedOutputs = predictFromCCF(loaded, X, bTreeOutputs=True)
+                np.testing.assert_array_equal(predicts, loadedPredicts)
+                np.testing.assert_array_equal(probs, loadedProbs)
+                np.testing.assert_array_equal(outputs, loadedOutputs)
+                np.testing.assert_array_equal(CCF["outOfBagError"], loaded["outOfBagError"])
+
+            # Trees can still be added to a memory mapped forest
+            extended = extendCCF(loadCCF(folder, mmap_mode='r'), X, Y, 2, do_parallel=False)
+            self.assertEqual(treeOutputs(extended, X).shape[1], 7)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_extend_needs_original_training_data(self):
+        X, Y = makeData()
+        XOther, YOther = makeData(seed=1)
+        CCF = genCCF(X, Y, nTrees=2, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        with self.assertRaises(AssertionError):
+            extendCCF(CCF, XOther, YOther, 2, do_parallel=False)
+        self.assertEqual(len(CCF["Trees"]), 2)
+
+        self.assertEqual(CCF["trainingFingerprint"], trainingFingerprint(X.copy(), Y.copy()))
+        self.assertNotEqual(CCF["trainingFingerprint"], trainingFingerprint(X.iloc[::-1], Y))
+
+    def test_out_of_bag_stats_only_kept_for_warm_start(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(bBagTrees=True), do_parallel=False, bOutOfBagPreds=True)
+        self.assertNotIn("oobStats", CCF)
+        self.assertIn("outOfBagError", CCF)
+        self.assertEqual(CCF["outOfBagPreds"].shape[0], X.shape[0])
+        with self.assertRaises(AssertionError):
+            extendCCF(CCF, X, Y, 2, do_parallel=False)
+
+        folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(saveCCF(CCF, folder), 'header.json')) as f:
+                self.assertNotIn("oobStats", json.load(f)["CCF"])
+        finally:
+            shutil.rmtree(folder)
+
+        CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        self.assertEqual(CCF["oobStats"]["nOOb"].shape[0], X.shape[0])
+
+    def test_timeout_returns_partial_forest(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=200, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False, timeout=0)
+
+        # At least one tree is always grown, and the forest can be used and
+        # extended as usual
+        self.assertGreaterEqual(len(CCF["Trees"]), 1)
+        self.assertLess(len(CCF["Trees"]), 200)
+        predicts, _, _ = predictFromCCF(CCF, X)
+        self.assertEqual(len(predicts), X.shape[0])
+
+        nTrees = len(CCF["Trees"])
+        CCF = extendCCF(CCF, X, Y, 3, do_parallel=False)
+        self.assertEqual(len(CCF["Trees"]), nTrees + 3)
+
+    def test_tree_waves_converge(self):
+        X, Y = makeData()
+        optionsFor = defaultOptions(treeWaveSize=5, treeWaveTolerance=0.02, treeWavePatience=2)
+        CCF = genCCF(X, Y, nTrees=500, optionsFor=optionsFor, do_parallel=False)
+
+        waves = CCF["treeWaves"]
+        self.assertTrue(waves["bConverged"])
+        self.assertLess(len(CCF["Trees"]), 500)
+        self.assertEqual(waves["nTrees"][-1], len(CCF["Trees"]))
+        self.assertEqual(waves["nTrees"], list(range(5, len(CCF["Trees"]) + 1, 5)))
+
+    def test_compression_within_tolerance(self):
+        X, Y = makeData()
+        XHeld, _ = makeData(N=200, seed=1)
+        CCF = genCCF(X, Y, nTrees=30, optionsFor=defaultOptions(), do_parallel=False)
+        _, probs, _ = predictFromCCF(CCF, XHeld)
+
+        compressed = compressCCF(CCF, XHeld, tol=0.02)
+        self.assertLess(len(compressed["Trees"]), 30)
+        self.assertLessEqual(compressed["compression"]["deviation"], 0.02)
+        _, compressedProbs, _ = predictFromCCF(compressed, XHeld)
+        self.assertLessEqual(np.mean(np.absolute(compressedProbs - probs)), 0.02 + 1e-12)
+
+        # Pruning keeps the same trees and the class each tree predicts
+        pruned = compressCCF(CCF, XHeld, tol=0.02, bPrune=True)
+        self.assertEqual(list(pruned["Trees"].keys()), list(compressed["Trees"].keys()))
+        np.testing.assert_array_equal(np.argmax(treeOutputs(pruned, XHeld), axis=2), np.argmax(treeOutputs(compressed, XHeld), axis=2))
+
+    def test_early_exit_matches_full_forest(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=20, optionsFor=defaultOptions(), do_parallel=False)
+        predicts, _, _ = predictFromCCF(CCF, X)
+        exitPredicts, _, nTreesUsed = predictFromCCFEarlyExit(CCF, X, batchSize=2)
+
+        np.testing.assert_array_equal(predicts, exitPredicts)
+        self.assertTrue(np.all(nTreesUsed <= 20))
+        self.assertTrue(np.any(nTreesUsed < 20))
+
+    def test_executors_match_serial(self):
+        X, Y = makeData()
+        serial  = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(), executor=tree_executors.SerialExecutor())
+        thread  = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(), executor=tree_executors.ThreadExecutor(3))
+        process = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(), executor=tree_executors.ProcessExecutor(2))
+        named   = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(), executor=tree_executors.getTreeExecutor('process', nJobs=2))
+        with TreeWorkers() as workers:
+            remote = tree_executors.RemoteExecutor([workers.address, workers.address], authkey=workers.authkey)
+            remote = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(), executor=remote)
+
+        for CCF in [thread, process, named, remote]:
+            self.assertEqual(list(CCF["Trees"].keys()), list(serial["Trees"].keys()))
+            for pos in serial["Trees"]:
+                self.assertTrue(sameTrees(serial["Trees"][pos], CCF["Trees"][pos]))
+
+    def test_parallel_fit_many_trees(self):
+        # Enough trees for the process pool to be sent several per worker
+        nTrees = 8 * mp.cpu_count() + 1
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=nTrees, optionsFor=defaultOptions(), do_parallel=True)
+
+        self.assertEqual(len(CCF["Trees"]), nTrees)
+        self.assertEqual(list(CCF["Trees"].keys()), list(range(nTrees)))
+
+    def test_remote_cancel_stops_tasks(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'finished')
+            with TreeWorkers() as workers:
+                executor = tree_executors.RemoteExecutor([workers.address], authkey=workers.authkey)
+                executor.start(sleepThenTouch, {}, [(1.0, path)])
+                self.assertIsNone(executor.next(timeout=0.3))
+
+                startTime = time.time()
+                executor.stop(bCancel=True)
+                self.assertLess(time.time() - startTime, 0.5)
+                self.assertFalse(any([thread.is_alive() for thread in executor._threads]))
+
+                time.sleep(1.5)
+                self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_thread_cancel_stops_trees(self):
+        X, Y = makeData()
+        splitNode = grow_CCT.splitNode
+        nodeTimes = []
+        def slowSplitNode(*args, **kwargs):
+            time.sleep(0.02)
+            nodeTimes.append(time.time())
+            return splitNode(*args, **kwargs)
+
+        # With a single thread the second tree starts as the first finishes,
+        # after the timeout, and must stop at its next node once cancelled
+        with mock.patch.object(grow_CCT, 'splitNode', side_effect=slowSplitNode):
+            CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(), timeout=0.1, executor=tree_executors.ThreadExecutor(1))
+            nNodes = len(nodeTimes)
+            time.sleep(0.5)
+        self.assertEqual(len(CCF["Trees"]), 1)
+        self.assertLessEqual(len(nodeTimes) - nNodes, 1)
+
+    def test_invalid_executor_settings(self):
+        with self.assertRaises(ValueError):
+            tree_executors.getTreeExecutor('gpu')
+        with self.assertRaises(ValueError):
+            tree_executors.getTreeExecutor('remote', remoteWorkers='')
+        with self.assertRaises(ValueError):
+            tree_executors.RemoteExecutor('localhost:1', authkey='').start(sleepThenTouch, {}, [])
+
+    def test_backends_match_rotated_trees(self):
+        # Data in Fortran order as the process backend copies it to C order
+        X, Y = makeData(N=1000, D=20)
+        X = np.asfortranarray(X.to_numpy())
+        for treeRotation in ['random', 'pca']:
+            serial  = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(treeRotation=treeRotation), do_parallel=False)
+            process = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(treeRotation=treeRotation), do_parallel=True)
+            for pos in serial["Trees"]:
+                self.assertTrue(sameTrees(serial["Trees"][pos], process["Trees"][pos]), treeRotation)
+
+    def test_class_indicator_cca_ill_conditioned(self):
+        rng = np.random.RandomState(0)
+        processes = {'CCA': True, 'CCAclasswise': False, 'Original': False, 'Random': False, 'PCA': False}
+        for cond in [1e4, 1e6]:
+            rotation, _ = np.linalg.qr(rng.randn(6, 6))
+            X = np.dot(rng.randn(500, 6) * np.logspace(0, -np.log10(cond), 6), rotation)
+            Y = np.eye(3)[np.arange(500) % 3]
+
+            # Scaled indicators are not recognised as such, so take the
+            # general QR path.  Whitening X'X squares the condition number,
+            # so the coefficients are less accurate than the projections.
+            A, _, U, _, r = component_analysis.componentAnalysis(X, Y, dict(processes), 1e-10)
+            AQR, _, UQR, _, rQR = component_analysis.componentAnalysis(X, 2 * Y, dict(processes), 1e-10)
+
+            self.assertEqual(A.shape, AQR.shape)
+            sign = np.sign(np.sum(A * AQR, axis=0))
+            np.testing.assert_allclose(U, UQR * sign, atol=1e-8)
+            np.testing.assert_allclose(A, AQR * sign, atol=1e-4)
+            np.testing.assert_allclose(r, rQR, atol=1e-4)
+
+    def test_missing_values_filled_per_tree(self):
+        X, Y = makeData()
+        for treeRotation in ['none', 'random']:
+            optionsFor = defaultOptions(missingValuesMethod='random', treeRotation=treeRotation)
+            CCF = genCCF(X, Y, nTrees=5, optionsFor=optionsFor, do_parallel=False)
+            XTest = X.iloc[0:20, :].copy()
+            XTest.iloc[::2, 0] = np.nan
+
+            np.random.seed(1)
+            outputs = treeOutputs(CCF, XTest)
+
+            # Replay the draws, the rows with missing values being filled
+            # anew for each tree in turn
+            XProc = replicateInputProcess(XTest, CCF["inputProcessDetails"])
+            bMissing = np.any(np.isnan(XProc), axis=1)
+            self.assertTrue(np.any(bMissing))
+            np.random.seed(1)
+            for n, tree in enumerate(CCF["Trees"].values()):
+                XTree = np.array(XProc)
+                XTree[bMissing, :] = random_missing_vals(XProc[bMissing, :])
+                expected, _ = traverse_tree_predict(tree, XTree)
+                np.testing.assert_allclose(outputs[:, n, :], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
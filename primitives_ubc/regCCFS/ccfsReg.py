@@ -15,6 +15,7 @@ from primitives_ubc.config_files import config
 # Import relevant libraries
 import os
 import time
+import tempfile
 import logging
 import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
@@ -23,7 +24,11 @@ from typing import Any, cast, Dict, List, Union, Sequence, Optional, Tuple
 
 # Import CCFs functions
 from primitives_ubc.regCCFS.src.generate_CCF import genCCF
+from primitives_ubc.regCCFS.src.generate_CCF import extendCCF
+from primitives_ubc.regCCFS.src.training_utils.tree_executors import getTreeExecutor, BACKENDS
 from primitives_ubc.regCCFS.src.predict_from_CCF import predictFromCCF
+from primitives_ubc.regCCFS.src.utils.persistUtils import saveCCF, loadCCF
+from primitives_ubc.regCCFS.src.utils.ccfUtils import trainingFingerprint
 
 __all__ = ('CanonicalCorrelationForestsRegressionPrimitive',)
 logger  = logging.getLogger(__name__)
@@ -34,6 +39,7 @@ Outputs = container.DataFrame
 
 class Params(params.Params):
     CCF_: Optional[Dict]
+    CCF_path: Optional[str]
     attribute_columns_names: Optional[List[str]]
     target_columns_metadata: Optional[List[OrderedDict]]
     target_columns_names: Optional[List[str]]
@@ -57,11 +63,54 @@ class Hyperparams(hyperparams.Hyperparams):
                         'https://metadata.datadrivendiscovery.org/types/ResourcesUseParameter',
         ],
     )
+    treeWaveSize = hyperparams.Hyperparameter[int](
+        default=0,
+        description="If positive, trees are grown in waves of this many and growth stops before nTrees once the forest has converged, see treeWaveTolerance.  The number of trees grown is that of the fitted forest.  0 always grows nTrees trees.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    treeWaveTolerance = hyperparams.Hyperparameter[float](
+        default=1.0e-03,
+        description="Growth in waves stops once, for treeWavePatience consecutive waves, the out of bag error improves by less than this, or if bagging is not used, the averaged predictions for a sample of the training points change by less than this on average.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    treeWavePatience = hyperparams.UniformInt(
+        lower=1,
+        upper=100,
+        default=3,
+        description="Number of consecutive waves below treeWaveTolerance after which growth stops, see treeWaveSize.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    warmStart = hyperparams.UniformBool(
+        default=False,
+        description="If the primitive already holds a forest, e.g. from set_params, grow only the trees needed to reach nTrees and append them to it instead of retraining from scratch.  The new trees use the options and input processing stored in the existing forest.  The forest then also keeps the out of bag totals of each training point needed to add trees, so warmStart must also be set for the fit that grows the forest to be extended.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    paramsFolder = hyperparams.Hyperparameter[str](
+        default='',
+        description="If set, get_params saves the fitted forest to a new sub-folder of this folder in a compact format (.npy arrays plus a JSON header) and returns its path instead of the forest itself.  set_params then memory maps the saved arrays, so loading is fast and processes scoring with the same forest share its memory.  The saved files must be kept for as long as the parameters are in use.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
     parallelprocessing = hyperparams.UniformBool(
         default=True,
         description="Use multi-cpu processing.",
         semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
     )
+    backend = hyperparams.Enumeration[str](
+        values=BACKENDS,
+        default='process',
+        description="How the trees are grown when parallelprocessing is true (otherwise they are grown one after another).  'serial' grows them one after another, 'thread' on a pool of n_jobs threads sharing the training data, 'process' on a pool of n_jobs processes sharing the training data through memory-mapped files, and 'remote' on the workers listed in remoteWorkers.  The forest is the same whichever is used.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    n_jobs = hyperparams.Hyperparameter[int](
+        default=-1,
+        description="Number of threads or processes used to grow the trees, all of the cpus if below 1.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ResourcesUseParameter']
+    )
+    remoteWorkers = hyperparams.Hyperparameter[str](
+        default='',
+        description="Comma separated host:port addresses of the workers used by the 'remote' backend.  Each is started with 'python -m primitives_ubc.regCCFS.src.training_utils.tree_executors host:port' and is sent one tree at a time, so an address can be listed several times to grow several trees on it at once.  Workers and primitive authenticate with the key in the environment variable CCFS_WORKER_AUTHKEY and, as data is sent pickled, should only be reachable from trusted hosts.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
     lambda_ = hyperparams.Enumeration[str](
         values=['log', 'sqrt', 'all'],
         default='log',
@@ -126,6 +175,54 @@ class Hyperparams(hyperparams.Hyperparams):
         description="Tolerance parameter for rank reduction during the CCA. It can be desirable to lower if the data has extreme correlation, in which this finite value could eliminate the true signal",
         semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
     )
+    ccaMethod = hyperparams.Enumeration[str](
+        values=['qr', 'covariance'],
+        default='qr',
+        description="How the CCA is calculated at each node.  'qr' uses a pivoted QR decomposition of the node's data.  'covariance' keeps sufficient statistics (sums and cross products over all features) for each node, calculating those of the smaller child directly and its sibling by subtraction, so the CCA costs are independent of the number of points.  'covariance' is only used when CCA is the only projection and neither projection bootstrapping nor bRCCA are in use, and requires memory quadratic in the number of features.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    ccaSketch = hyperparams.Enumeration[str](
+        values=['none', 'gaussian', 'countsketch'],
+        default='none',
+        description="Randomized sketch of the features used for the component analysis of wide nodes, e.g. with lambda_='all' on data with many expanded categorical features.  'gaussian' uses a dense Gaussian projection and 'countsketch' a sparse random hashing of the features.  Nodes with no more than ccaSketchSize selected features or points use the exact analysis.  Not used with bRCCA, or for nodes using ccaMethod='covariance'.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    ccaSketchSize = hyperparams.UniformInt(
+        lower=2,
+        upper=100000,
+        default=256,
+        description="Number of features the sketch reduces to when ccaSketch is used.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    histogramSplitMinPoints = hyperparams.Hyperparameter[int](
+        default=0,
+        description="Nodes with more points than this search for splits approximately, evaluating the mse criterion only between histogramSplitBins quantile bins of each projection rather than between every pair of points.  0 always uses the exact search.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    histogramSplitBins = hyperparams.UniformInt(
+        lower=2,
+        upper=65536,
+        default=256,
+        description="Number of quantile bins used by the approximate split search, see histogramSplitMinPoints.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    maxPointsForProjection = hyperparams.Hyperparameter[int](
+        default=0,
+        description="Nodes with more points than this estimate their projections from a random subsample of this many of them, which are then applied to all of the node's points for the split search.  Bounds the cost of the projection at large nodes.  0 always uses all points.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    categoricalEncoding = hyperparams.Enumeration[str](
+        values=['onehot', 'codes'],
+        default='onehot',
+        description="How categorical features are held during training.  'onehot' expands them into dense z-scored indicator columns, 'codes' keeps them as integer category codes and only forms the indicator columns of the features selected at each node, so memory stays proportional to the number of original features.  Tree rotations still use the dense expansion.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    precision = hyperparams.Enumeration[str](
+        values=['float64', 'float32'],
+        default='float64',
+        description="Floating point precision of the processed inputs and of the fitted forest.  'float32' halves the memory of the training data and of the stored trees and speeds up prediction, while the node projections (e.g. the QR decompositions of the CCA) are still estimated in double precision.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
     mseErrorTolerance = hyperparams.Hyperparameter[float](
         default=1e-6,
         description=" When doing regression with mse splits, the node is made into a leaf if the mse (i.e. variance) of the data is less  than this tolerance times the mse of the full data set.",
@@ -133,7 +230,13 @@ class Hyperparams(hyperparams.Hyperparams):
     )
     maxDepthSplit = hyperparams.Hyperparameter[str](
         default='stack',
-        description="Maximum depth of a node when splitting is still allowed. When set to 'stack' this is set to the maximum value that prevents crashes (usually ~500 which should never really be reached in sensible scenarios)",
+        description="Maximum depth of a node when splitting is still allowed. When set to 'stack' there is no limit on the depth, trees are grown without recursion so are not limited by the stack size.",
+        semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
+    )
+    treeGrowthOrder = hyperparams.Enumeration[str](
+        values=['depthFirst', 'breadthFirst'],
+        default='depthFirst',
+        description="Order in which the nodes of each tree are split.",
         semantic_types=['https://metadata.datadrivendiscovery.org/types/ControlParameter']
     )
     XVariationTol = hyperparams.Hyperparameter[float](
@@ -304,9 +407,14 @@ class CanonicalCorrelationForestsRegressionPrimitive(SupervisedLearnerPrimitiveB
         self._training_inputs: Inputs = None
         self._training_outputs: Outputs = None
         self._CCF = {}
+        # Folder that the current forest is saved in, see get_params
+        self._CCF_path = None
         self._label_name_columns = None
         # Is the model fit on the training data
         self._fitted = False
+        # Whether the last fit grew all of the trees, see fit
+        self._has_finished    = False
+        self._iterations_done = 0
 
 
     def set_training_data(self, *, inputs: Inputs, outputs: Outputs) -> None:
@@ -332,8 +440,22 @@ class CanonicalCorrelationForestsRegressionPrimitive(SupervisedLearnerPrimitiveB
         self.optionsClassCCF['treeRotation']                = self.hyperparams['treeRotation']
         self.optionsClassCCF['propTrain']                   = self.hyperparams['propTrain']
         self.optionsClassCCF['epsilonCCA']                  = self.hyperparams['epsilonCCA']
+        self.optionsClassCCF['ccaMethod']                   = self.hyperparams['ccaMethod']
+        self.optionsClassCCF['ccaSketch']                   = self.hyperparams['ccaSketch']
+        self.optionsClassCCF['ccaSketchSize']               = self.hyperparams['ccaSketchSize']
+        self.optionsClassCCF['histogramSplitMinPoints']     = self.hyperparams['histogramSplitMinPoints']
+        self.optionsClassCCF['histogramSplitBins']          = self.hyperparams['histogramSplitBins']
+        self.optionsClassCCF['maxPointsForProjection']      = self.hyperparams['maxPointsForProjection']
+        self.optionsClassCCF['categoricalEncoding']         = self.hyperparams['categoricalEncoding']
+        self.optionsClassCCF['precision']                   = self.hyperparams['precision']
+        self.optionsClassCCF['randomSeed']                  = self._random_state
+        self.optionsClassCCF['treeWaveSize']                = self.hyperparams['treeWaveSize']
+        self.optionsClassCCF['treeWaveTolerance']           = self.hyperparams['treeWaveTolerance']
+        self.optionsClassCCF['treeWavePatience']            = self.hyperparams['treeWavePatience']
+        self.optionsClassCCF['bKeepOobStats']               = self.hyperparams['warmStart']
         self.optionsClassCCF['mseErrorTolerance']           = self.hyperparams['mseErrorTolerance']
         self.optionsClassCCF['maxDepthSplit']               = self.hyperparams['maxDepthSplit']
+        self.optionsClassCCF['treeGrowthOrder']             = self.hyperparams['treeGrowthOrder']
         self.optionsClassCCF['XVariationTol']               = self.hyperparams['XVariationTol']
         self.optionsClassCCF['RotForM']                     = self.hyperparams['RotForM']
         self.optionsClassCCF['RotForpS']                    = self.hyperparams['RotForpS']
@@ -355,13 +477,40 @@ class CanonicalCorrelationForestsRegressionPrimitive(SupervisedLearnerPrimitiveB
         self.optionsClassCCF['mseTotal']                    = np.array([])
 
 
+    def _create_tree_executor(self):
+        """
+        Executor used to grow the trees, see tree_executors.
+        """
+        if not self.hyperparams['parallelprocessing']:
+            return getTreeExecutor('serial')
+
+        return getTreeExecutor(self.hyperparams['backend'], nJobs=self.hyperparams['n_jobs'], remoteWorkers=self.hyperparams['remoteWorkers'])
+
+
     def fit(self, *, timeout: float = None, iterations: int = None) -> base.CallResult[None]:
         """
         Inputs: ndarray of features
         Returns: None
+
+        Grows the forest.  If timeout is given, the trees finished when it
+        is reached are kept and the rest cancelled, in which case the forest
+        is usable but has fewer than nTrees trees and has_finished is false.
+        Calling fit again then grows the remaining trees.  iterations_done
+        is the number of trees in the forest.
         """
-        if self._fitted:
-            return CallResult(None)
+        startTime = time.time()
+
+        # Existing forests are added to when warm starting or when the
+        # previous fit timed out
+        bExtend = bool(self._CCF) and (self.hyperparams['warmStart'] or (self._fitted and not self._has_finished))
+
+        # Number of trees to add to an existing forest
+        nNewTrees = 0
+        if bExtend:
+            nNewTrees = self.hyperparams['nTrees'] - len(self._CCF["Trees"])
+
+        if self._fitted and (nNewTrees <= 0):
+            return CallResult(None, has_finished=self._has_finished, iterations_done=self._iterations_done)
 
         if self._training_inputs is None or self._training_outputs is None:
             raise exceptions.InvalidStateError("Missing training data.")
@@ -370,13 +519,40 @@ class CanonicalCorrelationForestsRegressionPrimitive(SupervisedLearnerPrimitiveB
         XTrain, _ = self._select_inputs_columns(self._training_inputs)
         YTrain, _ = self._select_outputs_columns(self._training_outputs)
 
+        # Trees can only be added to a forest grown on the same data
+        if bExtend and (self._CCF.get("trainingFingerprint", None) != trainingFingerprint(XTrain, YTrain)):
+            logger.warning('Training data differs from that of the existing forest, growing a new forest instead of warm starting')
+            bExtend = False
+
+        # Time left for growing the trees
+        remainingTime = None
+        if timeout is not None:
+            remainingTime = max(0.0, timeout - (time.time() - startTime))
+            # Needed to add the remaining trees if the fit is cut short
+            self.optionsClassCCF['bKeepOobStats'] = True
+
         # Fit data
-        CCF = genCCF(XTrain, YTrain, nTrees=self.optionsClassCCF['nTrees'], bReg=True, optionsFor=self.optionsClassCCF, do_parallel=self.optionsClassCCF['parallelprocessing'])
+        if bExtend:
+            if nNewTrees > 0:
+                CCF = extendCCF(self._CCF, XTrain, YTrain, nTrees=nNewTrees, bReg=True, do_parallel=self.optionsClassCCF['parallelprocessing'], timeout=remainingTime,\
+                                executor=self._create_tree_executor())
+            else:
+                CCF = self._CCF
+        else:
+            CCF = genCCF(XTrain, YTrain, nTrees=self.optionsClassCCF['nTrees'], bReg=True, optionsFor=self.optionsClassCCF, do_parallel=self.optionsClassCCF['parallelprocessing'],\
+                         timeout=remainingTime, executor=self._create_tree_executor())
 
         self._CCF    = CCF
+        self._CCF_path = None
         self._fitted = True
+        self._iterations_done = len(CCF["Trees"])
+        # Growth in waves may stop early once the forest has converged
+        self._has_finished    = (self._iterations_done >= self.hyperparams['nTrees']) or CCF.get("treeWaves", {}).get("bConverged", False)
+        # The out of bag totals are only kept, e.g. by get_params, for warm starts
+        if self._has_finished and (not self.hyperparams['warmStart']):
+            CCF.pop("oobStats", None)
 
-        return CallResult(None)
+        return CallResult(None, has_finished=self._has_finished, iterations_done=self._iterations_done)
 
 
     def produce(self, *, inputs: Inputs, iterations: int = None, timeout: float = None) -> base.CallResult[Outputs]:
@@ -404,22 +580,43 @@ class CanonicalCorrelationForestsRegressionPrimitive(SupervisedLearnerPrimitiveB
     def get_params(self) -> Params:
         if not self._fitted:
             return Params(CCF_=None,
+                          CCF_path=None,
+                          attribute_columns_names=self._attribute_columns_names,
+                          target_columns_metadata=self._target_columns_metadata,
+                          target_columns_names=self._target_columns_names)
+
+        if self.hyperparams['paramsFolder']:
+            # Saved once per fitted forest, each to its own folder so that a
+            # forest in use elsewhere is never overwritten
+            if self._CCF_path is None:
+                os.makedirs(self.hyperparams['paramsFolder'], exist_ok=True)
+                self._CCF_path = saveCCF(self._CCF, tempfile.mkdtemp(prefix='CCF_', dir=self.hyperparams['paramsFolder']))
+
+            return Params(CCF_=None,
+                          CCF_path=self._CCF_path,
                           attribute_columns_names=self._attribute_columns_names,
                           target_columns_metadata=self._target_columns_metadata,
                           target_columns_names=self._target_columns_names)
 
         return Params(CCF_=self._CCF,
+                      CCF_path=None,
                       attribute_columns_names=self._attribute_columns_names,
                       target_columns_metadata=self._target_columns_metadata,
                       target_columns_names=self._target_columns_names)
 
 
     def set_params(self, *, params: Params) -> None:
-        self._CCF = params['CCF_']
+        self._CCF_path = params.get('CCF_path', None)
+        if self._CCF_path:
+            self._CCF = loadCCF(self._CCF_path, mmap_mode='r')
+        else:
+            self._CCF = params['CCF_']
         self._attribute_columns_names = params['attribute_columns_names']
         self._target_columns_metadata = params['target_columns_metadata']
         self._target_columns_names = params['target_columns_names']
         self._fitted = True
+        self._has_finished    = True
+        self._iterations_done = len(self._CCF["Trees"]) if self._CCF else 0
 
 
     def __getstate__(self) -> dict:
@@ -0,0 +1,86 @@
+import numpy as np
+from collections import OrderedDict
+
+from .predict_from_CCF import predictFromCCF
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def compressCCF(CCF, X, tol=0.01, maxTrees=None, chunkSize=None):
+    """
+    Compresses a forest by greedily selecting a subset of its trees whose
+    averaged predictions on X stay within tol of those of the full forest.
+    Trees are added one at a time, each time choosing the tree that brings
+    the averaged predictions closest to those of the full forest, until
+    their mean absolute difference, relative to the standard deviation of
+    each output, is at most tol or maxTrees trees have been selected.
+
+    The out of bag statistics of the full forest do not apply to the
+    selected trees, so they are not kept and no trees can be added to the
+    compressed forest with extendCCF.
+
+    Parameters
+    ----------
+    CCF: Forest as returned by genCCF
+    X:   Held out inputs, in any format accepted by predictFromCCF, on which
+         the compressed forest is compared with the full one
+    tol: Allowed mean absolute difference between the predictions of the
+         compressed and the full forest, relative to the standard deviation
+         of the training outputs
+    maxTrees: Maximum number of trees to select, defaults to all of them
+    chunkSize: Passed to predictFromCCF
+
+    Returns
+    -------
+    compressedCCF: New forest holding the selected trees in their original
+                   order, which can be used by predictFromCCF.  The field
+                   compression gives the original number of trees and the
+                   achieved difference.  CCF itself is not modified.
+    """
+    _, _, treeOutputs = predictFromCCF(CCF, X, bTreeOutputs=True, chunkSize=chunkSize)
+    # Held as nTrees x N x K so that the outputs of each tree are contiguous
+    treeOutputs = np.ascontiguousarray(np.transpose(treeOutputs, (1, 0, 2)), dtype=np.float64)
+    nTrees, N, K = treeOutputs.shape
+    # Compared in units of the standard deviation of each output
+    treeOutputs  = treeOutputs / np.reshape(CCF["options"]["org_stdY"], (1, 1, -1))
+    forestMean   = np.mean(treeOutputs, axis=0)
+    if maxTrees is None:
+        maxTrees = nTrees
+    maxTrees = max(1, min(int(maxTrees), nTrees))
+
+    # Candidate trees are scored in blocks to bound the working memory
+    blockSize = max(1, (2**24) // (N * K))
+
+    cumMean   = np.zeros((N, K))
+    bSelected = np.zeros((nTrees,), dtype=bool)
+    iSelected = []
+    deviation = np.inf
+    while (len(iSelected) < maxTrees) and (deviation > tol):
+        iCandidates = (~bSelected).nonzero()[0]
+        deviations  = np.empty((iCandidates.size,))
+        for iStart in range(0, iCandidates.size, blockSize):
+            iBlock = iCandidates[iStart:iStart+blockSize]
+            means  = (cumMean[np.newaxis, :, :] + treeOutputs[iBlock, :, :]) / (len(iSelected) + 1)
+            deviations[iStart:iStart+iBlock.size] = np.mean(np.absolute(means - forestMean[np.newaxis, :, :]), axis=(1, 2))
+
+        iBest     = np.argmin(deviations)
+        deviation = deviations[iBest]
+        bSelected[iCandidates[iBest]] = True
+        iSelected.append(iCandidates[iBest])
+        cumMean   = cumMean + treeOutputs[iCandidates[iBest], :, :]
+
+    logger.info('Selected {} of {} trees, mean absolute difference {}'.format(len(iSelected), nTrees, deviation))
+
+    keys  = list(CCF["Trees"].keys())
+    trees = OrderedDict()
+    for iTree in sorted(iSelected):
+        trees[keys[iTree]] = CCF["Trees"][keys[iTree]]
+
+    compressedCCF = {key: value for key, value in CCF.items() if key not in ["Trees", "stackedTrees", "oobStats", "outOfBagPreds", "outOfBagCounts"]}
+    compressedCCF["Trees"] = trees
+    compressedCCF["outOfBagError"] = 'OOB error not available for compressed forests.'
+    compressedCCF["compression"] = {"nTreesOriginal": nTrees, "deviation": float(deviation)}
+
+    return compressedCCF
+
@@ -1,9 +1,11 @@
 import numpy as np
-from primitives_ubc.regCCFS.src.predict_from_CCT import predictFromCCT
+import pandas as pd
+from primitives_ubc.regCCFS.src.utils.flatTreeUtils import stackTrees
+from primitives_ubc.regCCFS.src.prediction_utils.traverse_forestPredict import traverse_forest_predict_missing
 from primitives_ubc.regCCFS.src.prediction_utils.replicate_input_process import replicateInputProcess
-from primitives_ubc.regCCFS.src.prediction_utils.tree_output_forest_pred import treeOutputsToForestPredicts
+from primitives_ubc.regCCFS.src.prediction_utils.tree_output_forest_pred import forestMeanToForestPredicts
 
-def predictFromCCF(CCF, X):
+def predictFromCCF(CCF, X, bTreeOutputs=False, chunkSize=None):
     """
     Parameters
     ----------
@@ -11,6 +13,11 @@ def predictFromCCF(CCF, X):
         Trees, giving a cell array of tree structures, and
         options which is an object of type optionsClassCCF
     X:  Input features at which to make predictions, each row should be a seperate data point
+    bTreeOutputs: If true, the individual tree outputs are also returned.  These
+                  take N x L x K memory so are not kept by default.
+    chunkSize: Number of rows of X processed at a time.  By default this is
+               chosen so that the tree outputs of a chunk have at most 2**24
+               elements.
 
     Returns
     -------
@@ -33,19 +40,43 @@ def predictFromCCF(CCF, X):
                  trees and K is the number of predictions.  K=1 for
                  regression, K = number of classes for classification, and
                  for regression then each output is concatenated in the third dimension.
+                 None unless bTreeOutputs is true.
     """
-    X = replicateInputProcess(X, CCF["inputProcessDetails"])
+    # All trees are evaluated together, one chunk of rows at a time.  Forests
+    # loaded by loadCCF are already stacked.
+    stackedTrees = CCF.get("stackedTrees", None)
+    if stackedTrees is None:
+        stackedTrees = stackTrees(CCF["Trees"])
+    nTrees = stackedTrees["nTrees"]
+    K      = stackedTrees["mean"].shape[1]
+    N      = X.shape[0]
+    if chunkSize is None:
+        chunkSize = max(1, (2**24) // (nTrees * K))
 
-    nTrees = len(CCF["Trees"])
+    forestMean = np.empty((N, K))
+    if bTreeOutputs:
+        treeOutputs = np.empty((N, nTrees, K), dtype=stackedTrees["mean"].dtype)
+    else:
+        treeOutputs = None
 
-    # Preallocate output space
-    pcctx0 = predictFromCCT(CCF["Trees"][0], X)
-    pcctx0 = np.expand_dims(pcctx0, axis=1)
-    treeOutputs = np.tile(pcctx0, [1, nTrees, 1])
+    for iStart in range(0, N, chunkSize):
+        iChunk = slice(iStart, min(iStart+chunkSize, N))
+        if isinstance(X, pd.DataFrame):
+            XChunk = X.iloc[iChunk, :]
+        else:
+            XChunk = X[iChunk, :]
 
-    for n in range(1, nTrees):
-        treeOutputs[:, n, :] = predictFromCCT(CCF["Trees"][n], X)
+        XChunk = replicateInputProcess(XChunk, CCF["inputProcessDetails"])
+        # Evaluated in the precision that the forest is stored in
+        XChunk = XChunk.astype(stackedTrees["decisionProjection"].dtype, copy=False)
 
-    forestPredicts, forestProbs = treeOutputsToForestPredicts(CCF, treeOutputs)
+        # Any values left as NaN are randomly assigned, separately by each
+        # tree
+        chunkOutputs, _ = traverse_forest_predict_missing(stackedTrees, XChunk)
+        forestMean[iChunk, :] = np.mean(chunkOutputs, axis=1)
+        if bTreeOutputs:
+            treeOutputs[iChunk, :, :] = chunkOutputs
+
+    forestPredicts, forestProbs = forestMeanToForestPredicts(CCF, forestMean)
 
     return forestPredicts, forestProbs, treeOutputs
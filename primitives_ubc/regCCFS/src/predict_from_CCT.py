@@ -2,21 +2,23 @@ from primitives_ubc.regCCFS.src.utils.ccfUtils import random_missing_vals
 from primitives_ubc.regCCFS.src.prediction_utils.traverse_treePredict import traverse_tree_predict
 from primitives_ubc.regCCFS.src.prediction_utils.replicate_input_process import replicateInputProcess
 
-def predictFromCCT(tree, X):
+def predictFromCCT(tree, X, bLeafIds=False):
     """
     predictFromCCT predicts output using trained tree
 
     Parameters
     ----------
-    tree: output strcut from growTree
+    tree: output strcut from growTree, either flat or nested
     X: processed input features
+    bLeafIds: If true, also return the index of the assigned leaf node
 
     Returns
     -------
     leaf_mean:  Mean of outputs present at the leaf.
                 For classification then this represents the class
                 probability, for regression it is simply the output mean.
-    leaf_node:  The full leaf node details for the assigned point.
+    leaf_node:  Index of the assigned leaf node in the flat tree, only
+                returned if bLeafIds is true.
     """
     if 'inputProcessDetails' in tree.keys():
         X = replicateInputProcess(X, tree["inputProcessDetails"])
@@ -24,6 +26,9 @@ def predictFromCCT(tree, X):
     # Any values left as NaN now need to be randomly assigned
     X = random_missing_vals(X)
 
-    leaf_mean = traverse_tree_predict(tree, X)
+    leaf_mean, leaf_node = traverse_tree_predict(tree, X)
+
+    if bLeafIds:
+        return leaf_mean, leaf_node
 
     return leaf_mean
@@ -2,13 +2,16 @@ import numpy as np
 import pandas as pd
 from primitives_ubc.regCCFS.src.utils.commonUtils import is_numeric
 from primitives_ubc.regCCFS.src.utils.commonUtils import makeSureString
+from primitives_ubc.regCCFS.src.utils.commonUtils import expandCategoricalCodes
+from primitives_ubc.regCCFS.src.utils.categoricalUtils import CategoricalMatrix
 
-def replicateInputProcess(Xraw, InputProcessDetails):
+def replicateInputProcess(Xraw, InputProcessDetails, bExpandCategoricals=True):
     """
     This can be used to create an anonymous function that applies the same
     data transformation as was done by on the training data to new data.
     InputProcessDetails is the structure output from processInputData and
-    stored in the forest.
+    stored in the forest.  If bExpandCategoricals is False, any categorical
+    features are returned as a CategoricalMatrix rather than expanded.
     """
     bOrdinal = InputProcessDetails["bOrdinal"]
     Cats     = InputProcessDetails["Cats"]
@@ -23,8 +26,8 @@ def replicateInputProcess(Xraw, InputProcessDetails):
         # values
         X = Xraw.loc[:, bOrdinal]
         bNumeric = is_numeric(X, compress=False)
-        bNumeric = pd.DataFrame(bNumeric, dtype=type(True))
-        X.iloc[~bNumeric] = np.nan
+        if not np.all(bNumeric):
+            X = X.where(bNumeric)
         X = X.to_numpy(dtype=float)
     else:
         X = Xraw[:, bOrdinal]
@@ -33,17 +36,25 @@ def replicateInputProcess(Xraw, InputProcessDetails):
     if isinstance(Xraw, pd.DataFrame) and XCat_exist:
         XCat = Xraw.loc[:, ~bOrdinal]
         XCat = makeSureString(XCat, nSigFigTol=10)
-        # Expand the categorical features
-        for n in range(XCat.shape[1]):
-            cats_unique = Cats[n]
-            nCats = len(cats_unique)
-            # This is setup so that any trivial features are not included
-            if nCats==1:
-                continue
-            sizeSoFar = X.shape[1]
-            X = np.concatenate((X, np.zeros((X.shape[0], nCats))), axis=1)
-            for c in range(nCats):
-                X[XCat.iloc[:, n] == cats_unique[c], (sizeSoFar+c)] = 1;
+        # Encode by the index of each value in the training categories,
+        # unseen categories being given -1 so that none of their columns are
+        # set.  Trivial features with a single category are not included.
+        nCats   = np.array([len(Cats[n]) for n in range(XCat.shape[1])], dtype=int)
+        iExpand = (nCats > 1).nonzero()[0]
+        codes   = np.zeros((XCat.shape[0], iExpand.size), dtype=int)
+        for m, n in enumerate(iExpand):
+            codes[:, m] = pd.Index(Cats[n]).get_indexer(XCat.iloc[:, n])
+        if bExpandCategoricals or (iExpand.size == 0):
+            X = np.concatenate((X, expandCategoricalCodes(codes, nCats[iExpand])), axis=1)
+        else:
+            nOrd = X.shape[1]
+            D    = nOrd + np.sum(nCats[iExpand])
+            mu   = np.broadcast_to(InputProcessDetails["mu_XTrain"],  (D,))
+            std  = np.broadcast_to(InputProcessDetails["std_XTrain"], (D,))
+            X = np.divide(np.subtract(X, mu[0:nOrd]), std[0:nOrd])
+            if InputProcessDetails["bNaNtoMean"]:
+                X[np.isnan(X)] = 0
+            return CategoricalMatrix(X, codes.astype(np.int32), nCats[iExpand], mu[nOrd:], std[nOrd:])
 
     # Normalize feature vectors
     X = np.divide(np.subtract(X, InputProcessDetails["mu_XTrain"]), InputProcessDetails["std_XTrain"])
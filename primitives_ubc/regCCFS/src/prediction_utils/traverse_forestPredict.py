@@ -0,0 +1,173 @@
+import numpy as np
+from primitives_ubc.regCCFS.src.utils.ccfUtils import random_missing_vals
+from primitives_ubc.regCCFS.src.utils.flatTreeUtils import stackTrees
+from primitives_ubc.regCCFS.src.prediction_utils.traverse_treePredict import nodeProjection
+
+
+#-----------------------------------------------------------------------------#
+def rotateForestInputs(stackedTrees, X):
+    """
+    Applies the rotation of every tree to X in one batched matrix product.
+    X is either N x D or L x N x D with separate inputs for each tree.
+    Returns a (G, N, D) array of inputs and the index of the input space used
+    by each tree, G = 1 if no tree is rotated and X is shared.
+    """
+    if X.ndim == 2:
+        if not ('rotR' in stackedTrees):
+            return X[np.newaxis, :, :], np.zeros((stackedTrees["nTrees"],), dtype=np.int32)
+        X = X[np.newaxis, :, :]
+    elif not ('rotR' in stackedTrees):
+        return X, np.arange(stackedTrees["nTrees"], dtype=np.int32)
+
+    XRot = np.matmul(np.subtract(X, stackedTrees["rotMu"][:, np.newaxis, :]), stackedTrees["rotR"])
+
+    return XRot, np.arange(stackedTrees["nTrees"], dtype=np.int32)
+
+#-----------------------------------------------------------------------------#
+def depthProjectionMatrix(stackedTrees, nodes, D):
+    """
+    Dense D x nNodes matrix whose columns are the decision projections of
+    the given nodes, so that a single matmul projects X onto all of them.
+    """
+    W = np.zeros((D, nodes.size), dtype=stackedTrees["decisionProjection"].dtype)
+    cols = np.repeat(np.arange(nodes.size)[np.newaxis, :], stackedTrees["iIn"].shape[1], axis=0).T
+    np.add.at(W, (stackedTrees["iIn"][nodes, :], cols), stackedTrees["decisionProjection"][nodes, :])
+
+    return W
+
+#-----------------------------------------------------------------------------#
+def traverse_forest_block(stackedTrees, X, denseFactor):
+    """
+    Routes every row of X through every tree of the forest together, see
+    traverse_forest_predict.  Returns the NxL array of assigned leaves.
+    """
+    N, D   = X.shape[-2:]
+    nTrees = stackedTrees["nTrees"]
+    nNodes = stackedTrees["bLeaf"].size
+    bLeaf  = stackedTrees["bLeaf"]
+    maxIn  = stackedTrees["iIn"].shape[1]
+    XSpace, iSpace = rotateForestInputs(stackedTrees, X)
+    # Whether the trees see different inputs, in which case the projections
+    # are always gathered from each tree's own input space
+    bRotated = (X.ndim == 3) or ('rotR' in stackedTrees)
+
+    # Pairs are indexed as tree * N + row, keeping the pairs of one tree
+    # together for locality of the node arrays
+    leaf_node = np.repeat(stackedTrees["roots"], N)
+    iActive   = (~bLeaf[leaf_node]).nonzero()[0]
+    nodes     = leaf_node[iActive]
+    while iActive.size > 0:
+        iRows = iActive % N
+
+        bNodeAtDepth = np.bincount(nodes, minlength=nNodes) > 0
+        bRowAtDepth  = np.bincount(iRows, minlength=N) > 0
+        nodesAtDepth = bNodeAtDepth.nonzero()[0]
+        rowsAtDepth  = bRowAtDepth.nonzero()[0]
+        bDense = (not bRotated) and\
+                 (rowsAtDepth.size * D * nodesAtDepth.size <= denseFactor * iActive.size * maxIn)
+
+        if bDense:
+            # Position of each node/row within those present at this depth
+            nodePos = np.cumsum(bNodeAtDepth) - 1
+            rowPos  = np.cumsum(bRowAtDepth) - 1
+            W = depthProjectionMatrix(stackedTrees, nodesAtDepth, D)
+            P = np.dot(X[rowsAtDepth, :], W)
+            U = P[rowPos[iRows], nodePos[nodes]]
+        elif not bRotated:
+            iX = np.take(stackedTrees["iIn"], nodes, axis=0) + (iRows * D)[:, np.newaxis]
+            U  = np.einsum('ij,ij->i', np.take(X, iX), np.take(stackedTrees["decisionProjection"], nodes, axis=0))
+        else:
+            iTrees = iSpace[iActive // N]
+            XNodes = XSpace[iTrees[:, np.newaxis], iRows[:, np.newaxis], stackedTrees["iIn"][nodes, :]]
+            U = np.einsum('ij,ij->i', XNodes, stackedTrees["decisionProjection"][nodes, :])
+
+        # Nodes using random feature expansion are evaluated one by one
+        for node in nodesAtDepth[stackedTrees["bExpanded"][nodesAtDepth]]:
+            bThisNode = (nodes == node)
+            XThis = XSpace[iSpace[iActive[bThisNode][0] // N], iRows[bThisNode], :]
+            U[bThisNode] = np.ravel(nodeProjection(stackedTrees, node, XThis))
+
+        nodes = np.where(U <= stackedTrees["paritionPoint"][nodes], stackedTrees["lessthanChild"][nodes], stackedTrees["greaterthanChild"][nodes])
+
+        # Record the pairs that have reached a leaf and drop them
+        bDone = bLeaf[nodes]
+        leaf_node[iActive[bDone]] = nodes[bDone]
+        iActive = iActive[~bDone]
+        nodes   = nodes[~bDone]
+
+    return leaf_node.reshape((nTrees, N)).T
+
+#-----------------------------------------------------------------------------#
+def traverse_forest_predict(stackedTrees, X, denseFactor=8, maxPairs=2**18):
+    """
+    Routes every row of X through every tree of the forest together.  At
+    each iteration all (row, tree) pairs that have not reached a leaf are at
+    the same depth.  The projections at that depth are either computed with
+    one matmul against the stacked projection matrix of all nodes at that
+    depth or, when that would be more expensive, with a single gather of the
+    padded features and weights of each pair's node.
+
+    Parameters
+    ----------
+    stackedTrees: Output of stackTrees, or a dict/list of trees
+    X:            Processed input features with no missing values, either
+                  N x D for all trees or L x N x D giving separate inputs for
+                  each tree
+    denseFactor:  Relative cost of a gathered multiply-add to one done as
+                  part of a matmul, used to choose between the two methods
+    maxPairs:     Rows are processed in blocks of at most this many
+                  (row, tree) pairs to keep the working arrays in cache
+
+    Returns
+    -------
+    treeOutputs: NxLxK array of the leaf means of each tree
+    leaf_node:   NxL array of the stacked index of the assigned leaves
+    """
+    if not stackedTrees.get("bStacked", False):
+        stackedTrees = stackTrees(stackedTrees)
+
+    X = np.ascontiguousarray(X)
+    N = X.shape[-2]
+    blockSize = max(1, maxPairs // stackedTrees["nTrees"])
+    leaf_node = np.empty((N, stackedTrees["nTrees"]), dtype=np.int32)
+    for iStart in range(0, N, blockSize):
+        leaf_node[iStart:(iStart+blockSize), :] = traverse_forest_block(stackedTrees, X[..., iStart:(iStart+blockSize), :], denseFactor)
+
+    treeOutputs = stackedTrees["mean"][leaf_node, :]
+
+    return treeOutputs, leaf_node
+
+#-----------------------------------------------------------------------------#
+def traverse_forest_predict_missing(stackedTrees, X, maxElements=2**24):
+    """
+    As traverse_forest_predict, but X may still contain missing values,
+    given as NaN.  These are randomly assigned separately for every tree, as
+    when each tree predicts on its own, so the rows with missing values are
+    passed with a copy for each tree, in blocks of at most maxElements
+    values.  Rows without missing values are shared by all trees.
+    """
+    if not stackedTrees.get("bStacked", False):
+        stackedTrees = stackTrees(stackedTrees)
+
+    bMissing = np.any(np.isnan(X), axis=1)
+    if not np.any(bMissing):
+        return traverse_forest_predict(stackedTrees, X)
+
+    N, D   = X.shape
+    nTrees = stackedTrees["nTrees"]
+    leaf_node = np.empty((N, nTrees), dtype=np.int32)
+
+    iComplete = (~bMissing).nonzero()[0]
+    if iComplete.size > 0:
+        _, leaf_node[iComplete, :] = traverse_forest_predict(stackedTrees, X[iComplete, :])
+
+    iMissing  = bMissing.nonzero()[0]
+    blockSize = max(1, maxElements // (nTrees * D))
+    for iStart in range(0, iMissing.size, blockSize):
+        iBlock = iMissing[iStart:(iStart+blockSize)]
+        XTrees = np.stack([random_missing_vals(X[iBlock, :]) for _ in range(nTrees)])
+        _, leaf_node[iBlock, :] = traverse_forest_predict(stackedTrees, XTrees)
+
+    treeOutputs = stackedTrees["mean"][leaf_node, :]
+
+    return treeOutputs, leaf_node
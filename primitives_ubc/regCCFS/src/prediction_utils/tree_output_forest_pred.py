@@ -12,6 +12,21 @@ def treeOutputsToForestPredicts(CCF, treeOutputs):
                   in doc string of predictCCF as it is provided as an output.
     """
     forestPredicts = np.mean(treeOutputs, axis=1)
+
+    return forestMeanToForestPredicts(CCF, forestPredicts)
+
+
+def forestMeanToForestPredicts(CCF, forestMean):
+    """
+    Converts the tree outputs averaged over the trees to forest predictions.
+    For regression these are simply the averaged outputs.
+
+    Parameters
+    ----------
+    CCF = Output of genCCF
+    forestMean = NxK array of averaged tree outputs
+    """
+    forestPredicts = forestMean
     forestProbs = []
 
     return forestPredicts, forestProbs
@@ -1,6 +1,7 @@
 import numpy as np
 import scipy.linalg as la
 from primitives_ubc.regCCFS.src.utils.ccfUtils import randomRotation
+from primitives_ubc.regCCFS.src.utils.ccfUtils import getGenerator
 from primitives_ubc.regCCFS.src.utils.commonUtils import sVT
 from primitives_ubc.regCCFS.src.utils.commonUtils import amerge
 from primitives_ubc.regCCFS.src.utils.commonUtils import dict2array
@@ -18,12 +19,14 @@ def isSquare(x):
             return False
 
 
-def componentAnalysis(X, Y, processes, epsilon):
+def componentAnalysis(X, Y, processes, epsilon, rng=None):
     """
     Carries out a a section of component analyses on X and Y to produce a
     projection matrix projMat which maps X to its components.  Valid
     projections are CCA, PCA, CCA-classwise, Original axes and Random Rotation.
+    Any random choices are drawn from rng, see getGenerator.
     """
+    rng   = getGenerator(rng)
     probs = dict2array(X=processes) * 1
     # Sample projections to use if some set to be probabilistically used
     bToSample = np.logical_and((probs > 0), (probs < 1))
@@ -31,7 +34,7 @@ def componentAnalysis(X, Y, processes, epsilon):
         # TODO: Ignoring for now
         probs[~bToSample] = 0
         cumprobs  = probs.cumsum(axis=0)/np.sum(probs)
-        iSampled  = np.sum(np.random.rand() > cumprobs) + 1
+        iSampled  = np.sum(rng.random() > cumprobs) + 1
         iToSample = bToSample.ravel().nonzero()[0]
         for n in range(iToSample.size):
             processes[iToSample[n]] = False
@@ -85,7 +88,7 @@ def componentAnalysis(X, Y, processes, epsilon):
         projMat = np.concatenate((projMat, np.eye(x2)))
 
     if processes['Random']:
-        projMat = np.concatenate((projMat, randomRotation(N=x2)))
+        projMat = np.concatenate((projMat, randomRotation(N=x2, rng=rng)))
 
     if processes['PCA']:
         # PCA projection
@@ -217,3 +220,112 @@ def componentAnalysis(X, Y, processes, epsilon):
         B[bYvaries, :] = yprojMat
 
     return A, B, U, V, r
+
+
+#-----------------------------------------------------------------------------#
+def nodeStatistics(X, Y):
+    """
+    Sufficient statistics of the points at a node for covariance based CCA,
+    see componentAnalysisFromStats.  These are additive over points, so the
+    statistics of one child can be found by subtracting those of its
+    sibling from the parent (see subtractStatistics).
+
+    Parameters
+    ----------
+    X: N x D array of the node's inputs (all features)
+    Y: N x K array of the node's outputs
+
+    Returns
+    -------
+    stats: dict with fields n, sumX, sumY, XX = X'X, XY = X'Y and YY = Y'Y
+    """
+    # Accumulated in double precision whatever the precision of the data
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+
+    stats = {}
+    stats["n"]    = X.shape[0]
+    stats["sumX"] = np.sum(X, axis=0)
+    stats["sumY"] = np.sum(Y, axis=0)
+    stats["XX"]   = np.dot(X.T, X)
+    stats["XY"]   = np.dot(X.T, Y)
+    stats["YY"]   = np.dot(Y.T, Y)
+
+    return stats
+
+
+def subtractStatistics(parentStats, childStats):
+    """
+    Statistics of the sibling of a child, i.e. parentStats - childStats.
+    """
+    stats = {}
+    for key in parentStats.keys():
+        stats[key] = parentStats[key] - childStats[key]
+
+    return stats
+
+
+def whiteningMatrix(C, epsilon):
+    """
+    Returns W such that W'CW = I on the span of the covariance matrix C,
+    dropping directions with variance below epsilon^2 times the largest.
+    This is the equivalent of the rank reduction of the pivoted QR in
+    componentAnalysis, for which epsilon applies to the square roots of
+    the variances.
+    """
+    vals, vecs = np.linalg.eigh(C)
+    if vals.size == 0 or vals[-1] <= 0:
+        return np.zeros((C.shape[0], 0))
+    bKeep = vals >= ((epsilon**2) * vals[-1])
+
+    return np.divide(vecs[:, bKeep], np.sqrt(vals[bKeep]))
+
+
+def componentAnalysisFromStats(stats, iIn, epsilon):
+    """
+    CCA projection of the features iIn calculated from the sufficient
+    statistics of a node instead of a QR decomposition of its data.  The
+    canonical directions come from the eigendecompositions of the small
+    covariance matrices, so the cost does not depend on the number of
+    points at the node.  Gives the same directions as the CCA of
+    componentAnalysis up to sign and numerical differences.
+
+    Parameters
+    ----------
+    stats:   Node statistics as returned by nodeStatistics
+    iIn:     Indices of the features to use
+    epsilon: Tolerance for rank reduction, as epsilonCCA
+
+    Returns
+    -------
+    projMat:  iIn.size x d matrix of canonical directions for X, normalized
+              to unit length
+    yprojMat: K x d matrix of canonical directions for Y
+    """
+    n   = stats["n"]
+    muX = stats["sumX"][iIn] / n
+    muY = stats["sumY"] / n
+
+    Cxx = (stats["XX"][np.ix_(iIn, iIn)] - n * np.outer(muX, muX)) / (n - 1)
+    Cxy = (stats["XY"][iIn, :] - n * np.outer(muX, muY)) / (n - 1)
+    Cyy = (stats["YY"] - n * np.outer(muY, muY)) / (n - 1)
+
+    Wx = whiteningMatrix(Cxx, epsilon)
+    Wy = whiteningMatrix(Cyy, epsilon)
+
+    if (Wx.shape[1] == 0) or (Wy.shape[1] == 0):
+        # Component analysis fails, use the first columns of X and Y
+        projMat  = np.concatenate((np.array([[1]]), np.zeros((iIn.size - 1, 1))))
+        yprojMat = np.concatenate((np.array([[1]]), np.zeros((Cyy.shape[0] - 1, 1))))
+        return projMat, yprojMat
+
+    d = np.min((Wx.shape[1], Wy.shape[1]))
+    L, _, M = np.linalg.svd(np.dot(np.dot(Wx.T, Cxy), Wy), full_matrices=False)
+
+    projMat  = np.dot(Wx, L[:, 0:d])
+    yprojMat = np.dot(Wy, M.T[:, 0:d])
+
+    # Normalize as in componentAnalysis
+    projMat = np.divide(projMat, np.sqrt(np.sum(projMat**2, axis=0)))
+
+    return projMat, yprojMat
@@ -1,4 +1,5 @@
 import inspect
+from collections import deque
 import numpy as np
 from primitives_ubc.regCCFS.src.utils.commonUtils import sVT
 from primitives_ubc.regCCFS.src.utils.commonUtils import is_numeric
@@ -6,10 +7,17 @@ from primitives_ubc.regCCFS.src.utils.commonUtils import fastUnique
 from primitives_ubc.regCCFS.src.utils.commonUtils import queryIfColumnsVary
 from primitives_ubc.regCCFS.src.utils.commonUtils import queryIfOnlyTwoUniqueRows
 from primitives_ubc.regCCFS.src.utils.ccfUtils import regCCA_alt
+from primitives_ubc.regCCFS.src.utils.ccfUtils import getGenerator
+from primitives_ubc.regCCFS.src.utils.ccfUtils import randomSketch
+from primitives_ubc.regCCFS.src.utils.ccfUtils import subsampleRows
 from primitives_ubc.regCCFS.src.utils.ccfUtils import random_feature_expansion
 from primitives_ubc.regCCFS.src.utils.ccfUtils import genFeatureExpansionParameters
 from primitives_ubc.regCCFS.src.training_utils.component_analysis import componentAnalysis
+from primitives_ubc.regCCFS.src.training_utils.component_analysis import componentAnalysisFromStats
+from primitives_ubc.regCCFS.src.training_utils.component_analysis import nodeStatistics
+from primitives_ubc.regCCFS.src.training_utils.component_analysis import subtractStatistics
 from primitives_ubc.regCCFS.src.training_utils.twopoint_max_marginsplit import twoPointMaxMarginSplit
+from primitives_ubc.regCCFS.src.training_utils.split_search import searchSplits, searchSplitsBinned
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -48,21 +56,36 @@ def makeExpansionFunc(wZ, bZ, bIncOrig):
     return f
 
 
-#-----------------------------------------------------------------------------#
-def calc_mse(cumtotal, cumsq, YTrainSort):
-    value = np.divide(cumsq, sVT(np.arange(1, YTrainSort.shape[0]+1))) -\
-            np.divide(((cumtotal[0:-1, :])**2  + YTrainSort**2 + np.multiply(2 * cumtotal[0:-1, :], YTrainSort)),\
-                       sVT(np.arange(1, YTrainSort.shape[0]+1)**2))
-
-    return value
-
 #-------------------------------------------------------------------------------
-def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
+def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth, iTrainRows=None, rng=None, stopEvent=None):
     """
     This function applies greedy splitting according to the CCT algorithm and the
-    provided options structure. Algorithm either returns a leaf or forms an
-    internal splitting node in which case the function recursively calls itself
-    for each of the children, eventually returning the corresponding subtree.
+    provided options structure. Nodes are split one at a time from an explicit
+    work queue, either depth first (the same order as a recursive
+    implementation) or breadth first as set by options["treeGrowthOrder"],
+    so the depth of the tree is not limited by the Python stack.
+
+    If options["ccaMethod"] is 'covariance', the CCA at each node is
+    calculated from sufficient statistics of its points (see
+    componentAnalysisFromStats).  Only the smaller child of each split has
+    its statistics calculated from the data, those of its sibling being
+    found by subtraction from the parent.  This requires CCA to be the only
+    projection and is not used with projection bootstrapping or bRCCA, in
+    which case the QR based componentAnalysis is used.
+
+    If options["ccaSketch"] is 'gaussian' or 'countsketch', nodes with more
+    than options["ccaSketchSize"] selected features and points carry out
+    the component analysis on that many random combinations of the
+    features (see randomSketch) instead of on the features themselves.
+
+    If options["histogramSplitMinPoints"] is positive, nodes with more
+    points than it only consider splits between options["histogramSplitBins"]
+    quantile bins of each projection (see searchSplitsBinned).
+
+    If options["maxPointsForProjection"] is positive, the projections of
+    nodes with more points than it are estimated from a random subsample
+    of that many of them and then applied to all of the node's points.
+    This does not apply to nodes using ccaMethod='covariance'.
 
     Parameters
     ----------
@@ -79,42 +102,153 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
                   data points, the corresponding values in iFeatureNum are
                   replaced with NaNs.
     depth       = Current tree depth (zero based)
+    iTrainRows  = Optional indices of the rows of XTrain and YTrain to train
+                  on, which may contain repeats (e.g. for bagging).  Defaults
+                  to all rows.
+    rng         = Optional numpy.random.Generator that all random choices
+                  made while growing the tree are drawn from, see
+                  ccfUtils.getGenerator
+    stopEvent   = Optional threading.Event checked before each node is
+                  split.  If it is set the tree is abandoned by raising a
+                  RuntimeError, e.g. when the fit has timed out.
 
 
     Returns
     -------
     tree        = Structure containing learnt tree
     """
+    # The tree is grown on a single ordering of the training rows, each node
+    # owning a contiguous range of it, so that the data is never copied for
+    # the children
+    rng = getGenerator(rng)
+    if iTrainRows is None:
+        order = np.arange(XTrain.shape[0])
+    else:
+        order = np.array(iTrainRows, copy=True).ravel()
+
+    growthOrder = options.get("treeGrowthOrder", 'depthFirst')
+    if not (growthOrder in ['depthFirst', 'breadthFirst']):
+        assert (False), 'Invalid option for treeGrowthOrder!'
+
+    # Nodes waiting to be split, each given by the node that will hold it,
+    # the field it is stored in, its depth and its range of the ordering.
+    # Depth first growth pops from the end, pushing the right child before
+    # the left, so that nodes are split in the same order as by recursion.
+    ccaMethod = options.get("ccaMethod", 'qr')
+    if not (ccaMethod in ['qr', 'covariance']):
+        assert (False), 'Invalid option for ccaMethod!'
+    bUseStats = (ccaMethod == 'covariance') and (not options["bProjBoot"]) and (not options["bRCCA"]) and\
+                ([proj for proj in options["projections"] if options["projections"][proj]] == ['CCA'])
+    nMinSplit = np.amax([2, options["minPointsForSplit"], 2 * options["minPointsLeaf"]])
+
+    rootStats = None
+    if bUseStats:
+        rootStats = nodeStatistics(XTrain[order, :], YTrain[order, :])
+
+    root = {}
+    work = deque([(root, "tree", depth, 0, order.size, rootStats)])
+    while work:
+        if (stopEvent is not None) and stopEvent.is_set():
+            raise RuntimeError('Tree growth cancelled!')
+
+        if growthOrder == 'depthFirst':
+            parent, field, nodeDepth, iStart, iEnd, stats = work.pop()
+        else:
+            parent, field, nodeDepth, iStart, iEnd, stats = work.popleft()
+
+        node, nLeft = splitNode(XTrain, YTrain, bReg, options, iFeatureNum, nodeDepth, order, iStart, iEnd, stats, rng)
+        parent[field] = node
+
+        if not node["bLeaf"]:
+            lessStats, greaterStats = childStatistics(XTrain, YTrain, order, iStart, iStart+nLeft, iEnd, stats, nMinSplit)
+            lessChild    = (node, "lessthanChild",    nodeDepth+1, iStart, iStart+nLeft, lessStats)
+            greaterChild = (node, "greaterthanChild", nodeDepth+1, iStart+nLeft, iEnd, greaterStats)
+            if growthOrder == 'depthFirst':
+                work.append(greaterChild)
+                work.append(lessChild)
+            else:
+                work.append(lessChild)
+                work.append(greaterChild)
+
+    return root["tree"]
+
+
+#-------------------------------------------------------------------------------
+def childStatistics(XTrain, YTrain, order, iStart, iSplit, iEnd, stats, nMinSplit):
+    """
+    Sufficient statistics of the two children of a node whose range of the
+    ordering has been partitioned at iSplit.  The smaller child is
+    calculated from its points and the larger by subtraction from the
+    parent.  Children too small to be split get None.
+    """
+    if stats is None:
+        return None, None
+
+    if (iSplit - iStart) <= (iEnd - iSplit):
+        rows = order[iStart:iSplit]
+    else:
+        rows = order[iSplit:iEnd]
+    smallStats = nodeStatistics(XTrain[rows, :], YTrain[rows, :])
+    largeStats = subtractStatistics(stats, smallStats)
+
+    if (iSplit - iStart) <= (iEnd - iSplit):
+        lessStats, greaterStats = smallStats, largeStats
+    else:
+        lessStats, greaterStats = largeStats, smallStats
+
+    if (iSplit - iStart) < nMinSplit:
+        lessStats = None
+    if (iEnd - iSplit) < nMinSplit:
+        greaterStats = None
+
+    return lessStats, greaterStats
+
+
+#-------------------------------------------------------------------------------
+def splitNode(XTrain, YTrain, bReg, options, iFeatureNum, depth, order, iStart, iEnd, stats=None, rng=None):
+    """
+    Splits the node holding the points XTrain[order[iStart:iEnd], :], see
+    growCCT.  Returns either a leaf or an internal node without its
+    children, in which case order[iStart:iEnd] has been partitioned so that
+    the first nLeft points go to the lessthanChild.  If given, stats are
+    the sufficient statistics of the node's points used for the CCA.  Random
+    choices are drawn from rng, see ccfUtils.getGenerator.
+
+    Returns
+    -------
+    tree  = Node struct
+    nLeft = Number of points going to the lessthanChild, 0 for leaves
+    """
+    rng   = getGenerator(rng)
+    rows  = order[iStart:iEnd]
+    YNode = YTrain[rows, :]
+
     # Standard variables
     eps = 2.2204e-16
 
     # Set any missing required variables
-    if (options["mseTotal"]).size == 0:
-        options["mseTotal"] = YTrain.var(axis=0)
+    if np.size(options["mseTotal"]) == 0:
+        options["mseTotal"] = YNode.var(axis=0)
 
     #---------------------------------------------------------------------------
     # First do checks for whether we should immediately terminate
     #---------------------------------------------------------------------------
-    N = XTrain.shape[0]
+    N = iEnd - iStart
     # Return if one training point, pure node or if options for returning
     # fulfilled.  A little case to deal with a binary YTrain is required.
     bStop = (N < (np.amax([2, options["minPointsForSplit"], 2 * options["minPointsLeaf"]]))) or\
             (is_numeric(options["maxDepthSplit"]) and depth > options["maxDepthSplit"])
 
-    if depth > 490 and (options["maxDepthSplit"] == 'stack'):
-        bStop = True
-        logging.warning('Reached maximum depth imposed by stack limitations!')
-
     if bStop:
-        tree = setupLeaf(YTrain, bReg, options)
-        return tree
+        tree = setupLeaf(YNode, bReg, options)
+        return tree, 0
 
     else:
         # Check if variance in Y is less than the cut off amount
-         varY = YTrain.var(axis=0)
+         varY = YNode.var(axis=0)
          if np.all(varY < (options["mseTotal"] * options["mseErrorTolerance"])):
-             tree = setupLeaf(YTrain, bReg, options)
-             return tree
+             tree = setupLeaf(YNode, bReg, options)
+             return tree, 0
 
     #---------------------------------------------------------------------------
     # Subsample features as required for hyperplane sampling
@@ -122,7 +256,7 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
     iCanBeSelected = fastUnique(X=iFeatureNum)
     iCanBeSelected = iCanBeSelected[~np.isnan(iCanBeSelected)]
     lambda_   = np.min((iCanBeSelected.size, options["lambda"]))
-    indFeatIn = np.random.choice(int(iCanBeSelected.size), int(lambda_), replace=False)
+    indFeatIn = rng.choice(int(iCanBeSelected.size), int(lambda_), replace=False)
     iFeatIn   = iCanBeSelected[indFeatIn]
 
     bInMat = np.equal((iFeatureNum.flatten(order='F')[np.newaxis]), (np.sort(iFeatIn.flatten(order='F'))[np.newaxis]).T) # 1xk == nx1
@@ -130,7 +264,7 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
 
     # Check for variation along selected dimensions and
     # resample features that have no variation
-    bXVaries = queryIfColumnsVary(X=XTrain[:, iIn], tol=options["XVariationTol"])
+    bXVaries = queryIfColumnsVary(X=XTrain[rows[:, np.newaxis], iIn], tol=options["XVariationTol"])
 
     if (not np.all(bXVaries)):
         iInNew    = iIn
@@ -146,30 +280,31 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
             lambda_   = np.min((iCanBeSelected.size, options["lambda"]-nSelected))
             if lambda_ < 1:
                 break
-            indFeatIn = np.random.choice(iCanBeSelected.size, size=int(lambda_), replace=False)
+            indFeatIn = rng.choice(iCanBeSelected.size, size=int(lambda_), replace=False)
             iFeatIn   = iCanBeSelected[indFeatIn]
             bInMat    = np.equal((iFeatureNum.flatten(order='F')[np.newaxis]), (iFeatIn.flatten(order='F')[np.newaxis].T))
             iInNew    = (np.any(bInMat, axis=0)).ravel().nonzero()[0]
-            bXVaries  = queryIfColumnsVary(X=XTrain[:, iInNew], tol=options["XVariationTol"])
+            bXVaries  = queryIfColumnsVary(X=XTrain[rows[:, np.newaxis], iInNew], tol=options["XVariationTol"])
             iIn       = np.sort(np.concatenate((iIn, iInNew[bXVaries])))
 
     if iIn.size == 0:
         # This means that there was no variation along any feature, therefore exit.
-        tree = setupLeaf(YTrain, bReg, options)
-        return tree
+        tree = setupLeaf(YNode, bReg, options)
+        return tree, 0
+
+    # Only the selected features of the node's points are gathered
+    XNode = XTrain[rows[:, np.newaxis], iIn]
 
     #---------------------------------------------------------------------------
     # Projection bootstrap if required
     #---------------------------------------------------------------------------
     if options["bProjBoot"]:
-        iTrainThis = np.random.randint(N, size=(N, 1))
-        XTrainBag  = XTrain[iTrainThis, iIn]
-        YTrainBag  = YTrain[iTrainThis, :]
-        if len(YTrainBag.shape) > 2:
-            YTrainBag  = np.squeeze(YTrainBag)
+        iTrainThis = rng.integers(N, size=(N, 1))
+        XTrainBag  = XNode[iTrainThis.ravel(), :]
+        YTrainBag  = YNode[iTrainThis.ravel(), :]
     else:
-        XTrainBag = XTrain[:, iIn]
-        YTrainBag = YTrain
+        XTrainBag = XNode
+        YTrainBag = YNode
 
     bXBagVaries = queryIfColumnsVary(X=XTrainBag, tol=options["XVariationTol"])
 
@@ -178,11 +313,15 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
         (not bReg and YTrainBag.shape[1] == 1 and (np.any(np.sum(YTrainBag, axis=0) == np.array([0, YTrainBag.shape[0]])))) or\
         (bReg and np.all(np.var(YTrainBag, axis=0) < (options["mseTotal"] * options["mseErrorTolerance"]))):
         if (not options["bContinueProjBootDegenerate"]):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
         else:
-            XTrainBag = XTrain[:, iIn]
-            YTrainBag = YTrain
+            XTrainBag = XNode
+            YTrainBag = YNode
+
+    # The projections are always estimated in double precision, e.g. for the
+    # QR decompositions of the CCA, even when the data is held in single
+    XTrainBag = np.asarray(XTrainBag, dtype=np.float64)
 
     #---------------------------------------------------------------------------
     # Check for only having two points
@@ -191,25 +330,48 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
         bSplit, projMat, partitionPoint = twoPointMaxMarginSplit(XTrainBag, YTrainBag, options["XVariationTol"])
 
         if (not bSplit):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
         else:
-            bLessThanTrain = np.dot(XTrain[:, iIn], projMat) <= partitionPoint
+            bLessThanTrain = np.dot(XNode, projMat) <= partitionPoint
             iDir = 0
     else:
+        # Estimate the projection from a bounded subsample of the points
+        # and then apply it to all of them
+        if 0 < options.get("maxPointsForProjection", 0) < XTrainBag.shape[0]:
+            iSample   = subsampleRows(XTrainBag.shape[0], int(options["maxPointsForProjection"]), rng=rng)
+            XTrainBag = XTrainBag[iSample, :]
+            YTrainBag = YTrainBag[iSample, ...]
+
         # Generate the new features as required
         if options["bRCCA"]:
-            wZ, bZ    = genFeatureExpansionParameters(XTrainBag, options["rccaNFeatures"], options["rccaLengthScale"])
+            wZ, bZ    = genFeatureExpansionParameters(XTrainBag, options["rccaNFeatures"], options["rccaLengthScale"], rng=rng)
             fExp      = makeExpansionFunc(wZ, bZ, options["rccaIncludeOriginal"])
             XTrainBag = fExp(XTrainBag)
             projMat, _, _ = regCCA_alt(XTrainBag, YTrainBag, options["rccaRegLambda"], options["rccaRegLambda"], 1e-8)
             if projMat.size == 0:
                 projMat = np.ones((XTrainBag.shape[1], 1))
-            UTrain = np.dot(fExp(XTrain[:, iIn]), projMat)
+            UTrain = np.dot(fExp(XNode), projMat)
+
+        elif stats is not None:
+            projMat, yprojMat = componentAnalysisFromStats(stats, iIn, options["epsilonCCA"])
+            UTrain = np.dot(XNode, projMat)
+
+        elif (options.get("ccaSketch", 'none') != 'none') and (iIn.size > options["ccaSketchSize"]) and\
+             (XTrainBag.shape[0] > options["ccaSketchSize"]):
+            # Carry out the component analysis on a random sketch of the
+            # features and map the projections back.  Small nodes, for which
+            # the sketch would lose too much, use the exact analysis.
+            S = randomSketch(iIn.size, int(options["ccaSketchSize"]), options["ccaSketch"], rng=rng)
+            XSketch = np.asarray((S.T @ XTrainBag.T).T)
+            projMat, yprojMat, _, _, _ = componentAnalysis(XSketch, YTrainBag, options["projections"], options["epsilonCCA"], rng=rng)
+            projMat = np.asarray(S @ projMat)
+            projMat = np.divide(projMat, np.sqrt(np.sum(projMat**2, axis=0)))
+            UTrain  = np.dot(XNode, projMat)
 
         else:
-            projMat, yprojMat, _, _, _ = componentAnalysis(XTrainBag, YTrainBag, options["projections"], options["epsilonCCA"])
-            UTrain = np.dot(XTrain[:, iIn], projMat)
+            projMat, yprojMat, _, _, _ = componentAnalysis(XTrainBag, YTrainBag, options["projections"], options["epsilonCCA"], rng=rng)
+            UTrain = np.dot(XNode, projMat)
 
         #-----------------------------------------------------------------------
         # Choose the features to use
@@ -218,122 +380,39 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
         bUTrainVaries = queryIfColumnsVary(UTrain, options["XVariationTol"])
 
         if (not np.any(bUTrainVaries)):
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
 
         UTrain  = UTrain[:, bUTrainVaries]
         projMat = projMat[:, bUTrainVaries]
 
-        if options["bUseOutputComponentsMSE"] and bReg and (YTrain.shape[1] > 1) and\
+        if options["bUseOutputComponentsMSE"] and bReg and (YNode.shape[1] > 1) and\
            (not (yprojMat.size == 0)) and (options["splitCriterion"] == 'mse'):
-           VTrain = np.dot(YTrain, yprojMat)
+           VTrain = np.dot(YNode, yprojMat)
 
         #-----------------------------------------------------------------------
         # Search over splits using provided method
         #-----------------------------------------------------------------------
-        nProjDirs  = UTrain.shape[1]
-        splitGains = np.empty((nProjDirs,1))
-        splitGains.fill(np.nan)
-        iSplits    = np.empty((nProjDirs,1))
-        iSplits.fill(np.nan)
-
-        for nVarAtt in range(nProjDirs):
-            # Calculate the probabilities of being at each class in each of child
-            # nodes based on proportion of training data for each of possible
-            # splits using current projection
-            sort_UTrain   = UTrain[:, nVarAtt].ravel()
-            UTrainSort    = np.sort(sort_UTrain)
-            iUTrainSort   = np.argsort(sort_UTrain)
-
-            bUniquePoints_ = np.diff(UTrainSort, n=1, axis=0)
-            bUniquePoints  = np.concatenate((bUniquePoints_ > options["XVariationTol"], np.array([False])))
-
-            if options["bUseOutputComponentsMSE"] and bReg and YTrain.shape[1] > 1 and (not (yprojMat.size == 0)) and (options["splitCriterion"] == 'mse'):
-                VTrainSort = VTrain[iUTrainSort, :]
-            else:
-                VTrainSort = YTrain[iUTrainSort, :]
-
-            leftCum = np.cumsum(VTrainSort, axis=0)
-            if (YTrain.shape[1] ==1 or options["bSepPred"]) and (not bReg):
-                # Convert to [class_doesnt_exist,class_exists]
-                leftCum = np.concatenate((np.subtract(sVT(X=np.arange(0,N)), leftCum), leftCum))
-
-            rightCum = np.subtract(leftCum[-1, :], leftCum)
-
-            # Calculate the metric values of the current node and two child nodes
-            if options["splitCriterion"] == 'mse':
-                cumSqLeft = np.cumsum(VTrainSort**2)
-                cumSqLeft = np.expand_dims(cumSqLeft, axis=1)
-                varData   = np.subtract((cumSqLeft[-1]/N), (leftCum[-1, :]/N)**2)
-                if np.all(varData < (options["mseTotal"] * options["mseErrorTolerance"])):
-                    # Total variation is less then the allowed tolerance so
-                    # terminate and construct a leaf
-                    tree = setupLeaf(YTrain, bReg, options)
-                    return tree
-
-                cumtotal_l = np.concatenate((np.zeros((1, VTrainSort.shape[1])), leftCum))
-                metricLeft = calc_mse(cumtotal=cumtotal_l, cumsq=cumSqLeft, YTrainSort=VTrainSort)
-                # For calculating the right need to go in additive order again
-                # so go from other end and then flip
-                end  = cumSqLeft.shape[0]  - 1
-                vend = VTrainSort.shape[0] - 1
-
-                metricRight = np.concatenate((np.zeros((1, VTrainSort.shape[1])),\
-                                calc_mse(rightCum[::-1, :],\
-                                        np.subtract((cumSqLeft[-1, :][np.newaxis]), cumSqLeft[(end-1)::-1, :]),\
-                                        VTrainSort[vend:0:-1, :])))
-
-                metricRight = metricRight[::-1, :]
-                # No need to do the grouping for regression as each must be
-                # a seperate output anyway.
-            else:
-                assert (False), 'Invalid split criterion!'
-
-            metricCurrent = np.copy(metricLeft[-1, :])
-            metricLeft[~bUniquePoints,  :] = np.inf
-            metricRight[~bUniquePoints, :] = np.inf
-
-            # Calculate gain in metric for each of possible splits based on current
-            # metric value minus metric value of child weighted by number of terms
-            # in each child
-            metricGain = np.subtract(metricCurrent,\
-                        (np.multiply(sVT(np.arange(1,N+1, 1)), metricLeft)\
-                        +np.multiply(sVT(np.arange(N-1, -1, -1)), metricRight))/N)
-            metricGain = np.round(metricGain, decimals=4)
-
-            # Combine gains if there are mulitple outputs.  Note that for gini,
-            # info and mse, the joint gain is equal to the mean gain, hence
-            # taking the mean here rather than explicitly calculating joints before.
-            if metricGain.shape[1] > 1:
-                if is_numeric(options["taskWeights"]):
-                    # If weights provided, weight task appropriately in terms of importance.
-                    metricGain = np.multiply(metricGain, (options["taskWeights"].flatten(order='F')[np.newaxis])) # (nxk) .* (1*k)
-
-                multiTGC = options["multiTaskGainCombination"]
-                if multiTGC == 'mean':
-                    metricGain = np.mean(metricGain, axis=1, keepdims=True)
-                elif multiTGC == 'max':
-                    metricGain = np.max(metricGain, axis=1, keepdims=True)
-                else:
-                    assert (False), 'Invalid option for options.multiTaskGainCombination!'
-
-            # Disallow splits that violate the minimum number of leaf points
-            end = (metricGain.shape[0]-1)
-            metricGain[0:(options["minPointsLeaf"]-1)] = -np.inf
-            metricGain[(end-(options["minPointsLeaf"]-1)):] = -np.inf # Note that end is never chosen anyway
-
-            # Randomly sample from equally best splits
-            iSplits[nVarAtt]    = np.argmax(metricGain[0:-1])
-            splitGains[nVarAtt] = np.max(metricGain[0:-1])
-            iEqualMax = ((np.absolute(metricGain[0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
-            if iEqualMax.size == 0:
-                iEqualMax = np.array([1])
-            iSplits[nVarAtt] = iEqualMax[np.random.randint(iEqualMax.size)]
+        if options["bUseOutputComponentsMSE"] and bReg and (YNode.shape[1] > 1) and\
+           (not (yprojMat.size == 0)) and (options["splitCriterion"] == 'mse'):
+            VNode = VTrain
+        else:
+            VNode = YNode
+
+        if 0 < options.get("histogramSplitMinPoints", 0) < N:
+            # Approximate search over quantile bins for large nodes
+            bStop, splitGains, iSplits = searchSplitsBinned(UTrain, VNode, options, options.get("histogramSplitBins", 256), eps, rng=rng)
+        else:
+            bStop, splitGains, iSplits = searchSplits(UTrain, VNode, options, eps, rng=rng)
+
+        if bStop:
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
 
         # If no split gives a positive gain then stop
         if np.max(splitGains) < 0:
-            tree = setupLeaf(YTrain, bReg, options)
-            return tree
+            tree = setupLeaf(YNode, bReg, options)
+            return tree, 0
 
         # Establish between projection direction
         maxGain   = np.max(splitGains, axis=0)
@@ -341,7 +420,7 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
 
         # Use given method to break ties
         if options["dirIfEqual"] == 'rand':
-            iDir = iEqualMax[np.random.randint(iEqualMax.size)]
+            iDir = iEqualMax[rng.integers(iEqualMax.size)]
         elif options["dirIfEqual"] == 'first':
             if iEqualMax.size == 0:
                 iDir = 0
@@ -355,7 +434,9 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
         # Establish partition point and assign to child
         #-----------------------------------------------------------------------
         UTrain = UTrain[:, iDir, np.newaxis]
-        UTrainSort = np.sort(UTrain, axis=0)
+        # Only the points either side of the split are needed, which are
+        # found without sorting the node
+        UTrainSort = np.partition(UTrain, (int(iSplit[0]), int(iSplit[0])+1), axis=0)
 
         # The convoluted nature of the below is to avoid numerical errors
         uTrainSortLeftPart = UTrainSort[iSplit]
@@ -370,12 +451,12 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
             assert (False), 'Suggested split with empty!'
 
     #-----------------------------------------------------------------------
-    # Recur tree growth to child nodes and constructs tree struct
+    # Construct the node struct and partition the points between the children
     #-----------------------------------------------------------------------
     tree = {}
     tree["bLeaf"]   = False
     tree["Npoints"] = N
-    tree["mean"]    = np.mean(YTrain, axis=0)
+    tree["mean"]    = np.mean(YNode, axis=0)
 
     if (not options["org_stdY"].size == 0):
         tree["mean"] = tree["mean"] * options["org_stdY"]
@@ -389,8 +470,12 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
         else:
             bLessThanTrain = np.squeeze(bLessThanTrain, axis=0)
 
-    treeLeft  = growCCT(XTrain[bLessThanTrain, :], YTrain[bLessThanTrain,  :], bReg, options, iFeatureNum, depth+1)
-    treeRight = growCCT(XTrain[~bLessThanTrain,:], YTrain[~bLessThanTrain, :], bReg, options, iFeatureNum, depth+1)
+    # Partition the node's range of the ordering in place, keeping the
+    # original order of the points within each child.  A stable sort of a
+    # boolean key is a linear time counting sort.
+    nLeft = int(np.sum(bLessThanTrain))
+    order[iStart:iEnd] = rows[np.argsort(~bLessThanTrain, kind='stable')]
+
     tree["iIn"] = iIn
 
     if options["bRCCA"]:
@@ -405,7 +490,5 @@ def growCCT(XTrain, YTrain, bReg, options, iFeatureNum, depth):
 
     tree["decisionProjection"] = projMat[:, iDir]
     tree["paritionPoint"]      = partitionPoint
-    tree["lessthanChild"]      = treeLeft
-    tree["greaterthanChild"]   = treeRight
 
-    return tree
+    return tree, nLeft
@@ -3,11 +3,14 @@ import pandas as pd
 from primitives_ubc.regCCFS.src.utils.commonUtils import sVT
 from primitives_ubc.regCCFS.src.utils.commonUtils import is_numeric
 from primitives_ubc.regCCFS.src.utils.commonUtils import makeSureString
+from primitives_ubc.regCCFS.src.utils.commonUtils import expandCategoricalCodes
+from primitives_ubc.regCCFS.src.utils.categoricalUtils import CategoricalMatrix
+from primitives_ubc.regCCFS.src.utils.categoricalUtils import indicatorMoments
 from primitives_ubc.regCCFS.src.prediction_utils.replicate_input_process import replicateInputProcess
 
 
 
-def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FNormalize=True):
+def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FNormalize=True, bExpandCategoricals=True):
     """
     Process input features, expanding categoricals and converting to zScores.
 
@@ -27,6 +30,10 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
            categories that do not appear in the training data.
     bNaNtoMean: Replace NaNs with the mean, default false.
     FNormalize: Normalize the processed features, default true.
+    bExpandCategoricals: Expand the categorical features into dense one-hot
+              columns, default true.  Otherwise XTrain is returned as a
+              CategoricalMatrix holding the categories as integer codes,
+              which only forms the indicator columns that are indexed.
 
     Returns
     -------
@@ -69,8 +76,7 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
                 iContainsString = (np.sum(~bNumeric, axis=0) > 0).ravel().nonzero()[0]
                 nStr = np.zeros((XTrainRC.shape[1]), dtype=int)
                 for n in iContainsString.flatten(order='F'):
-                    x_unique = np.unique(XTrainRC.loc[~bNumeric[:, n], n])
-                    nStr[n]  = len(x_unique)
+                    nStr[n] = len(pd.unique(XTrainRC.loc[~bNumeric[:, n], n]))
                 bOrdinal = nStr < 2
                 # Features with only a single unqiue string and otherwise
                 # numeric treated also treated as ordinal with the string
@@ -89,8 +95,8 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
         # values
         XTrain   = XTrainRC.loc[:, bOrdinal]
         bNumeric = is_numeric(XTrain, compress=False)
-        bNumeric = pd.DataFrame(bNumeric, dtype=type(True))
-        XTrain[~bNumeric] = np.nan
+        if not np.all(bNumeric):
+            XTrain = XTrain.where(bNumeric)
         XTrain = XTrain.to_numpy(dtype=float)
     else:
         XTrain = XTrainRC[:, bOrdinal]
@@ -99,39 +105,33 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
     if isinstance(XTrainRC, pd.DataFrame) and XCat_exist:
         XCat = XTrainRC.loc[:, ~bOrdinal]
         XCat = makeSureString(XCat, nSigFigTol=10)
-        # Previous properties
-        iFeatureNum  = list(range(XTrain.shape[1]))
         featureNames = featureNamesOrig[bOrdinal]
         featureBaseNames = featureNamesOrig[~bOrdinal]
-        # Collect Categorical features
-        Cats = {}
-        iFeatureNum = np.array([iFeatureNum], dtype=int)
-        # Expand the categorical features
+        # Encode each categorical feature by the index of its value in the
+        # sorted unique values
+        Cats  = {}
+        codes = np.zeros(XCat.shape, dtype=int)
         for n in range(XCat.shape[1]):
-            cats_unique  = np.unique(XCat.iloc[:, n])
-            Cats[n]      = cats_unique
-            newNames     = np.array([f'Cat_{name}' for name in cats_unique])
+            codes[:, n], cats_unique = pd.factorize(XCat.iloc[:, n], sort=True)
+            Cats[n]      = np.asarray(cats_unique)
+            newNames     = np.array([f'Cat_{name}' for name in Cats[n]])
             featureNames = np.concatenate((featureNames, newNames))
 
-            nCats = len(cats_unique)
-            # This is setup so that any trivial features are not included
-            if nCats==1:
-                continue
-            sizeSoFar = iFeatureNum.shape[1]
-            if len(iFeatureNum) == 0:
-                iFeatureNum = np.ones((1,nCats))
-            else:
-                iFeatureNum = np.concatenate((iFeatureNum, (iFeatureNum[:, -1] + 1) * np.ones((1,nCats))), axis=1).astype(float)
-
-            XTrain = np.concatenate((XTrain, np.zeros((XTrain.shape[0], nCats))), axis=1)
-            for c in range(nCats):
-                XTrain[XCat.iloc[:, n] == cats_unique[c], (sizeSoFar+c)] = 1
-
-        # Remove single dimension if any
-        iFeatureNum = np.squeeze(iFeatureNum)
+        # Expand the categorical features.  This is setup so that any
+        # trivial features are not included.
+        nCats   = np.array([len(Cats[n]) for n in range(XCat.shape[1])], dtype=int)
+        bExpand = nCats > 1
+        nOrd    = XTrain.shape[1]
+        codes   = codes[:, bExpand].astype(np.int32)
+        nCats   = nCats[bExpand]
+        iFeatureNum = np.concatenate((np.arange(nOrd), nOrd + np.repeat(np.arange(nCats.size), nCats))) * 1.0
+        bCodes  = (not bExpandCategoricals) and (nCats.size > 0)
+        if not bCodes:
+            XTrain = np.concatenate((XTrain, expandCategoricalCodes(codes, nCats)), axis=1)
 
     else:
         Cats = {}
+        bCodes = False
         iFeatureNum  = np.arange(XTrain.shape[1]) * 1.0
         featureNames = featureNamesOrig[bOrdinal]
         featureBaseNames = featureNamesOrig[~bOrdinal]
@@ -140,8 +140,14 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
         # Convert to Z-scores, Normalize feature vectors
         mu_XTrain  = np.nanmean(XTrain, axis=0)
         std_XTrain = np.nanstd(XTrain,  axis=0, ddof=1)
+        if bCodes:
+            # The indicator columns are not formed, so their moments are
+            # found from the category counts
+            mu_Ind, std_Ind = indicatorMoments(codes, nCats)
+            mu_XTrain  = np.concatenate((mu_XTrain, mu_Ind))
+            std_XTrain = np.concatenate((std_XTrain, std_Ind))
         std_XTrain[abs(std_XTrain)<1e-10] = 1.0
-        XTrain = np.divide(np.subtract(XTrain, mu_XTrain), std_XTrain)
+        XTrain = np.divide(np.subtract(XTrain, mu_XTrain[0:XTrain.shape[1]]), std_XTrain[0:XTrain.shape[1]])
     else:
         mu_XTrain  = 0.0
         std_XTrain = 1.0
@@ -149,6 +155,11 @@ def processInputData(XTrainRC, bOrdinal=None, XTestRC=None, bNaNtoMean=False, FN
     if bNaNtoMean:
         XTrain[np.isnan(XTrain)] = 0.0
 
+    if bCodes:
+        nInd   = np.sum(nCats)
+        XTrain = CategoricalMatrix(XTrain, codes, nCats, np.broadcast_to(mu_XTrain, (nOrd+nInd,))[nOrd:],\
+                                   np.broadcast_to(std_XTrain, (nOrd+nInd,))[nOrd:])
+
     # If required, generate function for converting additional data and
     # calculate conversion for any test data provided.
     inputProcessDetails = {}
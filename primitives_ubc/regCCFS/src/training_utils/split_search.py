@@ -0,0 +1,315 @@
+import numpy as np
+from primitives_ubc.regCCFS.src.utils.commonUtils import sVT
+from primitives_ubc.regCCFS.src.utils.commonUtils import is_numeric
+from primitives_ubc.regCCFS.src.utils.ccfUtils import getGenerator
+
+
+#-----------------------------------------------------------------------------#
+def calc_mse(cumtotal, cumsq, YTrainSort):
+    """
+    Mean squared error of the points up to each position of the sorted
+    outputs, the points being along the second to last axis.
+    """
+    value = np.divide(cumsq, sVT(np.arange(1, YTrainSort.shape[-2]+1))) -\
+            np.divide(((cumtotal[..., 0:-1, :])**2  + YTrainSort**2 + np.multiply(2 * cumtotal[..., 0:-1, :], YTrainSort)),\
+                       sVT(np.arange(1, YTrainSort.shape[-2]+1)**2))
+
+    return value
+
+
+#-----------------------------------------------------------------------------#
+def gainsFromMetrics(metricLeft, metricRight, nLeft, N, bValid, options):
+    """
+    Combines the criterion of the children at each candidate split into the
+    gain of the split.
+
+    Parameters
+    ----------
+    metricLeft, metricRight: d x S x K arrays of the criterion of the
+             left and right children
+    nLeft:   Array broadcastable to d x S x 1 of the number of points going
+             left at each candidate split
+    N:       Number of points
+    bValid:  d x S Boolean array, False for candidate splits that do not
+             separate distinct points
+    options: Options dict
+
+    Returns
+    -------
+    metricGain: d x S array of gains, -inf for disallowed splits
+    """
+    # Metric
+    metricCurrent = np.copy(metricLeft[:, -1, np.newaxis, :])
+    metricLeft[~bValid,  :] = np.inf
+    metricRight[~bValid, :] = np.inf
+
+    # Calculate gain in metric for each of possible splits based on current
+    # metric value minus metric value of child weighted by number of terms
+    # in each child
+    metricGain = np.subtract(metricCurrent,\
+                (np.multiply(nLeft, metricLeft)\
+                +np.multiply(np.subtract(N, nLeft), metricRight))/N)
+    metricGain = np.round(metricGain, decimals=4)
+
+    # Combine gains if there are mulitple outputs.  Note that for gini,
+    # info and mse, the joint gain is equal to the mean gain, hence
+    # taking the mean here rather than explicitly calculating joints before.
+    if metricGain.shape[2] > 1:
+        if is_numeric(options["taskWeights"]):
+            # If weights provided, weight task appropriately in terms of importance.
+            metricGain = np.multiply(metricGain, np.ravel(options["taskWeights"], order='F'))
+
+        multiTGC = options["multiTaskGainCombination"]
+        if multiTGC == 'mean':
+            metricGain = np.mean(metricGain, axis=2, keepdims=True)
+        elif multiTGC == 'max':
+            metricGain = np.max(metricGain, axis=2, keepdims=True)
+        else:
+            assert (False), 'Invalid option for options.multiTaskGainCombination!'
+
+    metricGain = metricGain[:, :, 0]
+
+    # Disallow splits that violate the minimum number of leaf points
+    bTooFew = np.logical_or(nLeft < options["minPointsLeaf"], np.subtract(N, nLeft) < options["minPointsLeaf"])
+    metricGain[np.broadcast_to(bTooFew[..., 0], metricGain.shape)] = -np.inf
+
+    return metricGain
+
+
+#-----------------------------------------------------------------------------#
+def metricGainsBlock(UTrainSort, VTrainSort, options):
+    """
+    Calculates the gain in the split criterion for every candidate split of a
+    block of projection directions at once.
+
+    Parameters
+    ----------
+    UTrainSort: d x N array of the sorted projected points of each direction
+    VTrainSort: d x N x K array of the outputs in the sorted order of each
+                direction
+    options:    Options dict
+
+    Returns
+    -------
+    metricGain: d x N array of gains, -inf for disallowed splits
+    bLowVar:    d array, True where the total variation of the outputs is
+                less than the allowed tolerance
+    """
+    d, N = UTrainSort.shape
+
+    bUniquePoints_ = np.diff(UTrainSort, n=1, axis=1)
+    bUniquePoints  = np.concatenate((bUniquePoints_ > options["XVariationTol"], np.zeros((d, 1), dtype=bool)), axis=1)
+
+    leftCum  = np.cumsum(VTrainSort, axis=1)
+    rightCum = np.subtract(leftCum[:, -1, np.newaxis, :], leftCum)
+
+    # Calculate the metric values of the current node and two child nodes
+    if options["splitCriterion"] == 'mse':
+        cumSqLeft = np.cumsum(VTrainSort**2, axis=1)
+        varData   = np.subtract((cumSqLeft[:, -1, :]/N), (leftCum[:, -1, :]/N)**2)
+        bLowVar   = np.all(varData < (options["mseTotal"] * options["mseErrorTolerance"]), axis=1)
+
+        cumtotal_l = np.concatenate((np.zeros((d, 1, VTrainSort.shape[2])), leftCum), axis=1)
+        metricLeft = calc_mse(cumtotal=cumtotal_l, cumsq=cumSqLeft, YTrainSort=VTrainSort)
+        # For calculating the right need to go in additive order again
+        # so go from other end and then flip
+        end  = cumSqLeft.shape[1]  - 1
+        vend = VTrainSort.shape[1] - 1
+
+        metricRight = np.concatenate((np.zeros((d, 1, VTrainSort.shape[2])),\
+                        calc_mse(rightCum[:, ::-1, :],\
+                                np.subtract(cumSqLeft[:, -1, np.newaxis, :], cumSqLeft[:, (end-1)::-1, :]),\
+                                VTrainSort[:, vend:0:-1, :])), axis=1)
+
+        metricRight = metricRight[:, ::-1, :]
+        # No need to do the grouping for regression as each must be
+        # a seperate output anyway.
+    else:
+        assert (False), 'Invalid split criterion!'
+
+    nLeft      = np.arange(1, N+1)[np.newaxis, :, np.newaxis]
+    metricGain = gainsFromMetrics(metricLeft, metricRight, nLeft, N, bUniquePoints, options)
+
+    return metricGain, bLowVar
+
+
+def edgeGaps(UTrain, iBin, d, S):
+    """
+    Gap between the largest point left of each bin edge and the smallest
+    point right of it, for the bins iBin (offset per direction, see
+    binnedGains) of the N x d projected points UTrain.  Returns a d x S
+    array, the gap after the last bin being -inf.
+    """
+    binMax = np.full((d*S,), -np.inf)
+    binMin = np.full((d*S,), np.inf)
+    np.maximum.at(binMax, iBin, UTrain.ravel())
+    np.minimum.at(binMin, iBin, UTrain.ravel())
+
+    leftMax  = np.maximum.accumulate(binMax.reshape(d, S), axis=1)
+    rightMin = np.minimum.accumulate(binMin.reshape(d, S)[:, ::-1], axis=1)[:, ::-1]
+    gaps = np.full((d, S), -np.inf)
+    gaps[:, :-1] = rightMin[:, 1:] - leftMax[:, :-1]
+
+    return gaps
+
+
+def binnedGains(UTrain, VTrain, options, nBins):
+    """
+    Approximate version of metricGainsBlock that only considers splits
+    between quantile bins of each direction.  The bin edges are values of
+    the projected points, so a point goes left of an edge if it is no
+    greater than it, and the output sums of each bin are found
+    without sorting.
+
+    Parameters
+    ----------
+    UTrain:  N x d array of projected points
+    VTrain:  N x K array of outputs
+    options: Options dict
+    nBins:   Number of quantile bins per direction
+
+    Returns
+    -------
+    metricGain: d x S array of gains at the bin edges, -inf for disallowed
+                splits
+    nLeft:      d x S array of the number of points going left at each edge
+    """
+    N, d = UTrain.shape
+    K = VTrain.shape[1]
+
+    if not options["splitCriterion"] == 'mse':
+        assert (False), 'Invalid split criterion!'
+
+    # The edges are estimated from an evenly strided subsample of the points
+    # as finding the exact quantiles is nearly as costly as a full sort
+    USample = np.sort(UTrain[::max(1, N // (16*nBins)), :], axis=0)
+    kth     = np.unique(np.round(np.linspace(0, USample.shape[0]-1, nBins+1)[1:-1]).astype(int))
+    edges   = USample[kth, :]
+    S       = kth.size + 1
+
+    # Bin of each point for each direction, offset so that the bins of all
+    # directions can be counted together
+    iBin = np.empty((N, d), dtype=np.intp)
+    for n in range(d):
+        iBin[:, n] = np.searchsorted(edges[:, n], UTrain[:, n], side='left') + n*S
+    iBin = iBin.ravel()
+
+    binCounts = np.bincount(iBin, minlength=d*S).reshape(d, S)
+    binSums   = np.empty((d, S, K))
+    binSqSums = np.empty((d, S, K))
+    for k in range(K):
+        vk = np.repeat(VTrain[:, k], d)
+        binSums[:, :, k]   = np.bincount(iBin, weights=vk,    minlength=d*S).reshape(d, S)
+        binSqSums[:, :, k] = np.bincount(iBin, weights=vk**2, minlength=d*S).reshape(d, S)
+
+    nLeft     = np.cumsum(binCounts, axis=1)[:, :, np.newaxis]
+    leftCum   = np.cumsum(binSums,   axis=1)
+    cumSqLeft = np.cumsum(binSqSums, axis=1)
+    nRight    = np.subtract(N, nLeft)
+
+    metricLeft  = np.divide(cumSqLeft, nLeft) - np.divide(leftCum, nLeft)**2
+    metricRight = np.divide(np.subtract(cumSqLeft[:, -1, np.newaxis, :], cumSqLeft), nRight) -\
+                  np.divide(np.subtract(leftCum[:, -1, np.newaxis, :], leftCum), nRight)**2
+    metricRight[:, -1, :] = 0
+
+    # Repeated edges give empty bins, only the first of which is kept, and
+    # as for the exact search the points either side of a split must differ
+    bValid = np.logical_and(np.logical_and(binCounts > 0, nLeft[:, :, 0] < N), edgeGaps(UTrain, iBin, d, S) > options["XVariationTol"])
+
+    return gainsFromMetrics(metricLeft, metricRight, nLeft, N, bValid, options), nLeft[:, :, 0]
+
+
+#-----------------------------------------------------------------------------#
+def searchSplits(UTrain, VTrain, options, eps=2.2204e-16, maxBlockSize=2**22, rng=None):
+    """
+    Searches for the best split along every projection direction.  All
+    columns of UTrain are sorted together and the gains of the candidate
+    splits are calculated for blocks of directions at a time, with the block
+    size chosen so that the d x N x K working arrays have at most
+    maxBlockSize elements.  Ties are broken at random per direction, drawing
+    from rng (see getGenerator) in the same order as when searching one
+    direction at a time.
+
+    Parameters
+    ----------
+    UTrain:  N x nProjDirs array of projected training points
+    VTrain:  N x K array of outputs, or their projections if
+             bUseOutputComponentsMSE is used
+    options: Options dict
+
+    Returns
+    -------
+    bStop:      True if the total variation of the outputs is less than the
+                allowed tolerance, in which case a leaf should be made
+    splitGains: nProjDirs x 1 array of the best gain for each direction
+    iSplits:    nProjDirs x 1 array of the index in the sorted order of the
+                last point going left for the best split of each direction
+    """
+    N, nProjDirs = UTrain.shape
+    K   = VTrain.shape[1]
+    rng = getGenerator(rng)
+
+    iUTrainSort = np.argsort(UTrain, axis=0)
+    UTrainSort  = np.take_along_axis(UTrain, iUTrainSort, axis=0)
+
+    metricGain = np.empty((nProjDirs, N))
+    bLowVar    = np.zeros((nProjDirs,), dtype=bool)
+    blockSize  = max(1, maxBlockSize // (N * K))
+    for iStart in range(0, nProjDirs, blockSize):
+        iBlock = np.arange(iStart, min(iStart+blockSize, nProjDirs))
+        metricGain[iBlock, :], bLowVar[iBlock] = metricGainsBlock(UTrainSort[:, iBlock].T, VTrain[iUTrainSort[:, iBlock].T, :], options)
+
+    splitGains = np.empty((nProjDirs,1))
+    splitGains.fill(np.nan)
+    iSplits    = np.empty((nProjDirs,1))
+    iSplits.fill(np.nan)
+
+    for nVarAtt in range(nProjDirs):
+        if bLowVar[nVarAtt]:
+            # Total variation is less then the allowed tolerance so
+            # terminate and construct a leaf
+            return True, splitGains, iSplits
+
+        # Randomly sample from equally best splits
+        iSplits[nVarAtt]    = np.argmax(metricGain[nVarAtt, 0:-1])
+        splitGains[nVarAtt] = np.max(metricGain[nVarAtt, 0:-1])
+        iEqualMax = ((np.absolute(metricGain[nVarAtt, 0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
+        if iEqualMax.size == 0:
+            iEqualMax = np.array([1])
+        iSplits[nVarAtt] = iEqualMax[rng.integers(iEqualMax.size)]
+
+    return False, splitGains, iSplits
+
+
+def searchSplitsBinned(UTrain, VTrain, options, nBins, eps=2.2204e-16, rng=None):
+    """
+    Approximate version of searchSplits for large nodes, only considering
+    splits at the edges of nBins quantile bins of each direction (see
+    binnedGains).  Returns the same outputs as searchSplits, the index of a
+    split being that of the last point going left in the sorted order.
+    """
+    rng = getGenerator(rng)
+    N, nProjDirs = UTrain.shape
+
+    splitGains = np.empty((nProjDirs,1))
+    splitGains.fill(np.nan)
+    iSplits    = np.empty((nProjDirs,1))
+    iSplits.fill(np.nan)
+
+    varData = np.var(VTrain, axis=0)
+    if np.all(varData < (options["mseTotal"] * options["mseErrorTolerance"])):
+        # Total variation is less then the allowed tolerance so
+        # terminate and construct a leaf
+        return True, splitGains, iSplits
+
+    metricGain, nLeft = binnedGains(UTrain, VTrain, options, nBins)
+
+    for nVarAtt in range(nProjDirs):
+        # Randomly sample from equally best splits
+        splitGains[nVarAtt] = np.max(metricGain[nVarAtt, 0:-1])
+        iEqualMax = ((np.absolute(metricGain[nVarAtt, 0:-1] - splitGains[nVarAtt]) < (10*eps)).ravel().nonzero())[0]
+        if iEqualMax.size == 0:
+            iEqualMax = np.array([0])
+        iSplits[nVarAtt] = nLeft[nVarAtt, iEqualMax[rng.integers(iEqualMax.size)]] - 1
+
+    return False, splitGains, iSplits
@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
+import numpy as np
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ThreadPoolExecutor as ThreadPool
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from primitives_ubc.regCCFS.src.utils.categoricalUtils import CategoricalMatrix
+
+import logging
+logger  = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------#
+# Executors used to grow the trees of a forest.  Each runs
+# taskFunction(context, task) for a list of tasks, where context is a dict
+# holding the training data, under the keys XTrain and YTrain, and anything
+# else shared by all of the tasks.  The executors only differ in where the
+# tasks are run and how the context is sent there:
+#   - start(taskFunction, context, tasks) starts running the tasks
+#   - next(timeout) returns the result of a finished task, in any order, or
+#     None if no task finished within timeout seconds
+#   - stop(bCancel) releases the workers once all results have been
+#     collected, or if bCancel is true, abandons the outstanding tasks
+# The thread executor also adds stopEvent to the context, a threading.Event
+# set on cancelling, after which running tasks should return early.
+# An executor can be started again once stopped.
+
+BACKENDS = ['serial', 'thread', 'process', 'remote']
+
+# Environment variable holding the key used to authenticate remote workers
+AUTHKEY_VARIABLE = 'CCFS_WORKER_AUTHKEY'
+
+# Seconds between checks for cancellation while waiting on a remote worker
+POLL_INTERVAL = 0.1
+
+
+def numberOfJobs(nJobs):
+    """
+    Number of workers to use, all of the cpus if nJobs is None or below 1.
+    """
+    if (nJobs is None) or (nJobs < 1):
+        return mp.cpu_count()
+    return int(nJobs)
+
+
+def getTreeExecutor(backend='process', nJobs=None, remoteWorkers=None):
+    """
+    Creates an executor for growing trees.
+
+    Parameters
+    ----------
+    backend: One of
+             - 'serial'  = Grow the trees one after another in this process
+             - 'thread'  = Pool of nJobs threads.  Most of the numerical work
+                           releases the GIL, and the training data is shared
+                           without copies.
+             - 'process' = Pool of nJobs processes, with the training data
+                           shared through memory-mapped files
+             - 'remote'  = Workers on other hosts, see RemoteExecutor
+    nJobs: Number of threads or processes, all of the cpus by default
+    remoteWorkers: Addresses of the remote workers, either as a list of
+                   (host, port) or a comma separated string of host:port
+
+    Returns
+    -------
+    executor: Executor object
+    """
+    if backend == 'serial':
+        return SerialExecutor()
+    elif backend == 'thread':
+        return ThreadExecutor(nJobs)
+    elif backend == 'process':
+        return ProcessExecutor(nJobs)
+    elif backend == 'remote':
+        return RemoteExecutor(remoteWorkers)
+    else:
+        raise ValueError('Invalid executor backend {}, must be one of {}!'.format(backend, BACKENDS))
+
+
+#-------------------------------------------------------------------------------#
+class SerialExecutor(object):
+    """
+    Runs the tasks one after another in this process, each when its result
+    is requested.  A timeout only prevents the next task from starting once
+    it has passed.
+    """
+    def __init__(self):
+        self.nJobs  = 1
+        self._tasks = deque()
+
+    def start(self, taskFunction, context, tasks):
+        self._taskFunction = taskFunction
+        self._context      = context
+        self._tasks        = deque(tasks)
+
+    def next(self, timeout=None):
+        if ((timeout is not None) and (timeout <= 0)) or (not self._tasks):
+            return None
+        return self._taskFunction(self._context, self._tasks.popleft())
+
+    def stop(self, bCancel=False):
+        self._tasks   = deque()
+        self._context = None
+
+
+#-------------------------------------------------------------------------------#
+class ThreadExecutor(object):
+    """
+    Runs the tasks on a pool of threads sharing the context.  Threads cannot
+    be killed, so tasks that have already started when cancelled are told
+    to stop through context["stopEvent"].
+    """
+    def __init__(self, nJobs=None):
+        self.nJobs = numberOfJobs(nJobs)
+
+    def start(self, taskFunction, context, tasks):
+        self._bStop   = threading.Event()
+        context       = dict(context, stopEvent=self._bStop)
+        self._pool    = ThreadPool(max_workers=max(1, min(self.nJobs, len(tasks))))
+        self._pending = set([self._pool.submit(taskFunction, context, task) for task in tasks])
+
+    def next(self, timeout=None):
+        done, _ = wait(self._pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            return None
+        future = done.pop()
+        self._pending.discard(future)
+        return future.result()
+
+    def stop(self, bCancel=False):
+        if bCancel:
+            self._bStop.set()
+            if sys.version_info >= (3, 9):
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                for future in self._pending:
+                    future.cancel()
+                self._pool.shutdown(wait=False)
+        else:
+            self._pool.shutdown(wait=True)
+        self._pending = set()
+
+
+#-------------------------------------------------------------------------------#
+# Context held by each worker process of a ProcessExecutor.  This is set
+# once per worker so that only the tasks need to be sent.
+_workerContext = {}
+
+def shareTrainingData(XTrain, YTrain, folder):
+    """
+    Writes the training data to .npy files in folder so that the worker
+    processes can memory-map a single copy instead of each task receiving a
+    pickled copy of the full matrices.
+
+    Returns
+    -------
+    paths: dict giving the file holding XTrain and YTrain.  For a
+           CategoricalMatrix the ordinal features and codes are written
+           instead of XTrain, with the small remaining details kept in
+           paths["categorical"].
+    """
+    paths = {}
+    if isinstance(XTrain, CategoricalMatrix):
+        arrays = [('XOrd', XTrain.XOrd), ('codes', XTrain.codes), ('YTrain', YTrain)]
+        paths["categorical"] = (XTrain.nCats, XTrain.mu, XTrain.std)
+    else:
+        arrays = [('XTrain', XTrain), ('YTrain', YTrain)]
+
+    for name, data in arrays:
+        paths[name] = os.path.join(folder, name + '.npy')
+        np.save(paths[name], np.ascontiguousarray(data))
+
+    return paths
+
+
+def initSharedWorker(taskFunction, paths, context):
+    """
+    Pool initializer, memory-maps the shared training data read only.
+    """
+    context = dict(context)
+    if "categorical" in paths:
+        context["XTrain"] = CategoricalMatrix(np.load(paths["XOrd"], mmap_mode='r'), np.load(paths["codes"], mmap_mode='r'),\
+                                              *paths["categorical"])
+    else:
+        context["XTrain"] = np.load(paths["XTrain"], mmap_mode='r')
+    context["YTrain"] = np.load(paths["YTrain"], mmap_mode='r')
+    _workerContext["taskFunction"] = taskFunction
+    _workerContext["context"]      = context
+
+
+def runSharedTask(task):
+    """
+    Runs a single task in a worker process on its shared context.
+    """
+    return _workerContext["taskFunction"](_workerContext["context"], task)
+
+
+class ProcessExecutor(object):
+    """
+    Runs the tasks on a pool of worker processes.  The training data is
+    placed once in memory-mapped files, workers are sent one task at a
+    time, and the pool and files are always cleaned up by stop.
+    """
+    def __init__(self, nJobs=None):
+        self.nJobs = numberOfJobs(nJobs)
+
+    def start(self, taskFunction, context, tasks):
+        nProcesses = max(1, min(self.nJobs, len(tasks)))
+
+        self._folder = tempfile.mkdtemp(prefix='ccf_')
+        try:
+            paths  = shareTrainingData(context["XTrain"], context["YTrain"], self._folder)
+            shared = {key: value for key, value in context.items() if key not in ["XTrain", "YTrain"]}
+            self._pool = mp.Pool(processes=nProcesses, initializer=initSharedWorker, initargs=(taskFunction, paths, shared))
+        except:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            raise
+        # Only with a chunksize of 1 is the result an iterator whose next
+        # takes a timeout, and a tree costs far more than sending its task
+        self._results = self._pool.imap_unordered(runSharedTask, tasks, chunksize=1)
+
+    def next(self, timeout=None):
+        try:
+            return self._results.next(timeout=timeout)
+        except mp.TimeoutError:
+            return None
+
+    def stop(self, bCancel=False):
+        try:
+            if bCancel:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+        finally:
+            shutil.rmtree(self._folder, ignore_errors=True)
+
+
+#-------------------------------------------------------------------------------#
+def parseAddresses(addresses):
+    """
+    Converts a comma separated string of host:port to a list of (host, port).
+    """
+    if isinstance(addresses, str):
+        addresses = [address.strip().rsplit(':', 1) for address in addresses.split(',') if address.strip()]
+    return [(host, int(port)) for host, port in addresses]
+
+
+def workerAuthkey(authkey=None):
+    """
+    Key used to authenticate the connections to remote workers, read from
+    the environment variable CCFS_WORKER_AUTHKEY by default.  Tasks and
+    results are sent pickled, so connections are never accepted without one.
+    """
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_VARIABLE, '')
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if len(authkey) == 0:
+        raise ValueError('Remote workers need an authentication key, set {}!'.format(AUTHKEY_VARIABLE))
+
+    return authkey
+
+
+def runWatchedTask(conn, taskFunction, context, task):
+    """
+    Runs a task in a thread while watching conn, returning (True, result) or
+    (False, traceback).  Nothing is sent to a worker while its task runs, so
+    anything arriving on conn means the executor has closed the connection,
+    in which case the worker process exits without finishing the task.
+    """
+    outcome = []
+    def runTask():
+        try:
+            outcome.append((True, taskFunction(context, task)))
+        except Exception:
+            outcome.append((False, traceback.format_exc()))
+
+    thread = threading.Thread(target=runTask)
+    thread.daemon = True
+    thread.start()
+    while thread.is_alive():
+        thread.join(POLL_INTERVAL)
+        if thread.is_alive() and conn.poll():
+            logger.info('Connection closed, cancelling the running task')
+            os._exit(0)
+
+    return outcome[0]
+
+
+def remoteWorkerLoop(conn):
+    """
+    Serves a single connection to a RemoteExecutor, in a process of its own.
+    The first message gives the task function and context, after which each
+    message is a task, answered with (True, result) or (False, traceback),
+    until None or the connection is closed.
+    """
+    try:
+        taskFunction, context = conn.recv()
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            conn.send(runWatchedTask(conn, taskFunction, context, task))
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+def serveTreeWorkers(address, authkey=None):
+    """
+    Accepts connections from RemoteExecutors on address, a (host, port)
+    tuple, serving each in its own process, until interrupted.  A host with
+    several cpus can thus be listed several times in the addresses of an
+    executor.  The worker must be able to import this package.
+    """
+    listener = Listener(address, authkey=workerAuthkey(authkey))
+    logger.info('Tree worker listening on {}:{}'.format(*listener.address))
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (mp.AuthenticationError, EOFError, OSError):
+                logger.warning('Rejected a connection that failed authentication')
+                continue
+            worker = mp.Process(target=remoteWorkerLoop, args=(conn,))
+            worker.daemon = True
+            worker.start()
+            conn.close()
+    finally:
+        listener.close()
+
+
+class RemoteExecutor(object):
+    """
+    Runs the tasks on workers started on other hosts with serveTreeWorkers,
+    e.g. with
+
+        python -m primitives_ubc.regCCFS.src.training_utils.tree_executors host:port
+
+    One connection is made to each address, which is sent the task function
+    and context once and then one task at a time, so an address can be
+    repeated to run several tasks on it at once.  The connections are
+    authenticated with the key from workerAuthkey.  The task of a worker
+    that fails is handed to the others, and an error is raised if the
+    workers have all stopped with tasks outstanding.  Cancelling closes the
+    connections, which stops the workers' running tasks.
+    """
+    def __init__(self, addresses, authkey=None):
+        self.addresses = parseAddresses(addresses)
+        if len(self.addresses) == 0:
+            raise ValueError('No remote worker addresses given!')
+        self.nJobs    = len(self.addresses)
+        self._authkey = authkey
+
+    def start(self, taskFunction, context, tasks):
+        authkey = workerAuthkey(self._authkey)
+        self._tasks   = queue.Queue()
+        self._results = queue.Queue()
+        self._bStop   = threading.Event()
+        self._errors  = []
+        for task in tasks:
+            self._tasks.put(task)
+
+        self._threads = [threading.Thread(target=self._serveConnection, args=(address, authkey, taskFunction, context))\
+                         for address in self.addresses]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _serveConnection(self, address, authkey, taskFunction, context):
+        """
+        Sends tasks to the worker at address until none are left.
+        """
+        task = None
+        try:
+            conn = Client(address, authkey=authkey)
+            try:
+                conn.send((taskFunction, context))
+                while not self._bStop.is_set():
+                    try:
+                        task = self._tasks.get_nowait()
+                    except queue.Empty:
+                        break
+                    conn.send(task)
+                    while not conn.poll(POLL_INTERVAL):
+                        if self._bStop.is_set():
+                            return
+                    bOk, result = conn.recv()
+                    task = None
+                    self._results.put((bOk, result))
+                    if not bOk:
+                        break
+                if not self._bStop.is_set():
+                    conn.send(None)
+            finally:
+                conn.close()
+        except (EOFError, OSError, mp.AuthenticationError) as e:
+            if not self._bStop.is_set():
+                logger.warning('Remote worker {}:{} failed: {!r}'.format(address[0], address[1], e))
+            self._errors.append('{}:{}: {!r}'.format(address[0], address[1], e))
+            if task is not None:
+                self._tasks.put(task)
+
+    def next(self, timeout=None):
+        endTime = None if (timeout is None) else (time.time() + timeout)
+        while True:
+            waitTime = 0.1 if (endTime is None) else min(0.1, max(0, endTime - time.time()))
+            try:
+                bOk, result = self._results.get(timeout=waitTime)
+            except queue.Empty:
+                if not any([thread.is_alive() for thread in self._threads]) and self._results.empty():
+                    raise RuntimeError('Remote workers stopped with tasks outstanding!\n' + '\n'.join(self._errors))
+                if (endTime is not None) and (time.time() >= endTime):
+                    return None
+                continue
+            if not bOk:
+                raise RuntimeError('Task failed on a remote worker:\n' + result)
+            return result
+
+    def stop(self, bCancel=False):
+        # Each thread closes its connection once it sees the stop, at most
+        # POLL_INTERVAL seconds later if it is waiting on a running task
+        self._bStop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    serveTreeWorkers(parseAddresses(sys.argv[1])[0])
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+class CategoricalMatrix(object):
+    """
+    Processed training features with the categorical features held as
+    integer codes rather than dense one-hot columns.  Behaves as the matrix
+    that processInputData would otherwise return, i.e. the ordinal features
+    followed by the z-scored indicator columns of each expanded categorical
+    feature, but the indicator columns are only formed for the rows and
+    columns that are indexed.  Memory is thus proportional to the number of
+    original features rather than to the total number of categories.
+
+    Indexing as X[rows, cols] is outer indexing (as with np.ix_), so both
+    X[rows[:, np.newaxis], iIn] and X[rows, :] gather a dense block.  Any
+    other use, e.g. the tree rotations, falls back to the full dense matrix
+    through np.asarray(X) or X.toarray().
+
+    Parameters
+    ----------
+    XOrd:  N x nOrd array of the processed ordinal features
+    codes: N x C integer array giving the index of the category of each
+           point for each of the C expanded categorical features, negative
+           for categories that are unseen or missing
+    nCats: Length C array of the number of categories of each feature
+    mu, std: Length sum(nCats) arrays used to z-score the indicator columns
+    """
+    def __init__(self, XOrd, codes, nCats, mu, std):
+        self.XOrd  = XOrd
+        self.codes = codes
+        self.nCats = np.asarray(nCats, dtype=int)
+
+        # The indicator columns are formed in the precision of XOrd
+        dtype      = XOrd.dtype if np.issubdtype(XOrd.dtype, np.floating) else float
+        self.mu    = np.asarray(mu,  dtype=dtype)
+        self.std   = np.asarray(std, dtype=dtype)
+
+        # Categorical feature and category of each indicator column
+        self.iCatFeature = np.repeat(np.arange(self.nCats.size), self.nCats)
+        self.iCategory   = np.arange(self.iCatFeature.size) -\
+                           np.repeat(np.cumsum(self.nCats) - self.nCats, self.nCats)
+
+        self.nOrd  = XOrd.shape[1]
+        self.shape = (XOrd.shape[0], self.nOrd + self.iCatFeature.size)
+        self.ndim  = 2
+        self.dtype = np.result_type(XOrd.dtype, self.mu.dtype)
+
+    def replaceOrdinal(self, XOrd):
+        """
+        Copy of the matrix with different values of the ordinal features,
+        e.g. with missing values filled in.  The codes are shared.
+        """
+        return CategoricalMatrix(XOrd, self.codes, self.nCats, self.mu, self.std)
+
+    def astype(self, dtype, copy=True):
+        """
+        Copy of the matrix with the ordinal features and the z-scoring of the
+        indicator columns held as dtype.  The codes are shared.
+        """
+        return CategoricalMatrix(self.XOrd.astype(dtype, copy=copy), self.codes, self.nCats, self.mu, self.std)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+
+        rows = self._indices(rows, self.shape[0])
+        cols = self._indices(cols, self.shape[1])
+
+        X = np.empty((rows.size, cols.size), dtype=self.dtype)
+
+        bOrd = cols < self.nOrd
+        if np.any(bOrd):
+            X[:, bOrd] = self.XOrd[rows[:, np.newaxis], cols[bOrd]]
+
+        iInd = cols[~bOrd] - self.nOrd
+        if iInd.size > 0:
+            bIsCat = np.equal(self.codes[rows[:, np.newaxis], self.iCatFeature[iInd]], self.iCategory[iInd])
+            X[:, ~bOrd] = np.divide(np.subtract(bIsCat, self.mu[iInd]), self.std[iInd])
+
+        return X
+
+    def __array__(self, dtype=None):
+        X = self[:, :]
+        if dtype is not None:
+            X = X.astype(dtype)
+
+        return X
+
+    def toarray(self):
+        """
+        Full dense matrix
+        """
+        return self[:, :]
+
+    @staticmethod
+    def _indices(index, n):
+        """
+        Integer indices for a slice, Boolean mask or array of indices.  Row
+        vectors from index[:, np.newaxis] are flattened.
+        """
+        if isinstance(index, slice):
+            return np.arange(*index.indices(n))
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            return index.ravel().nonzero()[0]
+
+        return index.ravel().astype(np.intp)
+
+
+def indicatorMoments(codes, nCats):
+    """
+    Mean and standard deviation (ddof=1) of each indicator column of the
+    one-hot expansion of the codes, found from the counts of each category.
+
+    Parameters
+    ----------
+    codes: N x C integer array of category codes, negative for none
+    nCats: Length C array of the number of categories of each feature
+
+    Returns
+    -------
+    mu, std: Length sum(nCats) arrays
+    """
+    N = codes.shape[0]
+    counts = np.concatenate([np.bincount(codes[codes[:, n] >= 0, n], minlength=nCats[n]) for n in range(codes.shape[1])])
+
+    mu  = counts / N
+    var = (counts * (1 - mu)**2 + (N - counts) * mu**2) / (N - 1)
+
+    return mu, np.sqrt(var)
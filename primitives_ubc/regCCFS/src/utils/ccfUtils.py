@@ -1,6 +1,48 @@
+import hashlib
 import numpy as np
+import pandas as pd
+from scipy import sparse
 
-def genFeatureExpansionParameters(X, nF, s=0.1):
+def getGenerator(rng=None):
+    """
+    Returns rng if given, otherwise a new random Generator seeded from the
+    global numpy random state, so that callers that do not pass a generator
+    are still controlled by np.random.seed.
+
+    Parameters
+    ----------
+    rng: Optional numpy.random.Generator
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(0, 2**31 - 1))
+
+    return rng
+
+
+def treeGenerator(seed, pos):
+    """
+    Random Generator for the tree at position pos of a forest grown from
+    seed.  Each tree gets an independent stream that depends only on seed
+    and pos, so the trees do not depend on the order they are grown in or
+    on the process that grows them.
+
+    Parameters
+    ----------
+    seed: Non-negative int
+    pos:  int, index of the tree in the forest
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+    """
+    return np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key=(int(pos),)))
+
+
+def genFeatureExpansionParameters(X, nF, s=0.1, rng=None):
     """
     Generates random feature parameters for kernel CCA.
 
@@ -9,21 +51,23 @@ def genFeatureExpansionParameters(X, nF, s=0.1):
     X: Numpy array
     nF: float
     S: float
+    rng: Optional numpy.random.Generator, see getGenerator
 
     Returns
     -------
     w: Numpy array
     b: Numpy array
     """
-    M = X.shape[1]
+    M   = X.shape[1]
+    rng = getGenerator(rng)
 
-    w = s * np.random.randn(M, nF)
-    b = 2 * np.pi *np.random.rand(1, nF)
+    w = s * rng.standard_normal((M, nF))
+    b = 2 * np.pi * rng.random((1, nF))
 
     return w, b
 
 
-def manyRandPerms(nVarTot, nVarSel, nTimes):
+def manyRandPerms(nVarTot, nVarSel, nTimes, rng=None):
     """
     Generate a number of random permutations.
 
@@ -32,17 +76,19 @@ def manyRandPerms(nVarTot, nVarSel, nTimes):
     nVarTot: int
     nVarSel: int
     nTimes: int
+    rng: Optional numpy.random.Generator, see getGenerator
 
     Returns
     -------
     terms: Numpy array
     """
+    rng   = getGenerator(rng)
     terms = np.empty((nTimes, nVarSel))
     terms.fill(np.nan)
 
     for n in range(nTimes):
         rand_range = np.arange(0, nVarSel) # Changed to match Python Idxing
-        terms[n,:] = np.random.permutation(rand_range)
+        terms[n,:] = rng.permutation(rand_range)
 
     return terms
 
@@ -108,7 +154,7 @@ def random_feature_expansion(X, w, b):
     return Z
 
 
-def random_missing_vals(X, mu=0, sig=1):
+def random_missing_vals(X, mu=0, sig=1, rng=None):
     """
     Randomly assigns missing values to draws from a normal with the mean and
     standard deviation of the data.
@@ -118,6 +164,7 @@ def random_missing_vals(X, mu=0, sig=1):
     X: Numpy array
     mu: float
     sig: float
+    rng: Optional numpy.random.Generator, see getGenerator
 
     Returns
     -------
@@ -127,24 +174,25 @@ def random_missing_vals(X, mu=0, sig=1):
     nRands = np.sum(bNaN[:])
 
     if nRands != 0:
-        X[bNaN] = sig * np.random.randn(nRands) + mu
+        X[bNaN] = sig * getGenerator(rng).standard_normal(nRands) + mu
 
     return X
 
 
-def randomRotation(N):
+def randomRotation(N, rng=None):
     """
     Random rotation matrix of given dimension
 
     Parameters
     ----------
     N: int
+    rng: Optional numpy.random.Generator, see getGenerator
 
     Returns
     -------
     Q: Numpy array
     """
-    Q, R = np.linalg.qr(np.random.randn(N, N))
+    Q, R = np.linalg.qr(getGenerator(rng).standard_normal((N, N)))
     Q = Q @ np.diag(np.sign(np.diag(R)))
 
     detR = np.linalg.det(Q)
@@ -154,6 +202,111 @@ def randomRotation(N):
     return Q
 
 
+def randomSketch(N, nSketch, method='gaussian', rng=None):
+    """
+    Random sketching matrix for reducing N features to nSketch.
+
+    Parameters
+    ----------
+    N: int
+    nSketch: int
+    method: 'gaussian' for a dense Gaussian projection or 'countsketch' for
+            a sparse matrix hashing each feature to one of the nSketch
+            outputs with a random sign
+    rng: Optional numpy.random.Generator, see getGenerator
+
+    Returns
+    -------
+    S: N x nSketch Numpy array, or scipy sparse matrix for 'countsketch'
+    """
+    rng = getGenerator(rng)
+    if method == 'gaussian':
+        S = rng.standard_normal((N, nSketch)) / np.sqrt(nSketch)
+    elif method == 'countsketch':
+        iBucket = rng.integers(nSketch, size=N)
+        signs   = 2.0 * rng.integers(2, size=N) - 1
+        S = sparse.csr_matrix((signs, (np.arange(N), iBucket)), shape=(N, nSketch))
+    else:
+        assert (False), 'Invalid sketch method!'
+
+    return S
+
+
+def subsampleRows(N, nSample, strata=None, rng=None):
+    """
+    Random subsample of nSample of N rows without replacement.  If strata
+    are given, the rows are sampled from each distinct row of strata in
+    proportion to its size, rounded by largest remainder, with at least one
+    row taken from each.  If there are more strata than nSample, one row is
+    taken from each of nSample strata chosen in proportion to their size.
+
+    Parameters
+    ----------
+    N: int
+    nSample: int
+    strata: Optional N x K Numpy array, e.g. class indicators
+    rng: Optional numpy.random.Generator, see getGenerator
+
+    Returns
+    -------
+    iSample: Sorted indices of the sampled rows
+    """
+    rng = getGenerator(rng)
+    if strata is None:
+        return np.sort(rng.choice(N, nSample, replace=False))
+
+    _, iStrata, counts = np.unique(strata, axis=0, return_inverse=True, return_counts=True)
+    iStrata = iStrata.ravel()
+    if nSample < counts.size:
+        nTake = np.zeros(counts.shape, dtype=int)
+        nTake[rng.choice(counts.size, nSample, replace=False, p=counts/N)] = 1
+    else:
+        quota = nSample * counts / N
+        nTake = np.minimum(counts, np.maximum(1, np.floor(quota).astype(int)))
+        nExtra = nSample - np.sum(nTake)
+        if nExtra > 0:
+            # Rows left over from rounding down go to the largest remainders
+            remainder = np.where(nTake < counts, quota - nTake, -np.inf)
+            nTake[np.argsort(-remainder, kind='stable')[0:nExtra]] += 1
+        for _ in range(-nExtra):
+            # Rows given to the small strata are taken from the largest
+            nTake[np.argmax(nTake)] -= 1
+
+    # Shuffle and then group by stratum, taking the first nTake of each
+    iPerm  = rng.permutation(N)
+    iPerm  = iPerm[np.argsort(iStrata[iPerm], kind='stable')]
+    starts = np.concatenate((np.array([0]), np.cumsum(counts)[0:-1]))
+    rank   = np.arange(N) - np.repeat(starts, counts)
+
+    return np.sort(iPerm[rank < np.repeat(nTake, counts)])
+
+
+def trainingFingerprint(XTrain, YTrain):
+    """
+    Shapes and a hash of the training data as given to genCCF, stored in
+    the forest so that trees are only added to it using the same data.
+
+    Parameters
+    ----------
+    XTrain: Numpy array or pandas DataFrame of training inputs
+    YTrain: Numpy array or pandas DataFrame of training outputs
+
+    Returns
+    -------
+    fingerprint: dict with fields shapes (list of the shape of each) and
+                 hash (hex digest of the values of both)
+    """
+    digest = hashlib.sha1()
+    shapes = []
+    for data in [XTrain, YTrain]:
+        if not isinstance(data, (pd.DataFrame, pd.Series)):
+            data = pd.DataFrame(np.asarray(data))
+        shapes.append([int(n) for n in data.shape])
+        digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+
+    return {"shapes": shapes, "hash": digest.hexdigest()}
+
+
 def regCCA_alt(X, Y, gammaX, gammaY, corrTol):
     """
     Fast regularized CCA.  Used when doing kernel CCA.
@@ -0,0 +1,298 @@
+import numpy as np
+from collections import deque, OrderedDict
+
+
+def isFlatTree(tree):
+    """
+    Check if a tree is stored in the flat (structure-of-arrays) format
+
+    Parameters
+    ----------
+    tree: dict
+
+    Returns
+    -------
+    bFlat: Boolean
+    """
+    return bool(tree.get("bFlat", False))
+
+
+def flattenCCT(tree):
+    """
+    Converts a nested tree struct as produced by growCCT into a flat
+    structure-of-arrays tree.  Nodes are numbered in breadth first order with
+    the root at index 0, so that all nodes of one depth are contiguous.
+
+    Parameters
+    ----------
+    tree: dict
+          Nested tree struct with lessthanChild/greaterthanChild sub-trees
+
+    Returns
+    -------
+    flatTree: dict
+          - bFlat = True
+          - bLeaf = (nNodes,) Boolean array, True for leaf nodes
+          - depth = (nNodes,) depth of each node (zero based)
+          - Npoints = (nNodes,) number of training points at each node
+          - mean = (nNodes, K) mean of the outputs at each node.  For
+                   leaves this is the prediction.
+          - lessthanChild, greaterthanChild = (nNodes,) child indices, -1
+                   for leaves
+          - iIn = (nNodes, maxIn) feature indices used by the projection of
+                   each node, padded with 0
+          - decisionProjection = (nNodes, maxIn) projection weights for the
+                   features in iIn, padded with 0
+          - paritionPoint = (nNodes,) split threshold, NaN for leaves
+          - featureExpansion = dict of node index -> [wZ, bZ, bIncOrig, proj]
+                   for nodes using random feature expansion (bRCCA)
+          - rotDetails and any other tree level fields are copied across
+    """
+    if isFlatTree(tree):
+        return tree
+
+    # Breadth first ordering of the nodes
+    nodes  = []
+    depths = []
+    queue  = deque([(tree, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        nodes.append(node)
+        depths.append(depth)
+        if not node["bLeaf"]:
+            queue.append((node["lessthanChild"], depth+1))
+            queue.append((node["greaterthanChild"], depth+1))
+
+    nNodes = len(nodes)
+    K      = np.asarray(nodes[0]["mean"]).size
+    maxIn  = max([1] + [np.asarray(node["iIn"]).size for node in nodes if not node["bLeaf"]])
+
+    bLeaf   = np.zeros((nNodes,), dtype=bool)
+    Npoints = np.zeros((nNodes,), dtype=np.int64)
+    mean    = np.zeros((nNodes, K))
+    lessthanChild    = np.full((nNodes,), -1, dtype=np.int32)
+    greaterthanChild = np.full((nNodes,), -1, dtype=np.int32)
+    iIn = np.zeros((nNodes, maxIn), dtype=np.int32)
+    decisionProjection = np.zeros((nNodes, maxIn))
+    paritionPoint      = np.full((nNodes,), np.nan)
+    featureExpansion   = {}
+
+    bHasStd = any(["std_dev" in node for node in nodes])
+    if bHasStd:
+        std_dev = np.full((nNodes, K), np.nan)
+
+    # Children are visited in the same order as they were queued, so their
+    # indices can be assigned with a running counter
+    iNext = 1
+    for n, node in enumerate(nodes):
+        bLeaf[n]   = node["bLeaf"]
+        Npoints[n] = node["Npoints"]
+        mean[n, :] = np.asarray(node["mean"]).ravel()
+        if bHasStd and ("std_dev" in node):
+            std_dev[n, :] = np.asarray(node["std_dev"]).ravel()
+
+        if node["bLeaf"]:
+            continue
+
+        lessthanChild[n]    = iNext
+        greaterthanChild[n] = iNext + 1
+        iNext = iNext + 2
+
+        nodeIn = np.asarray(node["iIn"]).ravel()
+        iIn[n, 0:nodeIn.size] = nodeIn
+        paritionPoint[n] = np.asarray(node["paritionPoint"]).ravel()[0]
+
+        proj = np.asarray(node["decisionProjection"]).ravel()
+        if ("featureExpansion" in node) and (not (len(node["featureExpansion"]) == 0)):
+            wZ, bZ, bIncOrig = node["featureExpansion"]
+            featureExpansion[n] = [wZ, bZ, bIncOrig, proj]
+        else:
+            decisionProjection[n, 0:proj.size] = proj
+
+    flatTree = {}
+    flatTree["bFlat"]   = True
+    flatTree["bLeaf"]   = bLeaf
+    flatTree["depth"]   = np.array(depths, dtype=np.int32)
+    flatTree["Npoints"] = Npoints
+    flatTree["mean"]    = mean
+    if bHasStd:
+        flatTree["std_dev"] = std_dev
+    flatTree["lessthanChild"]      = lessthanChild
+    flatTree["greaterthanChild"]   = greaterthanChild
+    flatTree["iIn"]                = iIn
+    flatTree["decisionProjection"] = decisionProjection
+    flatTree["paritionPoint"]      = paritionPoint
+    flatTree["featureExpansion"]   = featureExpansion
+
+    # Carry across any tree level details, e.g. rotations
+    nodeFields = ["bLeaf", "Npoints", "mean", "std_dev", "iIn", "decisionProjection",\
+                  "paritionPoint", "lessthanChild", "greaterthanChild", "featureExpansion"]
+    for key in tree.keys():
+        if key not in nodeFields:
+            flatTree[key] = tree[key]
+
+    return flatTree
+
+
+def castTree(tree, dtype):
+    """
+    Converts the floating point arrays of a flat tree (node means,
+    projections, thresholds, feature expansions and rotations) to dtype,
+    e.g. to store a forest in single precision.  Returns a new tree.
+    """
+    tree = flattenCCT(tree)
+
+    def cast(x):
+        x = np.asarray(x)
+        if np.issubdtype(x.dtype, np.floating):
+            return x.astype(dtype)
+        return x
+
+    flatTree = dict(tree)
+    for key in ["mean", "std_dev", "decisionProjection", "paritionPoint"]:
+        if key in tree:
+            flatTree[key] = cast(tree[key])
+    flatTree["featureExpansion"] = {node: [cast(wZ), cast(bZ), bIncOrig, cast(proj)]\
+                                    for node, (wZ, bZ, bIncOrig, proj) in tree["featureExpansion"].items()}
+    if ("rotDetails" in tree) and (not (len(tree["rotDetails"]) == 0)):
+        flatTree["rotDetails"] = {key: cast(value) for key, value in tree["rotDetails"].items()}
+
+    return flatTree
+
+
+def stackTrees(trees):
+    """
+    Stacks the flat trees of a forest into a single set of node arrays so
+    that all trees can be evaluated together.  Node indices are offset so
+    that they index into the stacked arrays, with tree n rooted at
+    roots[n].
+
+    Parameters
+    ----------
+    trees: dict or list of trees (flat or nested)
+
+    Returns
+    -------
+    stackedTrees: dict
+          - bStacked = True
+          - nTrees = Number of trees
+          - roots = (nTrees,) index of the root node of each tree
+          - nIn = (nTrees,) number of iIn columns of each tree before padding
+          - bLeaf, depth, Npoints, mean, lessthanChild, greaterthanChild,
+            iIn, decisionProjection, paritionPoint = as for flattenCCT but
+            concatenated over the trees
+          - featureExpansion = dict keyed by stacked node index
+          - bExpanded = (nNodes,) Boolean array, True where the node uses
+                        random feature expansion
+          - rotR, rotMu = (nTrees, D, D) and (nTrees, D) stacked tree
+                        rotations, only present if any tree is rotated.
+                        Trees without a rotation use the identity.
+          - bRotated = (nTrees,) Boolean array, True for the rotated trees,
+                        only present if any tree is rotated
+    """
+    if isinstance(trees, dict):
+        trees = list(trees.values())
+    trees = [flattenCCT(tree) for tree in trees]
+
+    nTrees  = len(trees)
+    nNodes  = np.array([tree["bLeaf"].size for tree in trees])
+    offsets = np.concatenate((np.array([0]), np.cumsum(nNodes)))
+    maxIn   = max([tree["iIn"].shape[1] for tree in trees])
+
+    def padCols(x, dtype):
+        xPad = np.zeros((x.shape[0], maxIn), dtype=dtype)
+        xPad[:, 0:x.shape[1]] = x
+        return xPad
+
+    def offsetChild(child, offset):
+        return np.where(child >= 0, child + offset, -1).astype(np.int32)
+
+    stackedTrees = {}
+    stackedTrees["bStacked"] = True
+    stackedTrees["nTrees"]   = nTrees
+    stackedTrees["roots"]    = offsets[0:-1].astype(np.int32)
+    stackedTrees["nIn"]      = np.array([tree["iIn"].shape[1] for tree in trees], dtype=np.int32)
+    for key in ["bLeaf", "depth", "Npoints", "mean", "paritionPoint"]:
+        stackedTrees[key] = np.concatenate([tree[key] for tree in trees], axis=0)
+    if all(["std_dev" in tree for tree in trees]):
+        stackedTrees["std_dev"] = np.concatenate([tree["std_dev"] for tree in trees], axis=0)
+    stackedTrees["lessthanChild"]      = np.concatenate([offsetChild(tree["lessthanChild"], offsets[n]) for n, tree in enumerate(trees)])
+    stackedTrees["greaterthanChild"]   = np.concatenate([offsetChild(tree["greaterthanChild"], offsets[n]) for n, tree in enumerate(trees)])
+    stackedTrees["iIn"]                = np.concatenate([padCols(tree["iIn"], np.int32) for tree in trees], axis=0)
+    stackedTrees["decisionProjection"] = np.concatenate([padCols(tree["decisionProjection"], tree["decisionProjection"].dtype) for tree in trees], axis=0)
+
+    featureExpansion = {}
+    for n, tree in enumerate(trees):
+        for node, details in tree["featureExpansion"].items():
+            featureExpansion[int(node + offsets[n])] = details
+    stackedTrees["featureExpansion"] = featureExpansion
+    bExpanded = np.zeros((offsets[-1],), dtype=bool)
+    bExpanded[list(featureExpansion.keys())] = True
+    stackedTrees["bExpanded"] = bExpanded
+
+    bRotated = [('rotDetails' in tree) and (not (len(tree["rotDetails"]) == 0)) for tree in trees]
+    if any(bRotated):
+        D = [tree["rotDetails"]["R"].shape[0] for n, tree in enumerate(trees) if bRotated[n]][0]
+        dtype = stackedTrees["decisionProjection"].dtype
+        rotR  = np.tile(np.eye(D, dtype=dtype), (nTrees, 1, 1))
+        rotMu = np.zeros((nTrees, D), dtype=dtype)
+        for n, tree in enumerate(trees):
+            if bRotated[n]:
+                rotR[n, :, :] = tree["rotDetails"]["R"]
+                rotMu[n, :]   = tree["rotDetails"]["muX"]
+        stackedTrees["rotR"]  = rotR
+        stackedTrees["rotMu"] = rotMu
+        stackedTrees["bRotated"] = np.array(bRotated)
+
+    return stackedTrees
+
+
+def unstackTrees(stackedTrees, keys=None):
+    """
+    Inverse of stackTrees, splits a stacked forest back into its flat trees.
+    The node arrays of each tree are slices of the stacked arrays, so no
+    copies are made of e.g. memory mapped forests beyond the child indices.
+
+    Parameters
+    ----------
+    stackedTrees: dict as returned by stackTrees
+    keys: Keys of the trees in the returned forest, defaults to 0...nTrees-1
+
+    Returns
+    -------
+    trees: OrderedDict of flat trees
+    """
+    nTrees  = stackedTrees["nTrees"]
+    offsets = np.append(stackedTrees["roots"], stackedTrees["bLeaf"].size)
+    if keys is None:
+        keys = range(nTrees)
+
+    nodeKeys = ["bLeaf", "depth", "Npoints", "mean", "paritionPoint"]
+    if "std_dev" in stackedTrees:
+        nodeKeys.append("std_dev")
+
+    # Tree of each expanded node
+    expandedNodes = np.array(sorted(stackedTrees["featureExpansion"].keys()), dtype=np.int64)
+    iExpanded     = np.searchsorted(expandedNodes, offsets)
+
+    trees = OrderedDict()
+    for n, key in enumerate(keys):
+        iNodes = slice(offsets[n], offsets[n+1])
+        nIn    = stackedTrees["nIn"][n]
+
+        tree = {}
+        tree["bFlat"] = True
+        for nodeKey in nodeKeys:
+            tree[nodeKey] = stackedTrees[nodeKey][iNodes]
+        for child in ["lessthanChild", "greaterthanChild"]:
+            tree[child] = np.where(stackedTrees[child][iNodes] >= 0, stackedTrees[child][iNodes] - offsets[n], -1).astype(np.int32)
+        tree["iIn"]                = stackedTrees["iIn"][iNodes, 0:nIn]
+        tree["decisionProjection"] = stackedTrees["decisionProjection"][iNodes, 0:nIn]
+        tree["featureExpansion"]   = {int(node - offsets[n]): stackedTrees["featureExpansion"][node]\
+                                      for node in expandedNodes[iExpanded[n]:iExpanded[n+1]]}
+        if ("bRotated" in stackedTrees) and stackedTrees["bRotated"][n]:
+            tree["rotDetails"] = {'R': stackedTrees["rotR"][n], 'muX': stackedTrees["rotMu"][n]}
+
+        trees[key] = tree
+
+    return trees
@@ -0,0 +1,234 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from sklearn.preprocessing import OneHotEncoder
+
+from primitives_ubc.regCCFS.src.utils.flatTreeUtils import stackTrees, unstackTrees
+
+HEADER_FILE = 'header.json'
+FORMAT_VERSION = 1
+
+
+#-----------------------------------------------------------------------------#
+def saveCCF(CCF, folder, minArraySize=64):
+    """
+    Saves a forest in a compact format that can be memory mapped by loadCCF:
+    the stacked node arrays of the trees (see flatTreeUtils.stackTrees) and
+    any other large arrays are packed into one .npy file per dtype, and a
+    small JSON header holds the options, input processing details and the
+    position of each array in the packed files.  Unlike pickling the forest
+    this needs no per-tree objects to be rebuilt on loading.
+
+    Parameters
+    ----------
+    CCF:    Forest as returned by genCCF or loadCCF
+    folder: Folder to save to, created if needed.  Existing files of the
+            same names are overwritten.
+    minArraySize: Numeric arrays with fewer elements than this are stored
+            in the header rather than in the packed files
+
+    Returns
+    -------
+    folder: The folder the forest was saved to
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    contents = OrderedDict((key, value) for key, value in CCF.items() if key not in ["Trees", "stackedTrees"])
+    stackedTrees = CCF["stackedTrees"] if ("stackedTrees" in CCF) else stackTrees(CCF["Trees"])
+    contents["stackedTrees"] = dict(stackedTrees, featureExpansion=packFeatureExpansion(stackedTrees["featureExpansion"]))
+    contents["treeKeys"]     = list(CCF["Trees"].keys())
+
+    arrays = OrderedDict()
+    header = {"formatVersion": FORMAT_VERSION, "CCF": toJSON(contents, arrays, 'CCF', minArraySize)}
+
+    # Pack the arrays of each dtype end to end, recording where each starts
+    header["arrays"] = {}
+    packed = OrderedDict()
+    for name, value in arrays.items():
+        dtype = np.dtype(value.dtype).newbyteorder('=').name
+        packed.setdefault(dtype, [])
+        header["arrays"][name] = [dtype, sum([a.size for a in packed[dtype]]), list(value.shape)]
+        packed[dtype].append(np.ravel(value))
+
+    for dtype, values in packed.items():
+        np.save(os.path.join(folder, dtype + '.npy'), np.concatenate(values).astype(dtype, copy=False), allow_pickle=False)
+
+    # The header is written last so that it only refers to complete arrays
+    with open(os.path.join(folder, HEADER_FILE), 'w') as f:
+        json.dump(header, f)
+
+    return folder
+
+
+def loadCCF(folder, mmap_mode='r'):
+    """
+    Loads a forest saved by saveCCF.  The arrays are memory mapped by
+    default, so that processes scoring with the same forest share its pages
+    and loading does not depend on the size of the forest.
+
+    Parameters
+    ----------
+    folder:    Folder given to saveCCF
+    mmap_mode: Passed to np.load, None reads the arrays into memory
+
+    Returns
+    -------
+    CCF: Forest as returned by genCCF, with the stacked trees used by
+         predictFromCCF stored in CCF["stackedTrees"] and the trees in
+         CCF["Trees"] being views of them
+    """
+    with open(os.path.join(folder, HEADER_FILE), 'r') as f:
+        header = json.load(f)
+    assert (header.get("formatVersion", None) == FORMAT_VERSION), 'Unsupported forest format version!'
+
+    packed = {}
+    for dtype in set([details[0] for details in header["arrays"].values()]):
+        # Viewed as a plain array, which still refers to the mapped pages,
+        # as slicing a memmap is comparatively slow
+        packed[dtype] = np.load(os.path.join(folder, dtype + '.npy'), mmap_mode=mmap_mode, allow_pickle=False).view(np.ndarray)
+
+    def loadArray(name):
+        dtype, offset, shape = header["arrays"][name]
+        return packed[dtype][offset:offset+int(np.prod(shape))].reshape(shape)
+
+    CCF = fromJSON(header["CCF"], loadArray)
+    CCF["stackedTrees"]["featureExpansion"] = unpackFeatureExpansion(CCF["stackedTrees"]["featureExpansion"])
+    CCF["Trees"] = unstackTrees(CCF["stackedTrees"], keys=CCF.pop("treeKeys"))
+
+    return CCF
+
+
+#-----------------------------------------------------------------------------#
+def packFeatureExpansion(featureExpansion):
+    """
+    Packs the random feature expansions of the nodes of a stacked forest
+    (node index -> [wZ, bZ, bIncOrig, proj]) into a few arrays, with the
+    parameters of all nodes concatenated and their shapes kept alongside,
+    rather than saving a separate set of small arrays for every node.
+    """
+    nodes = np.array(list(featureExpansion.keys()), dtype=np.int64)
+    packed = {"nodes": nodes, "bIncOrig": np.array([bool(details[2]) for details in featureExpansion.values()])}
+    for n, field in [(0, "wZ"), (1, "bZ"), (3, "proj")]:
+        values = [np.asarray(details[n]) for details in featureExpansion.values()]
+        if nodes.size == 0:
+            packed[field + "Shape"] = np.zeros((0, 2), dtype=np.int64)
+            packed[field] = np.zeros((0,))
+        else:
+            packed[field + "Shape"] = np.array([value.shape for value in values], dtype=np.int64)
+            packed[field] = np.concatenate([np.ravel(value) for value in values])
+
+    return packed
+
+
+def unpackFeatureExpansion(packed):
+    """
+    Inverse of packFeatureExpansion, the parameters of each node being views
+    of the packed arrays.
+    """
+    fields = {}
+    for field in ["wZ", "bZ", "proj"]:
+        shapes = packed[field + "Shape"]
+        sizes  = np.prod(shapes, axis=1)
+        starts = (np.cumsum(sizes) - sizes).tolist()
+        fields[field] = [packed[field][start:start+size].reshape(shape) for start, size, shape in zip(starts, sizes.tolist(), shapes.tolist())]
+
+    return OrderedDict((int(node), [fields["wZ"][n], fields["bZ"][n], bool(packed["bIncOrig"][n]), fields["proj"][n]])\
+                       for n, node in enumerate(packed["nodes"]))
+
+
+def toJSON(value, arrays, name, minArraySize=64):
+    """
+    Converts a forest field into a JSON compatible value.  Numeric arrays
+    of at least minArraySize elements are added to arrays under a name
+    derived from their position in the forest and replaced by a reference
+    to it.  Dicts with non-string keys, tuples, numpy scalars, other arrays
+    and class encoders are tagged so that fromJSON can restore them.
+    """
+    if isinstance(value, dict):
+        if all([isinstance(key, str) for key in value.keys()]):
+            return OrderedDict((key, toJSON(item, arrays, name + '.' + key, minArraySize)) for key, item in value.items())
+        return {"__dict__": [[toJSON(key, arrays, name, minArraySize), toJSON(item, arrays, name + '.' + str(n), minArraySize)]\
+                             for n, (key, item) in enumerate(value.items())]}
+
+    elif isinstance(value, (list, tuple)):
+        items = [toJSON(item, arrays, name + '.' + str(n), minArraySize) for n, item in enumerate(value)]
+        if isinstance(value, tuple):
+            return {"__tuple__": items}
+        return items
+
+    elif isinstance(value, np.ndarray):
+        if (value.dtype.kind in 'biuf') and (value.size >= minArraySize):
+            arrays[name] = value
+            return {"__npy__": name}
+        if value.dtype.kind in 'biufU':
+            return {"__array__": value.tolist(), "dtype": value.dtype.str, "shape": list(value.shape)}
+        return {"__array__": [toJSON(item, arrays, name + '.' + str(n), minArraySize) for n, item in enumerate(value.ravel().tolist())],\
+                "dtype": 'object', "shape": list(value.shape)}
+
+    elif isinstance(value, np.generic) and (value.dtype.kind in 'biufU'):
+        return {"__scalar__": value.item(), "dtype": value.dtype.str}
+
+    elif isinstance(value, OneHotEncoder):
+        return {"__OneHotEncoder__": [toJSON(np.asarray(categories), arrays, name + '.categories' + str(n), minArraySize)\
+                                      for n, categories in enumerate(value.categories_)],
+                "featureNames": toJSON(getattr(value, 'feature_names_in_', None), arrays, name + '.featureNames', minArraySize)}
+
+    elif (value is None) or isinstance(value, (bool, int, float, str)):
+        return value
+
+    else:
+        assert (False), 'Cannot save forest field {} of type {}'.format(name, type(value))
+
+
+def fromJSON(value, loadArray):
+    """
+    Inverse of toJSON, loadArray(name) giving the array saved under name.
+    """
+    if isinstance(value, list):
+        return [fromJSON(item, loadArray) for item in value]
+
+    elif isinstance(value, dict):
+        if "__npy__" in value:
+            return loadArray(value["__npy__"])
+
+        elif "__array__" in value:
+            if value["dtype"] == 'object':
+                items = [fromJSON(item, loadArray) for item in value["__array__"]]
+                array = np.empty((len(items),), dtype=object)
+                array[:] = items
+                return array.reshape(value["shape"])
+            return np.array(value["__array__"], dtype=np.dtype(value["dtype"])).reshape(value["shape"])
+
+        elif "__scalar__" in value:
+            return np.dtype(value["dtype"]).type(value["__scalar__"])
+
+        elif "__tuple__" in value:
+            return tuple([fromJSON(item, loadArray) for item in value["__tuple__"]])
+
+        elif "__dict__" in value:
+            return OrderedDict((fromJSON(key, loadArray), fromJSON(item, loadArray)) for key, item in value["__dict__"])
+
+        elif "__OneHotEncoder__" in value:
+            return encoderFromCategories([fromJSON(item, loadArray) for item in value["__OneHotEncoder__"]],\
+                                         fromJSON(value["featureNames"], loadArray))
+
+        return OrderedDict((key, fromJSON(item, loadArray)) for key, item in value.items())
+
+    return value
+
+
+def encoderFromCategories(categories, featureNames=None):
+    """
+    Rebuilds the fitted class encoder of classExpansion from its categories.
+    """
+    enc = OneHotEncoder(categories=categories, handle_unknown='ignore')
+    if featureNames is None:
+        # Integer column names, so no feature names are recorded
+        featureNames = range(len(categories))
+    nRows = max([len(c) for c in categories])
+    XFit  = pd.DataFrame(OrderedDict((name, np.resize(c, nRows)) for name, c in zip(featureNames, categories)))
+    enc.fit(XFit)
+
+    return enc
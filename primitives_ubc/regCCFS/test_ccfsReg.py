@@ -0,0 +1,452 @@
+import os
+import copy
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from unittest import mock
+
+from primitives_ubc.regCCFS.src import generate_CCF
+from primitives_ubc.regCCFS.src.generate_CCF import genCCF, extendCCF
+from primitives_ubc.regCCFS.src.compress_CCF import compressCCF
+from primitives_ubc.regCCFS.src.predict_from_CCF import predictFromCCF
+from primitives_ubc.regCCFS.src.predict_from_CCT import predictFromCCT
+from primitives_ubc.regCCFS.src.utils.commonUtils import is_numeric
+from primitives_ubc.regCCFS.src.utils.categoricalUtils import CategoricalMatrix
+from primitives_ubc.regCCFS.src.utils.persistUtils import saveCCF, loadCCF
+from primitives_ubc.regCCFS.src.utils.ccfUtils import random_missing_vals, trainingFingerprint
+from primitives_ubc.regCCFS.src.utils.flatTreeUtils import isFlatTree, flattenCCT
+from primitives_ubc.regCCFS.src.prediction_utils.traverse_treePredict import traverse_tree_predict
+from primitives_ubc.regCCFS.src.prediction_utils.replicate_input_process import replicateInputProcess
+from primitives_ubc.regCCFS.src.training_utils import grow_CCT, tree_executors
+from primitives_ubc.regCCFS.src.training_utils.split_search import searchSplits, searchSplitsBinned
+from primitives_ubc.regCCFS.src.training_utils.process_inputData import processInputData
+
+
+def defaultOptions(**kwargs):
+    """
+    Options as set by the primitive from its default hyperparameters, with
+    any given keyword arguments overriding them.
+    """
+    optionsFor = {}
+    optionsFor['nTrees']                      = 100
+    optionsFor['parallelprocessing']          = True
+    optionsFor['lambda']                      = 'log'
+    optionsFor['splitCriterion']              = 'mse'
+    optionsFor['minPointsLeaf']               = 3
+    optionsFor['bSepPred']                    = False
+    optionsFor['taskWeights']                 = 'even'
+    optionsFor['bProjBoot']                   = 'default'
+    optionsFor['bBagTrees']                   = 'default'
+    optionsFor['projections']                 = {'CCA': True}
+    optionsFor['treeRotation']                = 'none'
+    optionsFor['propTrain']                   = 1.0
+    optionsFor['epsilonCCA']                  = 1.0e-04
+    optionsFor['ccaMethod']                   = 'qr'
+    optionsFor['ccaSketch']                   = 'none'
+    optionsFor['ccaSketchSize']               = 256
+    optionsFor['histogramSplitMinPoints']     = 0
+    optionsFor['histogramSplitBins']          = 256
+    optionsFor['maxPointsForProjection']      = 0
+    optionsFor['categoricalEncoding']         = 'onehot'
+    optionsFor['precision']                   = 'float64'
+    optionsFor['randomSeed']                  = 0
+    optionsFor['treeWaveSize']                = 0
+    optionsFor['treeWaveTolerance']           = 1.0e-03
+    optionsFor['treeWavePatience']            = 3
+    optionsFor['bKeepOobStats']               = False
+    optionsFor['mseErrorTolerance']           = 1e-6
+    optionsFor['maxDepthSplit']               = 'stack'
+    optionsFor['treeGrowthOrder']             = 'depthFirst'
+    optionsFor['XVariationTol']               = 1.0e-10
+    optionsFor['RotForM']                     = 3
+    optionsFor['RotForpS']                    = 0.75
+    optionsFor['RotForpClassLeaveOut']        = 0.5
+    optionsFor['minPointsForSplit']           = 6
+    optionsFor['dirIfEqual']                  = 'first'
+    optionsFor['bContinueProjBootDegenerate'] = True
+    optionsFor['multiTaskGainCombination']    = 'mean'
+    optionsFor['missingValuesMethod']         = 'random'
+    optionsFor['bUseOutputComponentsMSE']     = False
+    optionsFor['bRCCA']                       = False
+    optionsFor['rccaLengthScale']             = 0.1
+    optionsFor['rccaNFeatures']               = 50
+    optionsFor['rccaRegLambda']               = 1e-3
+    optionsFor['rccaIncludeOriginal']         = False
+    optionsFor['classNames']                  = np.array([])
+    optionsFor['org_muY']                     = np.array([])
+    optionsFor['org_stdY']                    = np.array([])
+    optionsFor['mseTotal']                    = np.array([])
+    optionsFor.update(kwargs)
+
+    return optionsFor
+
+
+def makeData(N=300, D=5, seed=0):
+    """
+    Regression problem with features in a DataFrame, as passed by the
+    primitive, and outputs as an N x 1 array.
+    """
+    rng = np.random.RandomState(seed)
+    X   = rng.randn(N, D)
+    y   = X[:, 0] + X[:, 1]**2 + 0.1 * rng.randn(N)
+
+    return pd.DataFrame(X), y.reshape(-1, 1)
+
+
+def treeOutputs(CCF, X):
+    """
+    Outputs of the individual trees, which match only for identical forests.
+    """
+    return predictFromCCF(CCF, X, bTreeOutputs=True)[2]
+
+
+def sameTrees(a, b):
+    """
+    Whether two trees, or any of their parts, are exactly equal.
+    """
+    if isinstance(a, dict):
+        return (set(a.keys()) == set(b.keys())) and all([sameTrees(a[key], b[key]) for key in a])
+    elif isinstance(a, (list, tuple)):
+        return (len(a) == len(b)) and all([sameTrees(x, y) for x, y in zip(a, b)])
+    elif isinstance(a, np.ndarray):
+        return (a.shape == b.shape) and np.array_equal(a, b, equal_nan=(a.dtype.kind == 'f'))
+    elif isinstance(a, float) and np.isnan(a):
+        return isinstance(b, float) and np.isnan(b)
+    return bool(a == b)
+
+
+def nestedPredict(tree, X):
+    """
+    Reference prediction of a nested tree, as grown by growCCT, routing the
+    rows of X recursively one node at a time.
+    """
+    if tree["bLeaf"]:
+        return np.tile(tree["mean"], (X.shape[0], 1))
+
+    bLessChild = np.ravel(np.dot(X[:, tree["iIn"]], tree["decisionProjection"]) <= tree["paritionPoint"])
+    outputs = np.empty((X.shape[0], np.size(tree["mean"])))
+    outputs[bLessChild, :]  = nestedPredict(tree["lessthanChild"], X[bLessChild, :])
+    outputs[~bLessChild, :] = nestedPredict(tree["greaterthanChild"], X[~bLessChild, :])
+
+    return outputs
+
+
+def genNestedCCF(X, Y, nTrees, optionsFor):
+    """
+    Grows a forest serially, also returning the nested trees that were
+    converted to the stored flat trees.
+    """
+    nestedTrees = []
+    def recordNested(tree):
+        nestedTrees.append(copy.deepcopy(tree))
+        return flattenCCT(tree)
+
+    with mock.patch.object(generate_CCF, 'flattenCCT', recordNested):
+        CCF = genCCF(X, Y, nTrees=nTrees, optionsFor=optionsFor, do_parallel=False)
+
+    return CCF, nestedTrees
+
+
+class TestCanonicalCorrelationForestsRegressor(unittest.TestCase):
+    def test_single_output_trees_split(self):
+        # Projection bootstrapping draws the node outputs with an N x 1
+        # index, and genCCF passes mseTotal as a plain number
+        X, Y = makeData()
+        optionsFor = defaultOptions(bProjBoot=True)
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=optionsFor, do_parallel=False)
+
+        self.assertEqual(len(CCF["Trees"]), 5)
+        for tree in CCF["Trees"].values():
+            self.assertFalse(tree["bLeaf"][0])
+
+    def test_flat_prediction_matches_nested_trees(self):
+        X, Y = makeData()
+        for treeRotation in ['none', 'random']:
+            CCF, nestedTrees = genNestedCCF(X, Y, 5, defaultOptions(treeRotation=treeRotation))
+            outputs = treeOutputs(CCF, X)
+
+            XProc = replicateInputProcess(X, CCF["inputProcessDetails"])
+            for n, tree in enumerate(CCF["Trees"].values()):
+                self.assertTrue(isFlatTree(tree))
+                XTree = XProc
+                if "rotDetails" in tree:
+                    XTree = np.dot(np.subtract(XProc, tree["rotDetails"]["muX"]), tree["rotDetails"]["R"])
+                np.testing.assert_allclose(outputs[:, n, :], nestedPredict(nestedTrees[n], XTree))
+                np.testing.assert_allclose(outputs[:, n, :], traverse_tree_predict(tree, XProc)[0])
+
+    def test_tree_prediction_returns_leaves(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=3, optionsFor=defaultOptions(), do_parallel=False)
+        XProc = replicateInputProcess(X, CCF["inputProcessDetails"])
+        for tree in CCF["Trees"].values():
+            outputs, leaves = predictFromCCT(tree, XProc, bLeafIds=True)
+            self.assertTrue(np.all(tree["bLeaf"][leaves]))
+            np.testing.assert_array_equal(outputs, tree["mean"][leaves, :])
+            np.testing.assert_array_equal(outputs, predictFromCCT(tree, XProc))
+
+    def test_chunked_prediction_matches_whole(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=defaultOptions(), do_parallel=False)
+        predicts, _, outputs = predictFromCCF(CCF, X, bTreeOutputs=True)
+
+        # Small chunks so that several are used, including a partial one
+        chunkPredicts, _, chunkOutputs = predictFromCCF(CCF, X, bTreeOutputs=True, chunkSize=70)
+        np.testing.assert_allclose(predicts, chunkPredicts)
+        np.testing.assert_array_equal(outputs, chunkOutputs)
+        np.testing.assert_allclose(predicts, np.mean(outputs, axis=1))
+        self.assertIsNone(predictFromCCF(CCF, X, chunkSize=70)[2])
+
+    def test_parallel_fit_matches_serial(self):
+        X, Y = makeData()
+        optionsFor = defaultOptions(bBagTrees=True, treeRotation='random', bKeepOobStats=True)
+        serial   = genCCF(X, Y, nTrees=6, optionsFor=dict(optionsFor), do_parallel=False)
+        parallel = genCCF(X, Y, nTrees=6, optionsFor=dict(optionsFor), do_parallel=True)
+        for pos in serial["Trees"]:
+            self.assertTrue(sameTrees(serial["Trees"][pos], parallel["Trees"][pos]))
+        np.testing.assert_array_equal(serial["oobStats"]["nOOb"], parallel["oobStats"]["nOOb"])
+        np.testing.assert_allclose(serial["outOfBagError"], parallel["outOfBagError"])
+
+    def test_warm_start_matches_full_fit(self):
+        X, Y = makeData()
+        full = genCCF(X, Y, nTrees=10, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        warm = genCCF(X, Y, nTrees=6, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        warm = extendCCF(warm, X, Y, 4, do_parallel=False)
+
+        self.assertEqual(list(warm["Trees"].keys()), list(full["Trees"].keys()))
+        for pos in full["Trees"]:
+            self.assertTrue(sameTrees(full["Trees"][pos], warm["Trees"][pos]))
+        np.testing.assert_array_equal(full["oobStats"]["nOOb"], warm["oobStats"]["nOOb"])
+        np.testing.assert_allclose(full["oobStats"]["cumOOb"], warm["oobStats"]["cumOOb"])
+        np.testing.assert_allclose(full["outOfBagError"], warm["outOfBagError"])
+
+    def test_mixed_input_processing(self):
+        X = pd.DataFrame({'a': [0.5, 1.5, 2.5, 3.5], 'b': ['y', 'x', 'z', 'x'], 'c': [1, 'NA', 3, 4]})
+        np.testing.assert_array_equal(is_numeric(X, compress=False), [[True, False, True], [True, False, False],
+                                                                     [True, False, True], [True, False, True]])
+
+        # The single string in c marks missing values, b is expanded
+        XTrain, iFeatureNum, inputProcessDetails, featureNames = processInputData(X.copy(), FNormalize=False)
+        np.testing.assert_array_equal(XTrain, [[0.5, 1, 0, 1, 0], [1.5, np.nan, 1, 0, 0],
+                                               [2.5, 3, 0, 0, 1], [3.5, 4, 1, 0, 0]])
+        np.testing.assert_array_equal(iFeatureNum, [0, 1, 2, 2, 2])
+        np.testing.assert_array_equal(featureNames, ['a', 'c', 'Cat_x', 'Cat_y', 'Cat_z'])
+
+        # Categories not seen in training set none of the expanded features
+        XNew = pd.DataFrame({'a': [1.0, 2.0], 'b': ['w', 'z'], 'c': [2, 'NA']})
+        np.testing.assert_array_equal(replicateInputProcess(XNew, inputProcessDetails),
+                                      [[1, 2, 0, 0, 0], [2, np.nan, 0, 0, 1]])
+
+
+    def test_categorical_codes_match_one_hot(self):
+        X, Y = makeData()
+        rng  = np.random.RandomState(1)
+        X['g'] = np.where(X[0] > 0.5, 'p', rng.choice(['q', 'r', 's'], X.shape[0]))
+        X['h'] = rng.choice(['u', 'v'], X.shape[0])
+
+        XDense, _, _, _ = processInputData(X.copy())
+        XCodes, _, _, _ = processInputData(X.copy(), bExpandCategoricals=False)
+        self.assertIsInstance(XCodes, CategoricalMatrix)
+        self.assertEqual(XCodes.shape, XDense.shape)
+        np.testing.assert_allclose(np.asarray(XCodes), XDense)
+        rows, cols = rng.choice(X.shape[0], 20), np.array([6, 0, 9, 5])
+        np.testing.assert_allclose(XCodes[rows[:, np.newaxis], cols], XDense[rows[:, np.newaxis], cols])
+        np.testing.assert_allclose(XCodes[rows, :], XDense[rows, :])
+
+        outputs = []
+        for categoricalEncoding in ['onehot', 'codes']:
+            CCF = genCCF(X.copy(), Y, nTrees=5, optionsFor=defaultOptions(categoricalEncoding=categoricalEncoding), do_parallel=False)
+            outputs.append(treeOutputs(CCF, X.copy()))
+        # The z-scored indicator columns can differ in their last bits, which
+        # may settle the odd near tie between splits differently
+        self.assertGreater(np.mean(np.isclose(outputs[0], outputs[1])), 0.99)
+
+
+    def test_single_precision_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        CCF = genCCF(X, Y, nTrees=10, optionsFor=defaultOptions(precision='float32', treeRotation='random'), do_parallel=False)
+        for tree in CCF["Trees"].values():
+            for key in ["mean", "decisionProjection", "paritionPoint"]:
+                self.assertEqual(tree[key].dtype, np.float32)
+            self.assertEqual(tree["rotDetails"]["R"].dtype, np.float32)
+
+        predicts, _, outputs = predictFromCCF(CCF, XHeld, bTreeOutputs=True)
+        self.assertEqual(outputs.dtype, np.float32)
+        self.assertLess(np.mean((predicts - YHeld)**2), 0.25 * np.var(YHeld))
+
+
+    def test_binned_split_variation_tol(self):
+        # Only the split between points further apart than XVariationTol is
+        # allowed, as in the exact search
+        U = np.repeat([[0.0], [1e-12], [1.0]], [40, 40, 20], axis=0)
+        V = np.repeat([[0.0], [1.0], [1.0]], [40, 40, 20], axis=0)
+        options = defaultOptions(mseTotal=np.var(V, axis=0))
+        _, exactGains, exactSplits = searchSplits(U, V, options)
+        _, splitGains, iSplits = searchSplitsBinned(U, V, options, 8)
+        np.testing.assert_allclose(splitGains, exactGains)
+        np.testing.assert_array_equal(iSplits, [[79]])
+        np.testing.assert_array_equal(iSplits, exactSplits)
+
+    def test_binned_split_forest(self):
+        X, Y = makeData()
+        XHeld, YHeld = makeData(N=200, seed=1)
+        optionsFor = defaultOptions(histogramSplitMinPoints=50, histogramSplitBins=16)
+        with mock.patch.object(grow_CCT, 'searchSplitsBinned', wraps=grow_CCT.searchSplitsBinned) as binned:
+            CCF = genCCF(X, Y, nTrees=10, optionsFor=optionsFor, do_parallel=False)
+            self.assertGreater(binned.call_count, 0)
+
+        predicts, _, _ = predictFromCCF(CCF, XHeld)
+        self.assertLess(np.mean((predicts - YHeld)**2), 0.25 * np.var(YHeld))
+
+    def test_save_load_round_trip(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=defaultOptions(treeRotation='random', bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        predicts, _, outputs = predictFromCCF(CCF, X, bTreeOutputs=True)
+
+        folder = tempfile.mkdtemp()
+        try:
+            saveCCF(CCF, folder)
+            for mmap_mode in ['r', None]:
+                loaded = loadCCF(folder, mmap_mode=mmap_mode)
+                loadedPredicts, _, loadedOutputs = predictFromCCF(loaded, X, bTreeOutputs=True)
+                np.testing.assert_array_equal(predicts, loadedPredicts)
+                np.testing.assert_array_equal(outputs, loadedOutputs)
+
+            # Trees can still be added to a memory mapped forest
+            extended = extendCCF(loadCCF(folder, mmap_mode='r'), X, Y, 2, do_parallel=False)
+            self.assertEqual(treeOutputs(extended, X).shape[1], 7)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_extend_needs_original_training_data(self):
+        X, Y = makeData()
+        XOther, YOther = makeData(seed=1)
+        CCF = genCCF(X, Y, nTrees=2, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        with self.assertRaises(AssertionError):
+            extendCCF(CCF, XOther, YOther, 2, do_parallel=False)
+        self.assertEqual(len(CCF["Trees"]), 2)
+
+        self.assertEqual(CCF["trainingFingerprint"], trainingFingerprint(X.copy(), Y.copy()))
+        self.assertNotEqual(CCF["trainingFingerprint"], trainingFingerprint(X.iloc[::-1], Y))
+
+    def test_out_of_bag_stats_only_kept_for_warm_start(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(bBagTrees=True), do_parallel=False, bOutOfBagPreds=True)
+        self.assertNotIn("oobStats", CCF)
+        self.assertIn("outOfBagError", CCF)
+        self.assertEqual(CCF["outOfBagPreds"].shape[0], X.shape[0])
+        with self.assertRaises(AssertionError):
+            extendCCF(CCF, X, Y, 2, do_parallel=False)
+
+        folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(saveCCF(CCF, folder), 'header.json')) as f:
+                self.assertNotIn("oobStats", json.load(f)["CCF"])
+        finally:
+            shutil.rmtree(folder)
+
+        CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False)
+        self.assertEqual(CCF["oobStats"]["nOOb"].shape[0], X.shape[0])
+
+    def test_timeout_returns_partial_forest(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=200, optionsFor=defaultOptions(bBagTrees=True, bKeepOobStats=True), do_parallel=False, timeout=0)
+
+        # At least one tree is always grown, and the forest can be used and
+        # extended as usual
+        self.assertGreaterEqual(len(CCF["Trees"]), 1)
+        self.assertLess(len(CCF["Trees"]), 200)
+        predicts, _, _ = predictFromCCF(CCF, X)
+        self.assertEqual(predicts.shape[0], X.shape[0])
+
+        nTrees = len(CCF["Trees"])
+        CCF = extendCCF(CCF, X, Y, 3, do_parallel=False)
+        self.assertEqual(len(CCF["Trees"]), nTrees + 3)
+
+    def test_tree_waves_converge(self):
+        X, Y = makeData()
+        optionsFor = defaultOptions(treeWaveSize=5, treeWaveTolerance=0.02, treeWavePatience=2)
+        CCF = genCCF(X, Y, nTrees=500, optionsFor=optionsFor, do_parallel=False)
+
+        waves = CCF["treeWaves"]
+        self.assertTrue(waves["bConverged"])
+        self.assertLess(len(CCF["Trees"]), 500)
+        self.assertEqual(waves["nTrees"][-1], len(CCF["Trees"]))
+        self.assertEqual(waves["nTrees"], list(range(5, len(CCF["Trees"]) + 1, 5)))
+
+    def test_compression_within_tolerance(self):
+        X, Y = makeData()
+        XHeld, _ = makeData(N=200, seed=1)
+        CCF = genCCF(X, Y, nTrees=30, optionsFor=defaultOptions(), do_parallel=False)
+
+        compressed = compressCCF(CCF, XHeld, tol=0.05)
+        self.assertLess(len(compressed["Trees"]), 30)
+        self.assertLessEqual(compressed["compression"]["deviation"], 0.05)
+
+    def test_executors_match_serial(self):
+        X, Y = makeData()
+        for treeRotation in ['none', 'random', 'pca']:
+            optionsFor = defaultOptions(treeRotation=treeRotation)
+            serial  = genCCF(X, Y, nTrees=4, optionsFor=dict(optionsFor), executor=tree_executors.SerialExecutor())
+            thread  = genCCF(X, Y, nTrees=4, optionsFor=dict(optionsFor), executor=tree_executors.ThreadExecutor(2))
+            process = genCCF(X, Y, nTrees=4, optionsFor=dict(optionsFor), executor=tree_executors.ProcessExecutor(2))
+
+            for CCF in [thread, process]:
+                self.assertEqual(list(CCF["Trees"].keys()), list(serial["Trees"].keys()))
+                for pos in serial["Trees"]:
+                    self.assertTrue(sameTrees(serial["Trees"][pos], CCF["Trees"][pos]), treeRotation)
+
+    def test_thread_cancel_stops_trees(self):
+        X, Y = makeData()
+        splitNode = grow_CCT.splitNode
+        nodeTimes = []
+        def slowSplitNode(*args, **kwargs):
+            time.sleep(0.02)
+            nodeTimes.append(time.time())
+            return splitNode(*args, **kwargs)
+
+        # With a single thread the second tree starts as the first finishes,
+        # after the timeout, and must stop at its next node once cancelled
+        with mock.patch.object(grow_CCT, 'splitNode', side_effect=slowSplitNode):
+            CCF = genCCF(X, Y, nTrees=4, optionsFor=defaultOptions(), timeout=0.1, executor=tree_executors.ThreadExecutor(1))
+            nNodes = len(nodeTimes)
+            time.sleep(0.5)
+        self.assertEqual(len(CCF["Trees"]), 1)
+        self.assertLessEqual(len(nodeTimes) - nNodes, 1)
+
+    def test_parallel_fit_many_trees(self):
+        # Enough trees for the process pool to be sent several per worker
+        nTrees = 8 * mp.cpu_count() + 1
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=nTrees, optionsFor=defaultOptions(), do_parallel=True)
+
+        self.assertEqual(list(CCF["Trees"].keys()), list(range(nTrees)))
+
+    def test_missing_values_filled_per_tree(self):
+        X, Y = makeData()
+        CCF = genCCF(X, Y, nTrees=5, optionsFor=defaultOptions(), do_parallel=False)
+        XTest = X.iloc[0:20, :].copy()
+        XTest.iloc[::2, 0] = np.nan
+
+        np.random.seed(1)
+        outputs = treeOutputs(CCF, XTest)
+
+        # Replay the draws, the rows with missing values being filled anew
+        # for each tree in turn
+        XProc = replicateInputProcess(XTest, CCF["inputProcessDetails"])
+        bMissing = np.any(np.isnan(XProc), axis=1)
+        self.assertTrue(np.any(bMissing))
+        np.random.seed(1)
+        for n, tree in enumerate(CCF["Trees"].values()):
+            XTree = np.array(XProc)
+            XTree[bMissing, :] = random_missing_vals(XProc[bMissing, :])
+            np.testing.assert_allclose(outputs[:, n, :], traverse_tree_predict(tree, XTree)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()